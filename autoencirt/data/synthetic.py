@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""Seeded synthetic graded-response data, written to disk in chunks
+"""
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+HEADER_FILE = "synthetic.json"
+
+
+def grm_probs(abilities, discriminations, difficulties, weight_exponent=1.0):
+    """Numpy mirror of GRModel.grm_model_prob for people x dims abilities
+
+    Args:
+        abilities (np.ndarray): N x D
+        discriminations (np.ndarray): D x I
+        difficulties (np.ndarray): D x I x (K-1), sorted along the last axis
+        weight_exponent (float, optional): Defaults to 1.0.
+
+    Returns:
+        np.ndarray: N x I x K category probabilities
+    """
+    offsets = difficulties[np.newaxis] - abilities[:, :, np.newaxis,
+                                                   np.newaxis]
+    cumulative = 1.0/(1.0 + np.exp(
+        offsets*discriminations[np.newaxis, :, :, np.newaxis]))
+    ones = np.ones(cumulative.shape[:-1] + (1,))
+    cumulative = np.concatenate(
+        [ones, cumulative, np.zeros_like(ones)], axis=-1)
+    probs = cumulative[..., :-1] - cumulative[..., 1:]
+    weights = np.abs(discriminations)**weight_exponent
+    weights = weights/np.sum(weights, axis=0, keepdims=True)
+    return np.sum(probs*weights[np.newaxis, :, :, np.newaxis], axis=1)
+
+
+def sample_categories(probs, rng):
+    """Vectorized categorical draws along the last axis
+    """
+    u = rng.random(probs.shape[:-1] + (1,))
+    return np.sum(np.cumsum(probs, axis=-1)[..., :-1] < u, axis=-1)
+
+
+class MissingCompletelyAtRandom(object):
+    """Each response is missing with probability `rate`, a float or one
+    rate per item
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def __call__(self, abilities, rng, shape):
+        if np.all(np.asarray(self.rate) == 0):
+            return None
+        return rng.random(shape) < self.rate
+
+    def get_config(self):
+        return {'pattern': 'mcar', 'rate': np.asarray(self.rate).tolist()}
+
+
+class MissingByAbility(object):
+    """Missing with probability sigmoid(logit(rate) + slope*theta_d),
+    e.g. people low on a trait skipping more items
+    """
+
+    def __init__(self, rate, slope=-1.0, dimension=0):
+        self.rate = rate
+        self.slope = slope
+        self.dimension = dimension
+
+    def __call__(self, abilities, rng, shape):
+        logit = np.log(self.rate) - np.log1p(-self.rate) + (
+            self.slope*abilities[:, self.dimension:(self.dimension + 1)])
+        return rng.random(shape) < 1.0/(1.0 + np.exp(-logit))
+
+    def get_config(self):
+        return {
+            'pattern': 'ability', 'rate': float(self.rate),
+            'slope': float(self.slope), 'dimension': int(self.dimension)}
+
+
+class PlannedForms(object):
+    """Planned missingness: every person answers only the items of one
+    form, chosen at random
+
+    Args:
+        forms (list): lists of item indices
+        weights (list, optional): form probabilities. Defaults to equal.
+    """
+
+    def __init__(self, forms, weights=None):
+        self.forms = [list(f) for f in forms]
+        self.weights = weights
+
+    def __call__(self, abilities, rng, shape):
+        answered = np.zeros((len(self.forms), shape[-1]), dtype=bool)
+        for j, form in enumerate(self.forms):
+            answered[j, form] = True
+        form = rng.choice(len(self.forms), size=shape[0], p=self.weights)
+        return ~answered[form]
+
+    def get_config(self):
+        return {
+            'pattern': 'forms', 'forms': self.forms,
+            'weights': None if self.weights is None else list(
+                self.weights)}
+
+
+def simulate_responses(
+        path, num_people, discriminations, difficulties, missingness=0.0,
+        seed=0, chunk_size=10000, weight_exponent=1.0, ability_mean=0.0,
+        ability_scale=1.0, item_keys=None):
+    """Stream GRM responses for given item parameters to `path`
+
+    People are drawn, answered and written one chunk at a time, with the
+    chunk computed by vectorized numpy, so memory depends on chunk_size
+    and not on num_people. Writes responses.npy (int8, -1 for missing,
+    readable by load_synthetic), abilities.npy (float32), params.npz and
+    a json header.
+
+    Args:
+        path (str): output directory
+        num_people (int): N
+        discriminations (np.ndarray): D x I
+        difficulties (np.ndarray): D x I x (K-1), sorted along the last
+            axis
+        missingness (optional): missing completely at random with this
+            probability, a float or one per item, or a pattern such as
+            MissingByAbility or PlannedForms, called with the chunk's
+            abilities, the generator and the chunk shape. Defaults to 0.0.
+        seed (int or np.random.Generator, optional): Defaults to 0.
+        chunk_size (int, optional): People per chunk. Defaults to 10000.
+        weight_exponent (float, optional): Defaults to 1.0.
+        ability_mean (float or np.ndarray, optional): per dimension.
+            Defaults to 0.0.
+        ability_scale (float or np.ndarray, optional): per dimension.
+            Defaults to 1.0.
+        item_keys (list, optional): Defaults to item0, item1, ...
+
+    Returns:
+        (dict, dict): the header, and the true parameters with the
+            abilities as a read-only memory map
+    """
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    discriminations = np.asarray(discriminations, dtype=np.float64)
+    difficulties = np.asarray(difficulties, dtype=np.float64)
+    dimensions, num_items = discriminations.shape
+    K = difficulties.shape[-1] + 1
+    if K > 128:
+        raise ValueError("Responses are stored as int8")
+    pattern = missingness
+    if not callable(pattern):
+        pattern = MissingCompletelyAtRandom(missingness)
+    np.savez(
+        os.path.join(path, "params.npz"),
+        discriminations=discriminations, difficulties=difficulties)
+
+    responses = np.lib.format.open_memmap(
+        os.path.join(path, "responses.npy"), mode="w+", dtype=np.int8,
+        shape=(num_people, num_items))
+    abilities = np.lib.format.open_memmap(
+        os.path.join(path, "abilities.npy"), mode="w+", dtype=np.float32,
+        shape=(num_people, dimensions))
+    for start in range(0, num_people, chunk_size):
+        stop = min(start + chunk_size, num_people)
+        theta = ability_mean + ability_scale*rng.normal(
+            size=(stop - start, dimensions))
+        choices = sample_categories(
+            grm_probs(theta, discriminations, difficulties, weight_exponent),
+            rng)
+        missing = pattern(theta, rng, choices.shape)
+        if missing is not None:
+            choices[missing] = -1
+        responses[start:stop] = choices
+        abilities[start:stop] = theta
+    responses.flush()
+    abilities.flush()
+    del responses, abilities
+
+    header = {
+        "num_people": int(num_people),
+        "num_items": int(num_items),
+        "response_cardinality": int(K),
+        "dimensions": int(dimensions),
+        "missingness": (
+            float(missingness) if np.isscalar(missingness)
+            else pattern.get_config()),
+        "seed": int(seed) if isinstance(seed, (int, np.integer)) else None,
+        "item_keys": (
+            [f"item{j}" for j in range(num_items)] if item_keys is None
+            else list(item_keys))
+    }
+    with open(os.path.join(path, HEADER_FILE), "w") as file:
+        json.dump(header, file, indent=1)
+    return header, load_params(path)
+
+
+def simulate_grm(
+        path, num_people, num_items, response_cardinality=5, dimensions=1,
+        missingness=0.0, seed=0, chunk_size=10000, weight_exponent=1.0):
+    """Simulate GRM responses to `path` one chunk of people at a time
+
+    Item parameters are drawn at random, see simulate_responses for the
+    files written.
+
+    Args:
+        path (str): output directory
+        num_people (int): N
+        num_items (int): I
+        response_cardinality (int, optional): K. Defaults to 5.
+        dimensions (int, optional): D. Defaults to 1.
+        missingness (optional): see simulate_responses. Defaults to 0.0.
+        seed (int, optional): Defaults to 0.
+        chunk_size (int, optional): People per chunk. Defaults to 10000.
+        weight_exponent (float, optional): Defaults to 1.0.
+
+    Returns:
+        dict: the header
+    """
+    rng = np.random.default_rng(seed)
+    K = response_cardinality
+    discriminations = np.abs(rng.normal(
+        1.5, 0.5, size=(dimensions, num_items)))
+    difficulties = np.sort(
+        rng.normal(size=(dimensions, num_items, K - 1)), axis=-1)
+    header, _ = simulate_responses(
+        path, num_people, discriminations, difficulties,
+        missingness=missingness, seed=rng, chunk_size=chunk_size,
+        weight_exponent=weight_exponent)
+    header["seed"] = int(seed)
+    with open(os.path.join(path, HEADER_FILE), "w") as file:
+        json.dump(header, file, indent=1)
+    return header
+
+
+def model_params(model):
+    """Item parameters of a calibrated GRModel or DichotomousModel, in the
+    layout of simulate_responses
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray, np.ndarray): discriminations
+            D x I, difficulties D x I x (K-1), and the mean and standard
+            deviation of the calibrated abilities over people, D
+    """
+    expectations = model.calibrated_expectations
+    discriminations = np.asarray(expectations['discriminations'])[0, ..., 0]
+    difficulties = np.asarray(expectations['difficulties0'])[0]
+    if 'ddifficulties' in expectations:
+        difficulties = np.cumsum(np.concatenate(
+            [difficulties, np.asarray(expectations['ddifficulties'])[0]],
+            axis=-1), axis=-1)
+    abilities = np.asarray(expectations['abilities'])[:, :, 0, 0]
+    return (
+        discriminations, difficulties, np.mean(abilities, axis=0),
+        np.std(abilities, axis=0))
+
+
+def simulate_from_model(model, path, num_people, abilities='calibrated',
+                        **kwargs):
+    """simulate_responses with the calibrated item parameters of a model
+
+    Args:
+        abilities (str, optional): 'calibrated' draws people from a
+            normal with the mean and spread of the calibrated abilities,
+            'prior' from the standard normal prior. Defaults to
+            'calibrated'.
+        **kwargs: passed on to simulate_responses
+
+    Returns:
+        (dict, dict): the header and the true parameters
+    """
+    discriminations, difficulties, mean, sd = model_params(model)
+    if abilities == 'prior':
+        mean, sd = 0.0, 1.0
+    return simulate_responses(
+        path, num_people, discriminations, difficulties,
+        weight_exponent=model.weight_exponent, ability_mean=mean,
+        ability_scale=sd, item_keys=model.item_keys, **kwargs)
+
+
+def load_params(path, mmap_mode="r"):
+    """True parameters of a simulated data set
+
+    Returns:
+        dict: discriminations, difficulties and abilities
+    """
+    params = dict(np.load(os.path.join(path, "params.npz")))
+    params["abilities"] = np.load(
+        os.path.join(path, "abilities.npy"), mmap_mode=mmap_mode)
+    return params
+
+
+def pack_dataset(data, path, item_keys, num_people, response_cardinality,
+                 person_key="person", chunk_size=65536):
+    """Write a per-person tf.data.Dataset in the layout of simulate_grm
+
+    Responses go to an int8 responses.npy, row by person index, with -1
+    for anything negative or NaN, so that load_synthetic can stream them
+    back from a memory map.
+
+    Returns:
+        dict: the header
+    """
+    os.makedirs(path, exist_ok=True)
+    responses = np.lib.format.open_memmap(
+        os.path.join(path, "responses.npy"), mode="w+", dtype=np.int8,
+        shape=(num_people, len(item_keys)))
+    responses[:] = -1
+    for batch in data.batch(chunk_size):
+        people = batch[person_key].numpy().astype(np.int64)
+        chunk = np.stack(
+            [batch[k].numpy().astype(np.float64) for k in item_keys], axis=-1)
+        responses[people] = np.where(
+            np.isfinite(chunk) & (chunk >= 0), chunk, -1).astype(np.int8)
+    responses.flush()
+
+    header = {
+        "num_people": int(num_people),
+        "num_items": len(item_keys),
+        "response_cardinality": int(response_cardinality),
+        "item_keys": list(item_keys)
+    }
+    with open(os.path.join(path, HEADER_FILE), "w") as file:
+        json.dump(header, file, indent=1)
+    return header
+
+
+def load_synthetic(path, person_key="person", chunk_size=65536,
+                   holdout=None, held_out=False):
+    """Stream a simulated data set as a per-person tf.data.Dataset
+
+    Args:
+        holdout (str, optional): .npy file of a boolean people x items
+            mask. Masked responses are dropped (set missing), or with
+            `held_out` they are the only ones kept. Defaults to None.
+        held_out (bool, optional): Defaults to False.
+
+    Returns:
+        (tf.data.Dataset, dict): dataset of {item: float32, person: int64}
+            records, and the header
+    """
+    with open(os.path.join(path, HEADER_FILE), "r") as file:
+        header = json.load(file)
+    responses = np.load(os.path.join(path, "responses.npy"), mmap_mode="r")
+    mask = None if holdout is None else np.load(holdout, mmap_mode="r")
+    num_people = header["num_people"]
+    item_keys = header["item_keys"]
+
+    def data_gen():
+        for start in range(0, num_people, chunk_size):
+            stop = min(start + chunk_size, num_people)
+            chunk = np.asarray(responses[start:stop], dtype=np.float32)
+            if mask is not None:
+                keep = np.asarray(mask[start:stop]) == held_out
+                chunk = np.where(keep, chunk, np.float32(-1))
+            record = {k: chunk[:, j] for j, k in enumerate(item_keys)}
+            record[person_key] = np.arange(start, stop, dtype=np.int64)
+            yield record
+
+    dataset = tf.data.Dataset.from_generator(
+        data_gen,
+        output_types={
+            **{k: tf.float32 for k in item_keys}, person_key: tf.int64},
+        output_shapes={
+            **{k: (None,) for k in item_keys}, person_key: (None,)}
+    ).unbatch().apply(tf.data.experimental.assert_cardinality(num_people))
+    return dataset, header
@@ -1,5 +1,6 @@
 from .irt import IRTModel
 from .grm import GRModel
+from .dichotomous import DichotomousModel
+from .multi import MultiGRModel
 from .irt import IRTModel
 from .model import BayesianModel
-
@@ -0,0 +1,446 @@
+import json
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+tfd = tfp.distributions
+
+STORE_FILE = "store.json"
+ARRAYS = ['loc', 'raw_scale', 'm_loc', 'v_loc', 'm_raw_scale',
+          'v_raw_scale', 'step']
+
+
+def _softplus_inverse(x):
+    return x + np.log(-np.expm1(-x))
+
+
+def _softplus(x):
+    return np.logaddexp(0., x)
+
+
+class AbilityStore(object):
+    """Disk-backed factorized Normal surrogate for per-person abilities
+
+    The locations, softplus-inverse scales and their Adam moments are kept
+    in partitioned, memory-mapped .npy files of `partition_size` people
+    each, in the storage dtype (float32 by default). Training
+    pages in the rows of a batch and writes them back after a lazy Adam
+    step, so only touched rows are read or updated and RAM does not grow
+    with the number of people.
+
+    Duck-types the parts of a distribution that PosteriorSampleStore uses
+    (batch_shape, event_shape, dtype and sample_rows).
+
+    Args:
+        num_people (int): N
+        event_shape (list): per-person shape, e.g. [D, 1, 1]
+        directory (str, optional): Defaults to a temporary directory
+            removed with the store.
+        dtype (str, optional): storage dtype. Defaults to 'float32'.
+        model_dtype (tf.DType, optional): dtype of the paged-in tensors.
+            Defaults to tf.float64.
+        partition_size (int, optional): People per file. Defaults to 2**20.
+        init_loc (float, optional): Defaults to 0.
+        init_scale (float, optional): Defaults to 0.1.
+        mmap_mode (str, optional): 'w+' creates the files, 'r+' opens them
+            for training, 'r' read only. Defaults to 'w+'.
+    """
+
+    def __init__(
+            self, num_people, event_shape, directory=None, dtype='float32',
+            model_dtype=tf.float64, partition_size=2**20, init_loc=0.,
+            init_scale=1e-1, mmap_mode='w+', beta_1=0.9, beta_2=0.999,
+            epsilon=1e-7):
+        self.num_people = int(num_people)
+        self.event_shape_list = [int(d) for d in event_shape]
+        self.storage_dtype = np.dtype(dtype)
+        self.model_dtype = tf.as_dtype(model_dtype)
+        self.partition_size = int(partition_size)
+        self.mmap_mode = mmap_mode
+        self.init_loc = float(init_loc)
+        self.init_scale = float(init_scale)
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="autoencirt_abilities_")
+            self._finalizer = weakref.finalize(
+                self, shutil.rmtree, directory, True)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.num_partitions = int(
+            np.ceil(self.num_people/self.partition_size))
+        self._arrays = {k: [] for k in ARRAYS}
+        for p in range(self.num_partitions):
+            for k in ARRAYS:
+                if mmap_mode == 'w+':
+                    self._arrays[k] += [
+                        self._create(k, p, self._partition_rows(p))]
+                else:
+                    self._arrays[k] += [self._open(k, p)]
+        if mmap_mode == 'w+':
+            self._write_header()
+
+    def _partition_rows(self, partition, num_people=None):
+        num_people = self.num_people if num_people is None else num_people
+        return min(
+            self.partition_size, num_people - partition*self.partition_size)
+
+    def _path(self, name, partition):
+        return os.path.join(self.directory, f"{name}.{partition}.npy")
+
+    def _open(self, name, partition):
+        return np.load(self._path(name, partition), mmap_mode=self.mmap_mode)
+
+    def _create(self, name, partition, rows, path=None):
+        dtype = np.int32 if name == 'step' else self.storage_dtype
+        shape = (rows,) + (
+            () if name == 'step' else tuple(self.event_shape_list))
+        out = np.lib.format.open_memmap(
+            self._path(name, partition) if path is None else path,
+            mode='w+', dtype=dtype, shape=shape)
+        out[:] = {
+            'loc': self.init_loc,
+            'raw_scale': _softplus_inverse(self.init_scale)
+        }.get(name, 0)
+        return out
+
+    def grow(self, num_people):
+        """Extend the store to `num_people` rows with initial values
+
+        Only the last partition is rewritten, existing rows keep their
+        values and optimizer state.
+        """
+        if num_people <= self.num_people:
+            return
+        if self.mmap_mode == 'r':
+            raise ValueError("The ability store is open read only")
+        self.flush()
+        last = self.num_partitions - 1
+        partitions = int(np.ceil(num_people/self.partition_size))
+        for k in ARRAYS:
+            if last >= 0 and self._arrays[k][last].shape[0] < (
+                    self.partition_size):
+                old = self._arrays[k][last]
+                tmp = self._path(k, last) + ".tmp"
+                new = self._create(
+                    k, last, self._partition_rows(last, num_people), tmp)
+                new[:old.shape[0]] = old
+                new.flush()
+                del new
+                self._arrays[k][last] = None
+                del old
+                os.replace(tmp, self._path(k, last))
+                self._arrays[k][last] = np.load(
+                    self._path(k, last), mmap_mode='r+')
+            for p in range(self.num_partitions, partitions):
+                self._arrays[k] += [
+                    self._create(k, p, self._partition_rows(p, num_people))]
+        self.num_people = int(num_people)
+        self.num_partitions = partitions
+        if self.mmap_mode == 'w+':
+            # reopen rather than truncate
+            self.mmap_mode = 'r+'
+        self._write_header()
+
+    def _write_header(self):
+        with open(os.path.join(self.directory, STORE_FILE), "w") as file:
+            json.dump(self.get_config(), file, indent=1)
+
+    def get_config(self):
+        return {
+            'num_people': self.num_people,
+            'event_shape': self.event_shape_list,
+            'dtype': self.storage_dtype.name,
+            'partition_size': self.partition_size,
+            'init_loc': self.init_loc,
+            'init_scale': self.init_scale
+        }
+
+    @classmethod
+    def open(cls, directory, mmap_mode='r+', model_dtype=tf.float64):
+        with open(os.path.join(directory, STORE_FILE), "r") as file:
+            config = json.load(file)
+        return cls(
+            config['num_people'], config['event_shape'], directory,
+            config['dtype'], model_dtype, config['partition_size'],
+            init_loc=config.get('init_loc', 0.),
+            init_scale=config.get('init_scale', 1e-1), mmap_mode=mmap_mode)
+
+    def save(self, directory):
+        """Copy the store files to `directory`
+        """
+        self.flush()
+        if os.path.abspath(directory) == os.path.abspath(self.directory):
+            return
+        os.makedirs(directory, exist_ok=True)
+        for f in os.listdir(self.directory):
+            shutil.copyfile(
+                os.path.join(self.directory, f),
+                os.path.join(directory, f))
+
+    def __getstate__(self):
+        # the files are the state, reopen them on unpickling
+        self.flush()
+        state = self.__dict__.copy()
+        state.pop('_arrays')
+        state.pop('_finalizer', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        if self.mmap_mode == 'w+':
+            self.mmap_mode = 'r+'
+        self._arrays = {
+            k: [self._open(k, p) for p in range(self.num_partitions)]
+            for k in ARRAYS}
+
+    def flush(self):
+        for arrays in self._arrays.values():
+            for a in arrays:
+                if isinstance(a, np.memmap):
+                    a.flush()
+
+    # distribution-like interface for PosteriorSampleStore
+
+    @property
+    def batch_shape(self):
+        return tf.TensorShape([self.num_people] + self.event_shape_list)
+
+    @property
+    def event_shape(self):
+        return tf.TensorShape([])
+
+    @property
+    def dtype(self):
+        return self.model_dtype
+
+    def distribution(self, rows=None, start=0, stop=None):
+        """Independent Normal over the given rows, as model_dtype tensors
+        """
+        if rows is None:
+            stop = self.num_people if stop is None else stop
+            loc = self.read('loc', start=start, stop=stop)
+            raw_scale = self.read('raw_scale', start=start, stop=stop)
+        else:
+            loc = self.take('loc', rows)
+            raw_scale = self.take('raw_scale', rows)
+        return tfd.Independent(
+            tfd.Normal(
+                loc=tf.cast(loc, self.model_dtype),
+                scale=tf.cast(_softplus(raw_scale), self.model_dtype)),
+            reinterpreted_batch_ndims=1 + len(self.event_shape_list))
+
+    def sample_rows(self, start, stop, num_samples, seed=None):
+        return self.distribution(start=start, stop=stop).sample(
+            num_samples, seed=seed)
+
+    def mean(self, start=0, stop=None):
+        return self.read('loc', start=start, stop=stop)
+
+    def stddev(self, start=0, stop=None):
+        return _softplus(self.read('raw_scale', start=start, stop=stop))
+
+    # row access
+
+    def _locate(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows//self.partition_size, rows % self.partition_size
+
+    def take(self, name, rows):
+        partitions, offsets = self._locate(rows)
+        if name == 'step':
+            out = np.empty(len(partitions), np.int32)
+        else:
+            out = np.empty(
+                (len(partitions),) + tuple(self.event_shape_list),
+                self.storage_dtype)
+        for p in np.unique(partitions):
+            mask = partitions == p
+            out[mask] = self._arrays[name][p][offsets[mask]]
+        return out
+
+    def put(self, name, rows, values):
+        partitions, offsets = self._locate(rows)
+        for p in np.unique(partitions):
+            mask = partitions == p
+            self._arrays[name][p][offsets[mask]] = values[mask]
+
+    def read(self, name, start=0, stop=None):
+        """Contiguous rows [start, stop)
+        """
+        stop = self.num_people if stop is None else stop
+        return self.take(name, np.arange(start, stop))
+
+    def apply_gradients(self, rows, grads, learning_rate):
+        """Lazy Adam on the given rows only
+
+        Every row keeps its own step count for the bias correction, so
+        rows that are rarely touched are not penalized. Rows with a
+        non-finite gradient are left as they are.
+
+        Args:
+            rows (np.ndarray): unique person indices
+            grads (dict): {'loc': ..., 'raw_scale': ...} shaped
+                [len(rows)] + event_shape
+            learning_rate (float):
+        """
+        if self.mmap_mode == 'r':
+            raise ValueError("The ability store is open read only")
+        grads = {
+            name: np.asarray(g, dtype=np.float64)
+            for name, g in grads.items()}
+        axes = tuple(range(1, 1 + len(self.event_shape_list)))
+        finite = np.all([
+            np.all(np.isfinite(g), axis=axes) for g in grads.values()],
+            axis=0)
+        if not np.all(finite):
+            rows = np.asarray(rows)[finite]
+            grads = {name: g[finite] for name, g in grads.items()}
+        step = self.take('step', rows) + 1
+        self.put('step', rows, step)
+        t = step.reshape((-1,) + (1,)*len(self.event_shape_list))
+        for name, g in grads.items():
+            m = self.beta_1*self.take(f"m_{name}", rows) + (
+                1. - self.beta_1)*g
+            v = self.beta_2*self.take(f"v_{name}", rows) + (
+                1. - self.beta_2)*g**2
+            m_hat = m/(1. - self.beta_1**t)
+            v_hat = v/(1. - self.beta_2**t)
+            value = self.take(name, rows) - learning_rate*m_hat/(
+                np.sqrt(v_hat) + self.epsilon)
+            self.put(f"m_{name}", rows, m.astype(self.storage_dtype))
+            self.put(f"v_{name}", rows, v.astype(self.storage_dtype))
+            self.put(name, rows, value.astype(self.storage_dtype))
+
+
+class StoreMoment(object):
+    """Per-person mean or standard deviation of an AbilityStore, read
+    lazily
+
+    Indexing reads only the selected rows, so the expectations of a paged
+    variable take no memory until used. np.asarray and
+    tf.convert_to_tensor read every row.
+
+    Args:
+        store (AbilityStore):
+        moment (str, optional): 'mean' or 'stddev'. Defaults to 'mean'.
+    """
+
+    def __init__(self, store, moment='mean'):
+        if moment not in ['mean', 'stddev']:
+            raise ValueError(f"Unknown moment {moment}")
+        self.store = store
+        self.moment = moment
+
+    @property
+    def shape(self):
+        return (self.store.num_people,) + tuple(self.store.event_shape_list)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.store.storage_dtype
+
+    def __len__(self):
+        return self.store.num_people
+
+    def _take(self, rows):
+        if self.moment == 'mean':
+            return self.store.take('loc', rows)
+        return _softplus(self.store.take('raw_scale', rows)).astype(
+            self.dtype)
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        rows = np.arange(self.store.num_people)[index[0]]
+        values = self._take(np.atleast_1d(rows))
+        if np.ndim(rows) == 0:
+            values = values[0]
+        return values[index[1:]]
+
+    def __array__(self, dtype=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+    def population_moments(self):
+        """Mean and standard deviation over people, reading one partition
+        at a time
+        """
+        total = 0.
+        total2 = 0.
+        for start in range(
+                0, self.store.num_people, self.store.partition_size):
+            stop = min(
+                start + self.store.partition_size, self.store.num_people)
+            values = self[start:stop].astype(np.float64)
+            total = total + np.sum(values, axis=0)
+            total2 = total2 + np.sum(values**2, axis=0)
+        mean = total/self.store.num_people
+        return mean, np.sqrt(np.maximum(
+            total2/self.store.num_people - mean**2, 0.))
+
+
+tf.register_tensor_conversion_function(
+    StoreMoment,
+    lambda value, dtype=None, name=None, as_ref=False: tf.convert_to_tensor(
+        np.asarray(value), dtype=dtype, name=name))
+
+
+class AbilityPage(object):
+    """Rows of an AbilityStore paged into trainable variables for one batch
+    """
+
+    def __init__(self, store):
+        self.store = store
+        shape = tf.TensorShape([None] + store.event_shape_list)
+        zeros = tf.zeros([0] + store.event_shape_list, store.model_dtype)
+        self.loc = tf.Variable(zeros, shape=shape, name="abilities_loc")
+        self.raw_scale = tf.Variable(
+            zeros, shape=shape, name="abilities_raw_scale")
+        self.rows = None
+
+    @property
+    def variables(self):
+        return [self.loc, self.raw_scale]
+
+    def page_in(self, batch, person_key):
+        """Load the batch's people and re-index the batch to the page
+        """
+        people = batch[person_key].numpy()
+        self.rows, inverse = np.unique(people, return_inverse=True)
+        self.refresh()
+        return {
+            **batch,
+            person_key: tf.constant(inverse, dtype=batch[person_key].dtype)}
+
+    def distribution(self):
+        return tfd.Independent(
+            tfd.Normal(
+                loc=self.loc, scale=tf.math.softplus(self.raw_scale)),
+            reinterpreted_batch_ndims=1 + len(self.store.event_shape_list))
+
+    def refresh(self):
+        self.loc.assign(tf.cast(
+            self.store.take('loc', self.rows), self.store.model_dtype))
+        self.raw_scale.assign(tf.cast(
+            self.store.take('raw_scale', self.rows), self.store.model_dtype))
+
+    def apply_gradients(self, grads, learning_rate):
+        """Lazy Adam step on the paged rows, written through to the store
+
+        The page itself is not updated, call refresh to train the same
+        rows again.
+        """
+        self.store.apply_gradients(
+            self.rows,
+            {'loc': grads[0].numpy(), 'raw_scale': grads[1].numpy()},
+            learning_rate)
@@ -0,0 +1,477 @@
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from autoencirt.irt.callbacks import peak_rss_mb
+from autoencirt.irt.compiled import TracedFunction, tf_function
+
+
+def finite_gradients(loss, grads):
+    ok = tf.math.is_finite(loss)
+    for g in grads:
+        if g is not None:
+            ok = tf.logical_and(ok, tf.reduce_all(tf.math.is_finite(g)))
+    return ok
+
+
+class _VariableSnapshot(object):
+    """In-memory fallback for rolling back when no checkpoint_dir is given
+    """
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.values = None
+
+    def save(self):
+        self.values = [v.numpy() for v in self.variables]
+
+    def restore(self):
+        if self.values is None:
+            return False
+        for v, x in zip(self.variables, self.values):
+            v.assign(x)
+        return True
+
+
+def fit_surrogate_posterior_minibatch(
+        loss_fn, trainable_variables, batched_dataset, num_epochs=100,
+        learning_rate=0.1, optimizer=None, abs_tol=1e-10, rel_tol=1e-8,
+        clip_value=5., max_decay_steps=25, decay_rate=0.99, check_every=25,
+        checkpoint_dir=None, checkpoint_every=1, max_to_keep=3,
+        resume=True, nan_lr_factor=0.5, max_rollbacks=5,
+        checkpoint_objects=None, callbacks=None, variable_groups=None,
+        count_fn=None, jit_compile=False, input_signature=None,
+        microbatches=1, gradient_hook=None, local_variables=None,
+        local_update=None, batch_fn=None, decay_count=0, sample_fn=None,
+        global_loss_fn=None, checkpoint_steps=None):
+    """Minibatch stochastic optimization of a variational loss
+
+    One optimizer step is taken per batch. Every `check_every` epochs the
+    mean epoch loss is compared against the previous window, the learning
+    rate is decayed by `decay_rate` when it has not improved, and the run
+    stops on `abs_tol`/`rel_tol` or after `max_decay_steps` decays.
+
+    Non-finite losses or gradients are never applied. Instead the
+    variables are rolled back to the last finite checkpoint and the learning
+    rate is multiplied by `nan_lr_factor`.
+
+    Args:
+        loss_fn (callable): batch -> scalar loss, or (batch, draws) ->
+            scalar loss with sample_fn
+        trainable_variables (list): variables to optimize
+        batched_dataset (tf.data.Dataset): one epoch of batches
+        num_epochs (int, optional): Defaults to 100.
+        learning_rate (float, optional): Defaults to 0.1.
+        optimizer (tf.optimizers.Optimizer, optional): Defaults to Adam.
+        abs_tol (float, optional): Defaults to 1e-10.
+        rel_tol (float, optional): Defaults to 1e-8.
+        clip_value (float, optional): Elementwise gradient clip.
+            Defaults to 5..
+        max_decay_steps (int, optional): Defaults to 25.
+        decay_rate (float, optional): Defaults to 0.99.
+        check_every (int, optional): Epochs between convergence checks.
+            Defaults to 25.
+        checkpoint_dir (str, optional): Write tf.train checkpoints here and
+            resume from the latest one. A checkpoint written within an
+            epoch records the batches done and their summed loss, and a
+            resumed run skips those batches of the epoch, which is exact
+            for a dataset that yields its batches in the same order every
+            epoch. Defaults to None.
+        checkpoint_every (int, optional): Epochs between checkpoints.
+            Defaults to 1.
+        checkpoint_steps (int, optional): Also checkpoint every this many
+            steps within an epoch, with checkpoint_dir. Defaults to None.
+        max_to_keep (int, optional): Checkpoints retained. Defaults to 3.
+        resume (bool, optional): Restore the latest checkpoint in
+            checkpoint_dir before training. Defaults to True.
+        nan_lr_factor (float, optional): Learning rate multiplier applied
+            on every rollback. Defaults to 0.5.
+        max_rollbacks (int, optional): Give up after this many rollbacks.
+            Defaults to 5.
+        checkpoint_objects (dict, optional): Extra trackables to checkpoint,
+            e.g. the surrogate distribution. Defaults to None.
+        callbacks (list, optional): autoencirt.irt.callbacks.Callback
+            instances. Defaults to None.
+        variable_groups (dict, optional): {name: [variables]} used for the
+            per-group gradient norms given to callbacks. Defaults to None.
+        count_fn (callable, optional): batch -> number of responses, for
+            throughput. Defaults to None.
+        jit_compile (bool, optional): XLA-compile the loss and gradient.
+            Defaults to False.
+        input_signature (dict, optional): TensorSpecs of a batch. With
+            fixed batch shapes the step is traced exactly once.
+            Defaults to None.
+        microbatches (int, optional): Split every batch along its first
+            axis into this many chunks (at most one per record), evaluated
+            one after the other, and sum their losses and gradients.
+            Without sample_fn, loss_fn must then weight its
+            batch-independent terms by 1/microbatches. Defaults to 1.
+        gradient_hook (callable, optional): (loss, grads, finite) ->
+            (loss, grads, finite), applied before the finiteness check,
+            e.g. an all-reduce across data-parallel workers.
+            Defaults to None.
+        local_variables (list, optional): Variables that are
+            differentiated along with trainable_variables but updated by
+            `local_update` instead of the optimizer, and are neither
+            checkpointed nor rolled back. Defaults to None.
+        local_update (callable, optional): (grads, learning_rate) -> None,
+            called with the clipped gradients of local_variables after
+            every applied step. Defaults to None.
+        batch_fn (callable, optional): batch -> batch, applied eagerly to
+            every batch before the step, e.g. to page in local variables.
+            Defaults to None.
+        decay_count (int, optional): Decays already taken, to continue
+            the schedule of an earlier run together with its final
+            learning_rate, see callbacks.TrainingState. A resumed
+            checkpoint takes precedence. Defaults to 0.
+        sample_fn (callable, optional): () -> draws, a (nested) structure
+            of reparameterized surrogate draws taken once per step and
+            shared by all microbatches, which then only evaluate loss_fn
+            on them. Defaults to None.
+        global_loss_fn (callable, optional): draws -> the
+            batch-independent part of the loss (prior and entropy),
+            evaluated once per step. Only used with sample_fn.
+            Defaults to None.
+
+    Returns:
+        np.ndarray: loss per completed epoch, including resumed epochs
+    """
+    trainable_variables = list(trainable_variables)
+    local_variables = [] if local_variables is None else list(
+        local_variables)
+    num_trainable = len(trainable_variables)
+    if optimizer is None:
+        optimizer = tf.optimizers.Adam(learning_rate=learning_rate)
+
+    # training state that has to survive a restart
+    state = {
+        'learning_rate': tf.Variable(
+            learning_rate, dtype=tf.float64, trainable=False),
+        'decay_count': tf.Variable(
+            decay_count, dtype=tf.int64, trainable=False),
+        'epoch': tf.Variable(0, dtype=tf.int64, trainable=False),
+        # progress within the current epoch
+        'batch': tf.Variable(0, dtype=tf.int64, trainable=False),
+        'epoch_loss': tf.Variable(0., dtype=tf.float64, trainable=False),
+        'losses': tf.Variable(
+            tf.zeros([0], dtype=tf.float64), shape=tf.TensorShape([None]),
+            trainable=False),
+    }
+    checkpoint = tf.train.Checkpoint(
+        optimizer=optimizer,
+        variables=trainable_variables,
+        **state,
+        **({} if checkpoint_objects is None else checkpoint_objects)
+    )
+    manager = None
+    snapshot = None
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        manager = tf.train.CheckpointManager(
+            checkpoint, checkpoint_dir, max_to_keep=max_to_keep)
+        if resume and manager.latest_checkpoint is not None:
+            checkpoint.restore(manager.latest_checkpoint)
+            print(f"Resuming from {manager.latest_checkpoint}")
+    else:
+        snapshot = _VariableSnapshot(trainable_variables)
+
+    def set_learning_rate(lr):
+        state['learning_rate'].assign(lr)
+        optimizer.learning_rate = float(lr)
+
+    set_learning_rate(state['learning_rate'].numpy())
+
+    def save():
+        if manager is not None:
+            manager.save()
+        else:
+            snapshot.save()
+
+    def rollback():
+        if manager is not None and manager.latest_checkpoint is not None:
+            lr = state['learning_rate'].numpy()
+            checkpoint.restore(manager.latest_checkpoint)
+            # keep cumulative learning-rate cuts from earlier rollbacks
+            set_learning_rate(
+                min(lr, state['learning_rate'].numpy())*nan_lr_factor)
+            return True
+        if snapshot is not None and snapshot.restore():
+            # snapshots are only taken at the end of an epoch
+            state['batch'].assign(0)
+            state['epoch_loss'].assign(0.)
+            set_learning_rate(state['learning_rate'].numpy()*nan_lr_factor)
+            return True
+        return False
+
+    variables = trainable_variables + local_variables
+
+    def add_gradients(grads, more):
+        return [
+            g if h is None else (
+                tf.convert_to_tensor(h) if g is None
+                else g + tf.convert_to_tensor(h))
+            for g, h in zip(grads, more)]
+
+    def chunk_gradients(batch):
+        with tf.GradientTape() as tape:
+            if sample_fn is None:
+                loss = loss_fn(batch)
+            else:
+                draws = sample_fn()
+                loss = loss_fn(batch, draws)
+                if global_loss_fn is not None:
+                    loss += global_loss_fn(draws)
+        return loss, tape.gradient(loss, variables)
+
+    def microbatch_parts(batch):
+        size = tf.nest.flatten(batch)[0].shape[0]
+        num_chunks = microbatches if size is None else min(
+            microbatches, size)
+        if size is None:
+            size = tf.shape(tf.nest.flatten(batch)[0])[0]
+        # balanced edges, static for a static batch size, so no chunk is
+        # empty when size >= num_chunks
+        edges = [(j*size)//num_chunks for j in range(num_chunks + 1)]
+        return [
+            tf.nest.map_structure(lambda v: v[a:b], batch)
+            for a, b in zip(edges[:-1], edges[1:])]
+
+    def accumulate_gradients(batch):
+        loss = None
+        grads = None
+        for part in microbatch_parts(batch):
+            # sequential, so only one chunk's intermediates are alive
+            with tf.control_dependencies(
+                    [] if grads is None else
+                    [g for g in grads if g is not None]):
+                chunk_loss, chunk_grads = chunk_gradients(part)
+            if grads is None:
+                loss, grads = chunk_loss, chunk_grads
+                continue
+            loss += chunk_loss
+            grads = add_gradients(grads, chunk_grads)
+        return loss, grads
+
+    def shared_draw_gradients(batch):
+        # one draw per step; each chunk backpropagates to the draws, and
+        # the summed draw gradients go through the sampling once
+        with tf.GradientTape() as sample_tape:
+            draws = sample_fn()
+        flat = tf.nest.flatten(draws)
+        with tf.GradientTape() as tape:
+            tape.watch(flat)
+            loss = tf.zeros([], dtype=flat[0].dtype) if (
+                global_loss_fn is None) else global_loss_fn(draws)
+        grads = add_gradients(
+            [None]*(len(flat) + len(variables)),
+            tape.gradient(loss, flat + variables))
+        for part in microbatch_parts(batch):
+            with tf.control_dependencies(
+                    [g for g in grads if g is not None]):
+                with tf.GradientTape() as tape:
+                    tape.watch(flat)
+                    chunk_loss = loss_fn(part, draws)
+                chunk_grads = tape.gradient(chunk_loss, flat + variables)
+            loss += chunk_loss
+            grads = add_gradients(grads, chunk_grads)
+        through = sample_tape.gradient(
+            flat, variables, output_gradients=[
+                tf.zeros_like(x) if g is None else g
+                for x, g in zip(flat, grads[:len(flat)])])
+        return loss, add_gradients(grads[len(flat):], through)
+
+    callbacks = [] if callbacks is None else list(callbacks)
+    want_gradients = any(cb.wants_gradients for cb in callbacks)
+    groups = {}
+    if want_gradients:
+        index = {v.ref(): j for j, v in enumerate(trainable_variables)}
+        groups = {
+            name: [index[v.ref()] for v in variables if v.ref() in index]
+            for name, variables in (
+                {'all': trainable_variables} if variable_groups is None
+                else variable_groups).items()
+        }
+
+    def group_norms(grads):
+        norms = {}
+        for name, ix in groups.items():
+            present = [grads[j] for j in ix if grads[j] is not None]
+            if len(present) > 0:
+                norms[name] = tf.linalg.global_norm(present)
+        return norms
+
+    def gradient_step(batch):
+        if microbatches > 1 and sample_fn is not None:
+            loss, grads = shared_draw_gradients(batch)
+        elif microbatches > 1:
+            loss, grads = accumulate_gradients(batch)
+        else:
+            loss, grads = chunk_gradients(batch)
+        # before clipping, so that spikes show
+        norms = group_norms(grads)
+        if clip_value is not None:
+            grads = [
+                None if g is None else tf.clip_by_value(
+                    g, -clip_value, clip_value)
+                for g in grads]
+        return loss, grads, finite_gradients(loss, grads), norms
+
+    compute_step = TracedFunction(
+        gradient_step, jit_compile=jit_compile,
+        input_signature=(
+            None if input_signature is None else [input_signature]))
+
+    def apply_gradients(grads):
+        pairs = [
+            (g, v) for g, v in zip(grads[:num_trainable], trainable_variables)
+            if g is not None]
+        if len(pairs) > 0:
+            optimizer.apply_gradients(pairs)
+
+    apply_step = tf_function(apply_gradients)
+
+    # a finite starting point to roll back to
+    if state['epoch'].numpy() == 0 and state['batch'].numpy() == 0:
+        save()
+
+    def tracing_count():
+        return compute_step.traces
+
+    for cb in callbacks:
+        cb.on_train_begin({
+            'epoch': int(state['epoch'].numpy()),
+            'num_variables': len(trainable_variables)})
+
+    losses = list(state['losses'].numpy())
+    rollbacks = 0
+    converged = False
+    step = 0
+    while (state['epoch'].numpy() < num_epochs) and not converged:
+        epoch_start = time.perf_counter()
+        # batches already done before an interruption or rollback
+        skip = int(state['batch'].numpy())
+        epoch_loss = float(state['epoch_loss'].numpy())
+        failed = False
+        iterator = iter(batched_dataset.skip(skip))
+        while True:
+            for cb in callbacks:
+                cb.on_step_begin(step)
+            t0 = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            if batch_fn is not None:
+                batch = batch_fn(batch)
+            t1 = time.perf_counter()
+            loss, grads, finite, norms = compute_step(batch)
+            if gradient_hook is not None:
+                loss, grads, finite = gradient_hook(loss, grads, finite)
+            if not bool(finite):
+                failed = True
+                break
+            t2 = time.perf_counter()
+            apply_step(grads)
+            if local_update is not None:
+                local_update(
+                    grads[num_trainable:],
+                    float(state['learning_rate'].numpy()))
+            epoch_loss += loss.numpy()
+            state['batch'].assign_add(1)
+            state['epoch_loss'].assign(epoch_loss)
+            if manager is not None and checkpoint_steps is not None and (
+                    state['batch'].numpy() % checkpoint_steps == 0):
+                save()
+            t3 = time.perf_counter()
+            if len(callbacks) > 0:
+                logs = {
+                    'epoch': int(state['epoch'].numpy()),
+                    'step': step,
+                    'loss': float(loss.numpy()),
+                    'step_time': t3 - t0,
+                    'input_time': t1 - t0,
+                    'compute_time': t2 - t1,
+                    'apply_time': t3 - t2,
+                    'num_responses': (
+                        None if count_fn is None else int(count_fn(batch))),
+                    'learning_rate': float(state['learning_rate'].numpy())
+                }
+                if want_gradients:
+                    clipped = group_norms(grads)
+                    logs['grad_norms'] = {
+                        name: float(norms[name].numpy()) if (
+                            name in norms) else 0.
+                        for name in groups}
+                    logs['clipped_grad_norms'] = {
+                        name: float(clipped[name].numpy()) if (
+                            name in clipped) else 0.
+                        for name in groups}
+                for cb in callbacks:
+                    cb.on_step_end(step, logs)
+            step += 1
+
+        if failed:
+            rollbacks += 1
+            if rollbacks > max_rollbacks or not rollback():
+                print(
+                    f"Non-finite loss in epoch {state['epoch'].numpy()}, "
+                    "stopping")
+                break
+            print(
+                "Non-finite loss, rolled back to epoch "
+                f"{state['epoch'].numpy()}, learning rate now "
+                f"{state['learning_rate'].numpy():.3g}")
+            losses = list(state['losses'].numpy())
+            continue
+
+        losses += [epoch_loss]
+        state['losses'].assign(np.array(losses, dtype=np.float64))
+        state['epoch'].assign_add(1)
+        state['batch'].assign(0)
+        state['epoch_loss'].assign(0.)
+        epoch = int(state['epoch'].numpy())
+
+        if epoch % check_every == 0 and len(losses) >= 2*check_every:
+            recent = np.nanmean(losses[-check_every:])
+            previous = np.nanmean(losses[-2*check_every:-check_every])
+            delta = previous - recent
+            if np.abs(delta) < abs_tol:
+                print(f"Converged in {epoch} epochs (absolute tolerance)")
+                converged = True
+            elif np.abs(delta) < rel_tol*np.abs(previous):
+                print(f"Converged in {epoch} epochs (relative tolerance)")
+                converged = True
+            elif delta < 0:
+                state['decay_count'].assign_add(1)
+                set_learning_rate(
+                    state['learning_rate'].numpy()*decay_rate)
+                if state['decay_count'].numpy() > max_decay_steps:
+                    print(f"Stopping after {max_decay_steps} decay steps")
+                    converged = True
+        if epoch % checkpoint_every == 0 or converged:
+            save()
+
+        for cb in callbacks:
+            cb.on_epoch_end(epoch, {
+                'epoch': epoch,
+                'loss': float(epoch_loss),
+                'epoch_time': time.perf_counter() - epoch_start,
+                'learning_rate': float(state['learning_rate'].numpy()),
+                'tracing_count': tracing_count(),
+                'peak_rss_mb': peak_rss_mb()
+            })
+        if any(cb.stop_training for cb in callbacks):
+            break
+
+    for cb in callbacks:
+        cb.on_train_end({
+            'epochs': int(state['epoch'].numpy()),
+            'tracing_count': tracing_count(),
+            'trace_cache': compute_step.stats(),
+            'peak_rss_mb': peak_rss_mb(),
+            'learning_rate': float(state['learning_rate'].numpy()),
+            'decay_count': int(state['decay_count'].numpy())
+        })
+    return np.array(losses)
@@ -0,0 +1,111 @@
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+# asymptotically optimal MALA acceptance rate
+TARGET_ACCEPTANCE = 0.574
+
+
+def unit_sum(x, axis):
+    """Sum over every axis except the unit axis, [U]
+
+    With axis None the whole tensor is one unit, [1].
+    """
+    if axis is None:
+        return tf.reshape(tf.reduce_sum(x), [1])
+    rank = len(x.shape)
+    axis = axis % rank
+    return tf.reduce_sum(x, axis=[a for a in range(rank) if a != axis])
+
+
+def _broadcast_units(mask, x, axis):
+    rank = len(x.shape)
+    if axis is None:
+        return tf.reshape(mask, [1]*rank)
+    shape = [1]*rank
+    shape[axis % rank] = -1
+    return tf.reshape(mask, shape)
+
+
+def mala_step(log_prob_fn, state, axes, step_size, seed=None):
+    """One Metropolis-adjusted Langevin step with a separate accept/reject
+    decision for every unit
+
+    The target must factor over units: unit u of log_prob_fn(state) may
+    only depend on slice u, along axes[j], of every state[j]. Then a
+    single gradient evaluation serves all units, and each unit is a valid
+    MALA chain of its own, e.g. every person or every item.
+
+    Args:
+        log_prob_fn (callable): list of tensors -> [U] log densities
+        state (list): unconstrained tensors
+        axes (list): unit axis of each state tensor, None for one unit
+        step_size (float): Langevin step h
+        seed (optional): stateless seed of the proposal and the
+            acceptance draws. Defaults to None, the global random state.
+
+    Returns:
+        (list, tf.Tensor): next state, [U] boolean acceptances
+    """
+    def value_and_gradients(x):
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            log_prob = log_prob_fn(x)
+        return log_prob, tape.gradient(log_prob, x)
+
+    def normal(shape, dtype, seed):
+        if seed is None:
+            return tf.random.normal(shape, dtype=dtype)
+        return tf.random.stateless_normal(shape, seed=seed, dtype=dtype)
+
+    seeds = [None]*(len(state) + 1)
+    if seed is not None:
+        seeds = tfp.random.split_seed(seed, n=len(state) + 1)
+    h = tf.cast(step_size, state[0].dtype)
+    log_prob, grads = value_and_gradients(state)
+    proposal = [
+        x + 0.5*h**2*g + h*normal(tf.shape(x), x.dtype, s)
+        for x, g, s in zip(state, grads, seeds)]
+    proposal_log_prob, proposal_grads = value_and_gradients(proposal)
+
+    def log_transition(to, start, g, axis):
+        return unit_sum(-(to - start - 0.5*h**2*g)**2/(2.*h**2), axis)
+
+    log_ratio = proposal_log_prob - log_prob
+    for x, y, g, g_y, axis in zip(
+            state, proposal, grads, proposal_grads, axes):
+        log_ratio += log_transition(x, y, g_y, axis) - log_transition(
+            y, x, g, axis)
+    log_ratio = tf.where(
+        tf.math.is_finite(log_ratio), log_ratio,
+        tf.constant(-np.inf, dtype=log_ratio.dtype))
+    if seeds[-1] is None:
+        u = tf.random.uniform(tf.shape(log_ratio), dtype=log_ratio.dtype)
+    else:
+        u = tf.random.stateless_uniform(
+            tf.shape(log_ratio), seed=seeds[-1], dtype=log_ratio.dtype)
+    log_u = tf.math.log(u)
+    accept = log_u < log_ratio
+    next_state = [
+        tf.where(_broadcast_units(accept, x, axis), y, x)
+        for x, y, axis in zip(state, proposal, axes)]
+    return next_state, accept
+
+
+class StepSizeAdapter(object):
+    """Robbins-Monro adaptation of log h toward a target acceptance rate
+    """
+
+    def __init__(self, step_size, target=TARGET_ACCEPTANCE, rate=0.6):
+        self.log_step_size = np.log(step_size)
+        self.target = target
+        self.rate = rate
+        self.t = 0
+
+    @property
+    def step_size(self):
+        return float(np.exp(self.log_step_size))
+
+    def update(self, acceptance):
+        self.t += 1
+        self.log_step_size += (acceptance - self.target)/self.t**self.rate
@@ -0,0 +1,264 @@
+import json
+import resource
+
+import numpy as np
+import tensorflow as tf
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+class Callback(object):
+    """Hooks called by fit_surrogate_posterior_minibatch
+
+    Step logs hold epoch, step, loss, step_time, input_time,
+    compute_time, apply_time, num_responses and learning_rate, plus
+    grad_norms ({group: global norm} of the raw gradients) and
+    clipped_grad_norms (the same after clip_value) when
+    `wants_gradients` is set. Epoch logs hold epoch, loss, epoch_time,
+    learning_rate, tracing_count and peak_rss_mb. The train end log adds
+    trace_cache, the calls, traces and cache hits of the compiled step,
+    and the final learning_rate and decay_count.
+    """
+    wants_gradients = False
+    stop_training = False
+
+    def on_train_begin(self, logs=None):
+        pass
+
+    def on_step_begin(self, step, logs=None):
+        pass
+
+    def on_step_end(self, step, logs=None):
+        pass
+
+    def on_epoch_end(self, epoch, logs=None):
+        pass
+
+    def on_train_end(self, logs=None):
+        pass
+
+
+class CoordinateUpdateCallback(Callback):
+    """Run a closed-form update before training and every `every` steps
+    """
+
+    def __init__(self, update_fn, every=1):
+        self.update_fn = update_fn
+        self.every = every
+
+    def on_train_begin(self, logs=None):
+        self.update_fn()
+
+    def on_step_end(self, step, logs=None):
+        if (step + 1) % self.every == 0:
+            self.update_fn()
+
+
+class TrainingState(Callback):
+    """Learning rate and decay count at the end of a run, to continue its
+    schedule in the next one
+
+    Pass `learning_rate` and `decay_count` on to the next
+    fit_surrogate_posterior_minibatch (or calibrate_advi) call.
+    """
+
+    def __init__(self, learning_rate=None, decay_count=0):
+        self.learning_rate = learning_rate
+        self.decay_count = decay_count
+
+    def on_train_end(self, logs=None):
+        self.learning_rate = logs['learning_rate']
+        self.decay_count = logs['decay_count']
+
+
+class ConvergenceMonitor(Callback):
+    """Stop training once the smoothed loss and the watched parameter
+    groups have settled
+
+    The noisy epoch loss is smoothed by the median of the last `window`
+    epochs. It counts as settled when that median moved by less than
+    `loss_tol` relative to the window before, or when the least-squares
+    slope over the window is not significantly negative (t statistic
+    above -trend_z). Every group in `watch` must also have changed by
+    less than `param_tol`, relative to its norm, since the last epoch.
+    Both have to hold for `patience` epochs in a row.
+
+    Args:
+        variable_groups (dict or callable): {group: [variables]}, e.g.
+            from BayesianModel._variable_groups(), or a function returning
+            it, resolved again at the start of every training run so that
+            rebuilt surrogates (e.g. after pruning) are watched
+        watch (list, optional): Groups that must settle. Defaults to
+            ['items'] if there is such a group, else all of them.
+        window (int, optional): Defaults to 10.
+        loss_tol (float, optional): Defaults to 1e-4.
+        trend_z (float, optional): None only uses loss_tol. Defaults to 2.
+        param_tol (float, optional): Defaults to 1e-3.
+        patience (int, optional): Defaults to 3.
+        min_epochs (int, optional): Defaults to 2*window.
+    """
+
+    def __init__(
+            self, variable_groups, watch=None, window=10, loss_tol=1e-4,
+            trend_z=2., param_tol=1e-3, patience=3, min_epochs=None):
+        self.variable_groups = variable_groups
+        groups = self._groups()
+        if watch is None:
+            watch = ['items'] if 'items' in groups else list(groups)
+        self.watch = list(watch)
+        missing = [g for g in self.watch if g not in groups]
+        if len(missing) > 0:
+            raise ValueError(f"Unknown variable groups {missing}")
+        self.window = window
+        self.loss_tol = loss_tol
+        self.trend_z = trend_z
+        self.param_tol = param_tol
+        self.patience = patience
+        self.min_epochs = 2*window if min_epochs is None else min_epochs
+        self.history = []
+
+    def _groups(self):
+        if callable(self.variable_groups):
+            return self.variable_groups()
+        return self.variable_groups
+
+    def _values(self):
+        return {
+            g: [v.numpy() for v in variables]
+            for g, variables in self.groups.items()}
+
+    def on_train_begin(self, logs=None):
+        self.stop_training = False
+        self.groups = self._groups()
+        self.losses = []
+        self.settled = 0
+        self.previous = self._values()
+
+    def loss_settled(self):
+        w = self.window
+        if len(self.losses) < 2*w:
+            return False, np.nan
+        recent = np.median(self.losses[-w:])
+        before = np.median(self.losses[-2*w:-w])
+        change = np.abs(before - recent)/max(np.abs(before), 1e-12)
+        if change < self.loss_tol:
+            return True, change
+        if self.trend_z is not None:
+            y = np.asarray(self.losses[-w:])
+            x = np.arange(w) - (w - 1)/2.
+            slope = np.sum(x*y)/np.sum(x**2)
+            residuals = y - np.mean(y) - slope*x
+            se = np.sqrt(
+                np.sum(residuals**2)/max(w - 2, 1)/np.sum(x**2))
+            if se > 0 and slope/se > -self.trend_z:
+                return True, change
+        return False, change
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.losses += [logs['loss']]
+        values = self._values()
+        param_change = {}
+        for g, current in values.items():
+            delta = np.sqrt(sum(
+                np.sum((a - b)**2) for a, b in zip(current, self.previous[g])))
+            norm = np.sqrt(sum(np.sum(b**2) for b in self.previous[g]))
+            param_change[g] = float(delta/max(norm, 1e-12))
+        self.previous = values
+        loss_ok, loss_change = self.loss_settled()
+        params_ok = all(param_change[g] < self.param_tol for g in self.watch)
+        self.settled = self.settled + 1 if (loss_ok and params_ok) else 0
+        self.history += [{
+            'epoch': epoch,
+            'smoothed_loss': float(np.median(self.losses[-self.window:])),
+            'loss_change': float(loss_change),
+            'param_change': param_change
+        }]
+        if len(self.losses) >= self.min_epochs and (
+                self.settled >= self.patience):
+            print(
+                f"{', '.join(self.watch)} settled after {epoch} epochs, "
+                "stopping")
+            self.stop_training = True
+
+
+class InMemorySink(object):
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records += [record]
+
+    def close(self):
+        pass
+
+
+class JSONLinesSink(object):
+    def __init__(self, path, mode="a"):
+        self.path = path
+        self.file = open(path, mode)
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class TelemetryCallback(Callback):
+    """Write per-step and per-epoch training telemetry to a sink
+
+    Args:
+        sink (InMemorySink or JSONLinesSink, optional): Defaults to a new
+            InMemorySink.
+        every (int, optional): Record every this many steps. Defaults to 1.
+        log_gradients (bool, optional): Gradient norms per variable group.
+            Defaults to True.
+        profile_dir (str, optional): Capture a TF profiler trace here.
+            Defaults to None.
+        profile_steps (tuple, optional): (first, last) global steps of the
+            trace. Defaults to (10, 20).
+    """
+
+    def __init__(
+            self, sink=None, every=1, log_gradients=True, profile_dir=None,
+            profile_steps=(10, 20)):
+        self.sink = InMemorySink() if sink is None else sink
+        self.every = every
+        self.wants_gradients = log_gradients
+        self.profile_dir = profile_dir
+        self.profile_steps = profile_steps
+        self._profiling = False
+
+    def on_train_begin(self, logs=None):
+        self.sink.write({"event": "train_begin", **(logs or {})})
+
+    def on_step_begin(self, step, logs=None):
+        if self.profile_dir is not None and (
+                step == self.profile_steps[0]) and not self._profiling:
+            tf.profiler.experimental.start(self.profile_dir)
+            self._profiling = True
+
+    def on_step_end(self, step, logs=None):
+        if self._profiling and step >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+        if step % self.every != 0:
+            return
+        logs = dict(logs or {})
+        if logs.get("num_responses") is not None and logs["step_time"] > 0:
+            logs["responses_per_s"] = logs["num_responses"]/logs["step_time"]
+        self.sink.write({"event": "step", **logs})
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.sink.write({"event": "epoch", **(logs or {})})
+
+    def on_train_end(self, logs=None):
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+        self.sink.write({"event": "train_end", **(logs or {})})
@@ -0,0 +1,89 @@
+import tensorflow as tf
+
+
+def tf_function(fn, input_signature=None, jit_compile=False, autograph=False):
+    """tf.function with XLA across TF versions
+
+    TF < 2.5 spells jit_compile as experimental_compile.
+    """
+    try:
+        return tf.function(
+            fn, input_signature=input_signature, jit_compile=jit_compile,
+            autograph=autograph)
+    except TypeError:
+        return tf.function(
+            fn, input_signature=input_signature,
+            experimental_compile=jit_compile, autograph=autograph)
+
+
+class TracedFunction(object):
+    """Callable wrapper around a tf.function that keeps trace-cache stats
+
+    Every call that does not add a concrete function to the cache is a
+    hit. With a full input signature there should be exactly one trace.
+    """
+
+    def __init__(self, fn, input_signature=None, jit_compile=False,
+                 autograph=False):
+        self.function = tf_function(
+            fn, input_signature=input_signature, jit_compile=jit_compile,
+            autograph=autograph)
+        self.jit_compile = jit_compile
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.function(*args, **kwargs)
+
+    @property
+    def traces(self):
+        if hasattr(self.function, 'experimental_get_tracing_count'):
+            return int(self.function.experimental_get_tracing_count())
+        return None
+
+    def stats(self):
+        traces = self.traces
+        return {
+            'calls': self.calls,
+            'traces': traces,
+            'hits': None if traces is None else self.calls - traces,
+            'jit_compile': self.jit_compile
+        }
+
+
+def batch_signature(element_spec, batch_size):
+    """Fixed-size TensorSpecs for a per-record (unbatched) element_spec
+    """
+    return tf.nest.map_structure(
+        lambda s: tf.TensorSpec(
+            [batch_size] + s.shape.as_list(), s.dtype, name=s.name),
+        element_spec)
+
+
+def sample_signature(distribution, sample_size):
+    """TensorSpecs for `sample_size` draws from a JointDistributionNamed
+    """
+    event_shape = distribution.event_shape
+    dtype = distribution.dtype
+    return {
+        k: tf.TensorSpec(
+            [sample_size] + event_shape[k].as_list(), dtype[k], name=k)
+        for k in event_shape.keys()
+    }
+
+
+def pad_batch(batch, batch_size, person_key, fill=-1):
+    """Pad a possibly short batch to `batch_size` rows
+
+    Padded rows get `fill` responses, which the likelihood treats as
+    missing, and person 0, so they contribute nothing. The result has a
+    static leading dimension.
+    """
+    padded = {}
+    for k, v in batch.items():
+        short = batch_size - tf.shape(v)[0]
+        paddings = [[0, short]] + [[0, 0]]*(len(v.shape) - 1)
+        value = 0 if k == person_key else fill
+        v = tf.pad(v, paddings, constant_values=tf.cast(value, v.dtype))
+        padded[k] = tf.ensure_shape(v, [batch_size] + v.shape.as_list()[1:])
+    return padded
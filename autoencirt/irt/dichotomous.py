@@ -0,0 +1,70 @@
+import tensorflow as tf
+
+from autoencirt.irt.grm import GRModel
+
+
+class DichotomousModel(GRModel):
+    """Two-parameter logistic model for yes/no items
+
+    Shares the horseshoe prior, surrogate, calibration and persistence of
+    GRModel, but drops ddifficulties and evaluates the Bernoulli
+    likelihood directly instead of padded cumulative category
+    probabilities. In one dimension P(x = 1) = sigmoid(a(theta - b)).
+    With several dimensions, as in GRModel, the per-dimension curves are
+    mixed with weights |a_d|^weight_exponent/sum_d |a_d|^weight_exponent,
+    in log space.
+    """
+    response_type = "dichotomous"
+    item_vars = ['discriminations', 'difficulties0']
+    omitted_vars = ['ddifficulties']
+    dimension_vars = [
+        'abilities', 'discriminations', 'difficulties0', 'mu', 'xi',
+        'xi_a']
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('response_cardinality', 2) != 2:
+            raise ValueError("Dichotomous items have two categories")
+        kwargs['response_cardinality'] = 2
+        super(DichotomousModel, self).__init__(*args, **kwargs)
+
+    def log_probs(self, abilities, discriminations, difficulties0):
+        """(log P(x = 0), log P(x = 1)), each ... x I
+        """
+        z = discriminations*(abilities - difficulties0)
+        if z.shape[-3] == 1:
+            return (
+                tf.math.log_sigmoid(-z)[..., 0, :, 0],
+                tf.math.log_sigmoid(z)[..., 0, :, 0])
+        log_weights = self.weight_exponent*tf.math.log(
+            tf.math.abs(discriminations))
+        log_weights -= tf.reduce_logsumexp(
+            log_weights, axis=-3, keepdims=True)
+        return (
+            tf.reduce_logsumexp(
+                log_weights + tf.math.log_sigmoid(-z), axis=-3)[..., 0],
+            tf.reduce_logsumexp(
+                log_weights + tf.math.log_sigmoid(z), axis=-3)[..., 0])
+
+    def grm_model_prob_d(self, abilities, discriminations, difficulties0,
+                         ddifficulties=None):
+        """Category probabilities ... x I x 2, for score and simulation
+        """
+        log_p0, log_p1 = self.log_probs(
+            abilities, discriminations, difficulties0)
+        return tf.math.exp(tf.stack([log_p0, log_p1], axis=-1))
+
+    def log_likelihood(
+            self, responses, discriminations, difficulties0, abilities,
+            *args, reduce_batch=True, chunk=True, per_item=False, **kwargs):
+        return self._response_log_likelihood(
+            responses, abilities, {
+                'discriminations': discriminations,
+                'difficulties0': difficulties0},
+            reduce_batch=reduce_batch, chunk=chunk, per_item=per_item)
+
+    def response_log_prob(self, abilities, choices, discriminations,
+                          difficulties0):
+        log_p0, log_p1 = self.log_probs(
+            abilities, discriminations, difficulties0)
+        choices = tf.cast(choices, log_p1.dtype)
+        return choices*log_p1 + (1. - choices)*log_p0
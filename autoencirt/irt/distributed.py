@@ -0,0 +1,299 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from autoencirt.irt.persistence import (
+    _resolve_class, assign_surrogate_arrays, load_arrays, read_header)
+
+
+def _shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError(
+            "calibrate_advi_distributed needs Python 3.8 or later for "
+            "multiprocessing.shared_memory")
+    return shared_memory
+
+
+class SharedAllReduce(object):
+    """Sum vectors across local processes through shared memory
+
+    Every worker writes its row, waits for the others, sums all rows and
+    waits again before the buffer can be reused.
+
+    Args:
+        num_workers (int): number of participating processes
+        size (int): length of the reduced vectors
+    """
+
+    def __init__(self, num_workers, size, context=None):
+        context = multiprocessing if context is None else context
+        self.num_workers = num_workers
+        self.size = size
+        self.shm = _shared_memory().SharedMemory(
+            create=True, size=max(num_workers*size*8, 8))
+        self.name = self.shm.name
+        self.barrier = context.Barrier(num_workers)
+        self._owner = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['shm']
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self.shm = _shared_memory().SharedMemory(name=self.name)
+
+    @property
+    def buffer(self):
+        return np.ndarray(
+            (self.num_workers, self.size), dtype=np.float64,
+            buffer=self.shm.buf)
+
+    def reduce(self, worker, vector):
+        buffer = self.buffer
+        buffer[worker] = vector
+        self.barrier.wait()
+        total = np.sum(buffer, axis=0)
+        self.barrier.wait()
+        return total
+
+    def close(self):
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+def _shard_dataset(data, num_workers, worker, batch_size, num_batches,
+                   person_key, position):
+    """Exactly `num_batches` padded batches of one worker's records, with
+    persons re-indexed by `position` to the worker's rows
+    """
+    import tensorflow as tf
+
+    from autoencirt.irt.compiled import pad_batch
+
+    position = tf.constant(position)
+
+    def reindex(x):
+        return {
+            **x, person_key: tf.cast(
+                tf.gather(position, x[person_key]), x[person_key].dtype)}
+
+    def pad(x):
+        return pad_batch(x, batch_size, person_key)
+
+    def blank(x):
+        return pad(tf.nest.map_structure(lambda v: v[:0], x))
+
+    shard = data.shard(num_workers, worker).map(reindex).batch(
+        batch_size).map(pad)
+    # shards can differ by one batch, fill with empty batches
+    filler = shard.take(1).map(blank).repeat()
+    return shard.concatenate(filler).take(num_batches)
+
+
+def _gradient_hook(reducer, worker, global_index, dtypes):
+    """All-reduce of the loss, the finite flag and the global gradients.
+    Gradients of local variables stay on their worker.
+    """
+    import tensorflow as tf
+
+    def hook(loss, grads, finite):
+        parts = [np.array([float(loss.numpy()), float(bool(finite))])]
+        for j in global_index:
+            g = grads[j]
+            parts += [
+                np.zeros(reducer.shapes[j]).ravel() if g is None
+                else g.numpy().ravel()]
+        total = reducer.reduce(worker, np.concatenate(parts))
+        reduced = list(grads)
+        offset = 2
+        for j in global_index:
+            n = int(np.prod(reducer.shapes[j]))
+            reduced[j] = tf.constant(
+                np.reshape(total[offset:(offset + n)], reducer.shapes[j]),
+                dtype=dtypes[j])
+            offset += n
+        all_finite = total[1] == reducer.num_workers
+        return (
+            tf.constant(total[0], dtype=loss.dtype), reduced,
+            tf.constant(all_finite))
+
+    return hook
+
+
+def _global_variables(model):
+    """Indices, shapes and dtypes of the trainable variables of
+    non-local vars
+    """
+    variables = list(model.surrogate_distribution.trainable_variables)
+    local = set()
+    for k in model.local_vars:
+        for v in model.surrogate_distribution.model[k].trainable_variables:
+            local.add(v.ref())
+    index = [j for j, v in enumerate(variables) if v.ref() not in local]
+    shapes = {j: variables[j].shape.as_list() for j in index}
+    dtypes = {j: variables[j].dtype for j in index}
+    return index, shapes, dtypes
+
+
+def _load_rows(path, rows):
+    """A saved model whose local_vars only hold the given rows, in order,
+    so that its people are re-indexed 0..len(rows)-1
+    """
+    header = read_header(path)
+    model_class = _resolve_class(header["class"])
+    model = model_class.__new__(model_class)
+    model._init_from_config({**header["config"], 'num_people': len(rows)})
+    arrays = {
+        name: (
+            value[rows] if name.split("/")[1] in model.local_vars
+            else value)
+        for name, value in load_arrays(
+            path, header, prefix="surrogate/").items()}
+    assign_surrogate_arrays(model, arrays)
+    return model
+
+
+def _run_worker(worker, num_workers, reducer, model_dir, data_fn,
+                data_batches, threads, output_dir, advi_kwargs):
+    import tensorflow as tf
+    if threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    data = data_fn()
+    config = read_header(model_dir)["config"]
+    N = int(config["num_people"])
+    batch_size = int(np.ceil(np.ceil(N/num_workers)/data_batches))
+
+    # the worker's model only holds the rows of the people it owns
+    person_key = config["person_key"]
+    owned = np.concatenate([
+        b[person_key].numpy() for b in data.shard(
+            num_workers, worker).batch(65536)]).astype(np.int64)
+    position = np.zeros(N, dtype=np.int64)
+    position[owned] = np.arange(len(owned))
+    model = _load_rows(model_dir, owned)
+
+    global_index, shapes, dtypes = _global_variables(model)
+    reducer.shapes = shapes
+    shard = {
+        'num_workers': num_workers,
+        'gradient_hook': _gradient_hook(
+            reducer, worker, global_index, dtypes)
+    }
+    advi_kwargs = dict(advi_kwargs)
+    if advi_kwargs.get('checkpoint_dir') is not None:
+        advi_kwargs['checkpoint_dir'] = os.path.join(
+            advi_kwargs['checkpoint_dir'], f"worker{worker}")
+    losses = model.calibrate_advi(
+        data=_shard_dataset(
+            data, num_workers, worker, batch_size, data_batches,
+            person_key, position),
+        data_batches=data_batches, set_expectations=False, shard=shard,
+        **advi_kwargs)
+
+    path = os.path.join(output_dir, f"worker{worker}")
+    model.save(path)
+    np.save(os.path.join(path, "owned.npy"), owned)
+    np.save(os.path.join(path, "losses.npy"), np.asarray(losses))
+    reducer.close()
+
+
+def calibrate_advi_distributed(
+        model, data_fn, num_workers=2, data_batches=25, threads=None,
+        workdir=None, set_expectations=True, **advi_kwargs):
+    """Data-parallel calibrate_advi over local worker processes
+
+    Each worker loads a copy of the model and trains on its shard of the
+    data. Gradients of the global (item and horseshoe) surrogate
+    variables are summed across workers by a shared-memory all-reduce
+    after every step, so the replicas stay identical. Every worker only
+    holds the rows of local_vars (abilities) of the people in its shard,
+    re-indexed within the shard, so their memory and compute shrink with
+    num_workers. Afterwards the global variables are taken from worker 0
+    and each row of the local variables from its owner. Needs Python 3.8
+    for multiprocessing.shared_memory.
+
+    Args:
+        model (BayesianModel): model to calibrate, updated in place
+        data_fn (callable): picklable, returns the full tf.data.Dataset of
+            per-person records in every worker, e.g. a functools.partial
+        num_workers (int, optional): Defaults to 2.
+        data_batches (int, optional): Batches per worker per epoch.
+            Defaults to 25.
+        threads (int, optional): intra-op threads per worker. Defaults to
+            cpu_count // num_workers.
+        workdir (str, optional): Where to exchange models. Defaults to a
+            temporary directory that is removed afterwards.
+        set_expectations (bool, optional): Defaults to True.
+        **advi_kwargs: passed on to calibrate_advi
+
+    Returns:
+        np.ndarray: epoch losses, summed over workers
+    """
+    model._check_dense("calibrate_advi_distributed")
+    if threads is None:
+        threads = max((os.cpu_count() or 1)//num_workers, 1)
+    cleanup = workdir is None
+    workdir = tempfile.mkdtemp(prefix="autoencirt_dp_") if cleanup else (
+        workdir)
+    context = multiprocessing.get_context("spawn")
+    model_dir = os.path.join(workdir, "initial")
+    model.save(model_dir)
+
+    global_index, shapes, _ = _global_variables(model)
+    size = 2 + int(sum(np.prod(shapes[j]) for j in global_index))
+    reducer = SharedAllReduce(num_workers, size, context)
+    try:
+        processes = [
+            context.Process(
+                target=_run_worker,
+                args=(
+                    w, num_workers, reducer, model_dir, data_fn,
+                    data_batches, threads, workdir, advi_kwargs))
+            for w in range(num_workers)]
+        for p in processes:
+            p.start()
+        while any(p.is_alive() for p in processes):
+            for p in processes:
+                p.join(timeout=1.)
+            if any(p.exitcode not in (None, 0) for p in processes):
+                # release the others from the barrier
+                reducer.barrier.abort()
+        failed = [w for w, p in enumerate(processes) if p.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError(f"Workers {failed} failed")
+
+        arrays = {
+            k: np.array(v) for k, v in load_arrays(
+                model_dir, prefix="surrogate/").items()}
+        for w in range(num_workers):
+            path = os.path.join(workdir, f"worker{w}")
+            owned = np.load(os.path.join(path, "owned.npy"))
+            worker_arrays = load_arrays(path, prefix="surrogate/")
+            for name, value in worker_arrays.items():
+                if name.split("/")[1] in model.local_vars:
+                    arrays[name][owned] = value
+                elif w == 0:
+                    arrays[name] = np.array(value)
+        assign_surrogate_arrays(model, arrays)
+        losses = np.load(os.path.join(workdir, "worker0", "losses.npy"))
+    finally:
+        reducer.close()
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if len(model.conjugate_vars) > 0:
+        model.conjugate_update()
+    if set_expectations and len(losses) > 0 and np.isfinite(losses[-1]):
+        model.set_calibration_expectations()
+    return losses
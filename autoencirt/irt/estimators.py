@@ -0,0 +1,182 @@
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from autoencirt.irt.moments import unwrap
+
+tfd = tfp.distributions
+
+ESTIMATORS = ('standard', 'stl', 'analytic')
+
+
+def stop_gradient_distribution(distribution):
+    """Copy of a factorized surrogate whose parameters do not carry
+    gradients
+
+    Used for sticking-the-landing: samples stay reparameterized, but the
+    score term of log q drops out of the gradient.
+    """
+    if isinstance(distribution, tfd.Independent):
+        return tfd.Independent(
+            stop_gradient_distribution(distribution.distribution),
+            reinterpreted_batch_ndims=(
+                distribution.reinterpreted_batch_ndims))
+    if isinstance(distribution, tfd.TransformedDistribution):
+        return tfd.TransformedDistribution(
+            stop_gradient_distribution(distribution.distribution),
+            bijector=distribution.bijector)
+    parameters = {
+        k: tf.stop_gradient(tf.convert_to_tensor(v))
+        if isinstance(
+            v, (tf.Tensor, tf.Variable, tfp.util.DeferredTensor)) else v
+        for k, v in distribution.parameters.items()
+    }
+    return type(distribution)(**parameters)
+
+
+def _has_entropy(distribution):
+    try:
+        distribution.entropy()
+    except NotImplementedError:
+        return False
+    return True
+
+
+def entropy_term(distribution, sample):
+    """Per-draw estimate of the entropy of one factorized surrogate
+
+    The base entropy is analytic, and for a transformed surrogate the
+    log Jacobian of the bijector is evaluated at the draw, which is the
+    only part left to Monte Carlo. Returns None when the base has no
+    closed-form entropy.
+    """
+    bijector, base = unwrap(distribution)
+    if not _has_entropy(base):
+        return None
+    # the factorized surrogates reinterpret every batch dimension
+    entropy = tf.reduce_sum(base.entropy())
+    if bijector is None:
+        return entropy*tf.ones(
+            tf.shape(sample)[:1], dtype=entropy.dtype)
+    x = bijector.inverse(sample)
+    event_ndims = len(base.batch_shape) + len(base.event_shape)
+    return entropy + bijector.forward_log_det_jacobian(
+        x, event_ndims=event_ndims)
+
+
+def negative_log_q_terms(joint_distribution, samples, estimator='standard'):
+    """Per-variable terms of negative_log_q, one value per draw each
+
+    Returns:
+        dict: {variable: tf.Tensor}
+    """
+    if estimator not in ESTIMATORS:
+        raise ValueError(
+            f"Unknown estimator {estimator}, use one of {ESTIMATORS}")
+    terms = {}
+    for k, distribution in joint_distribution.model.items():
+        term = None
+        if estimator == 'standard':
+            term = -distribution.log_prob(samples[k])
+        if estimator == 'analytic':
+            term = entropy_term(distribution, samples[k])
+        if term is None:
+            term = -stop_gradient_distribution(
+                distribution).log_prob(samples[k])
+        terms[k] = term
+    return terms
+
+
+def negative_log_q(joint_distribution, samples, estimator='standard'):
+    """-log q(samples) or an equivalent estimate, one value per draw
+
+    Args:
+        joint_distribution (tfd.JointDistributionNamed): factorized
+            surrogate
+        samples (dict): draws from it
+        estimator (str, optional): 'standard' uses log q directly, 'stl'
+            stops gradients through the surrogate parameters in log q, and
+            'analytic' uses closed-form entropies where they exist and
+            sticking-the-landing elsewhere. Defaults to 'standard'.
+    """
+    if estimator == 'standard':
+        return -joint_distribution.log_prob(samples)
+    return tf.add_n(list(negative_log_q_terms(
+        joint_distribution, samples, estimator).values()))
+
+
+def elementwise_negative_log_q(distribution, sample, estimator='standard'):
+    """negative_log_q of one factorized surrogate without summing over its
+    elements, e.g. to weight the rows of a local variable
+    """
+    bijector, base = unwrap(distribution)
+    if estimator == 'analytic' and _has_entropy(base):
+        entropy = base.entropy()
+        if bijector is None:
+            return entropy*tf.ones_like(sample)
+        return entropy + bijector.forward_log_det_jacobian(
+            bijector.inverse(sample), event_ndims=0)
+    if estimator != 'standard':
+        bijector, base = unwrap(stop_gradient_distribution(distribution))
+    x = sample if bijector is None else bijector.inverse(sample)
+    log_prob = base.log_prob(x)
+    if bijector is not None:
+        log_prob -= bijector.forward_log_det_jacobian(x, event_ndims=0)
+    return -log_prob
+
+
+def linear_control_variate(
+        log_likelihood_fn, joint_distribution, samples):
+    """First-order Taylor control variate for the likelihood term
+
+    For every surrogate with a Normal base, x = loc + scale*eps, the
+    likelihood gradient at the surrogate mean, g, gives
+    c = g.(scale*eps) with E[c] = 0 and gradient g*eps in the scale, which
+    cancels the leading noise of the reparameterized scale gradient.
+    Subtract c from the per-draw likelihood.
+
+    Args:
+        log_likelihood_fn (callable): params dict -> log likelihood per draw
+        joint_distribution (tfd.JointDistributionNamed): factorized
+            surrogate
+        samples (dict): draws from it
+
+    Returns:
+        tf.Tensor: one value per draw
+    """
+    locs = {}
+    scales = {}
+    bijectors = {}
+    for k, distribution in joint_distribution.model.items():
+        bijector, base = unwrap(distribution)
+        if isinstance(base, tfd.Normal):
+            locs[k] = tf.convert_to_tensor(base.loc)
+            scales[k] = tf.convert_to_tensor(base.scale)
+            bijectors[k] = bijector
+    if len(locs) == 0:
+        return 0.
+
+    points = {k: tf.stop_gradient(v) for k, v in locs.items()}
+    with tf.GradientTape() as tape:
+        tape.watch(list(points.values()))
+        params = {k: v[:1] for k, v in samples.items()}
+        for k, x in points.items():
+            x = x[tf.newaxis, ...]
+            params[k] = x if bijectors[k] is None else (
+                bijectors[k].forward(x))
+        value = tf.reduce_sum(log_likelihood_fn(params))
+    grads = tape.gradient(value, points)
+
+    terms = []
+    for k, g in grads.items():
+        if g is None:
+            continue
+        x = samples[k]
+        if bijectors[k] is not None:
+            x = bijectors[k].inverse(x)
+        eps = tf.stop_gradient((x - locs[k])/scales[k])
+        g = tf.stop_gradient(g)
+        terms += [tf.reduce_sum(
+            tf.reshape(g*scales[k]*eps, [tf.shape(eps)[0], -1]), axis=-1)]
+    if len(terms) == 0:
+        return 0.
+    return tf.add_n(terms)
@@ -0,0 +1,194 @@
+import numpy as np
+from scipy.optimize import minimize_scalar
+from scipy.special import ndtr, ndtri
+
+# logistic ~ normal ogive scaling
+LOGISTIC_SCALE = 1.702
+
+
+class StreamingCorrelation(object):
+    """Pairwise-complete item moments accumulated one batch at a time
+
+    Memory is O(I^2), or O(I^2 K^2) with `polychoric`, independent of the
+    number of people. Negative responses are missing.
+
+    Args:
+        num_items (int): I
+        response_cardinality (int): K
+        polychoric (bool, optional): Also keep the K x K contingency table
+            of every item pair. Defaults to False.
+    """
+
+    def __init__(self, num_items, response_cardinality, polychoric=False):
+        I = num_items
+        self.response_cardinality = response_cardinality
+        self.polychoric = polychoric
+        self.count = np.zeros((I, I))
+        # sums over people with both i and j observed, of x_i and x_i^2
+        self.sum = np.zeros((I, I))
+        self.sum_squares = np.zeros((I, I))
+        self.cross = np.zeros((I, I))
+        self.tables = None
+        if polychoric:
+            K = response_cardinality
+            self.tables = np.zeros((I, I, K, K))
+
+    def update(self, responses):
+        """Add a people x items batch of responses
+        """
+        responses = np.asarray(responses, dtype=np.float64)
+        observed = (responses >= 0).astype(np.float64)
+        x = np.where(responses >= 0, responses, 0.)
+        self.count += observed.T @ observed
+        self.sum += x.T @ observed
+        self.sum_squares += (x**2).T @ observed
+        self.cross += x.T @ x
+        if self.polychoric:
+            K = self.response_cardinality
+            onehot = (
+                x[..., np.newaxis] == np.arange(K)
+            )*observed[..., np.newaxis]
+            self.tables += np.einsum('bik,bjl->ijkl', onehot, onehot)
+
+    def pearson(self):
+        """Pairwise-complete Pearson correlation matrix
+        """
+        n = self.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = n*self.cross - self.sum*self.sum.T
+            var = n*self.sum_squares - self.sum**2
+            corr = cov/np.sqrt(var*var.T)
+        corr = np.where(np.isfinite(corr), corr, 0.)
+        np.fill_diagonal(corr, 1.)
+        return corr
+
+    def thresholds(self):
+        """Normal-ogive thresholds, I x (K-1), from the item marginals
+
+        P(x_i < k) = Phi(tau_ik)
+        """
+        K = self.response_cardinality
+        marginals = np.stack([
+            np.diag(self.tables[i, i]) for i in range(len(self.tables))])
+        return _thresholds(marginals, K)
+
+    def polychoric_correlation(self):
+        """Two-step polychoric correlation matrix
+        """
+        if not self.polychoric:
+            raise ValueError("Accumulate with polychoric=True")
+        tau = self.thresholds()
+        I = len(tau)
+        corr = np.eye(I)
+        for i in range(I):
+            for j in range(i + 1, I):
+                corr[i, j] = corr[j, i] = polychoric_pair(
+                    self.tables[i, j], tau[i], tau[j])
+        return corr
+
+    def correlation(self):
+        if self.polychoric:
+            return nearest_correlation(self.polychoric_correlation())
+        return nearest_correlation(self.pearson())
+
+    def item_thresholds(self):
+        """Thresholds from the item means and variances when no tables
+        were kept, else from the tables
+        """
+        if self.polychoric:
+            return self.thresholds()
+        K = self.response_cardinality
+        # category proportions are not available, spread the thresholds
+        # around the item mean under a normal approximation
+        n = np.diag(self.count)
+        mean = np.diag(self.sum)/np.maximum(n, 1)
+        sd = np.sqrt(np.maximum(
+            np.diag(self.sum_squares)/np.maximum(n, 1) - mean**2, 1e-6))
+        cuts = np.arange(K - 1) + 0.5
+        return (cuts[np.newaxis, :] - mean[:, np.newaxis])/sd[:, np.newaxis]
+
+
+def _thresholds(marginals, K, eps=0.5):
+    counts = marginals + eps
+    cumulative = np.cumsum(counts, axis=-1)[..., :-1]/np.sum(
+        counts, axis=-1, keepdims=True)
+    return ndtri(cumulative)
+
+
+def bivariate_normal_cdf(h, k, rho, order=20):
+    """Phi_2(h, k; rho), vectorized in h and k, for |rho| < 1
+
+    Uses Phi_2 = Phi(h)Phi(k) + 1/(2 pi) int_0^rho
+    exp(-(h^2 - 2hkr + k^2)/(2(1 - r^2)))/sqrt(1 - r^2) dr
+    with Gauss-Legendre quadrature. Infinite limits are clipped to +-10.
+    """
+    h = np.clip(h, -10., 10.)
+    k = np.clip(k, -10., 10.)
+    z, w = np.polynomial.legendre.leggauss(order)
+    r = 0.5*rho*(z + 1.)
+    w = 0.5*rho*w
+    h_ = h[..., np.newaxis]
+    k_ = k[..., np.newaxis]
+    integrand = np.exp(
+        -(h_**2 - 2.*h_*k_*r + k_**2)/(2.*(1. - r**2)))/np.sqrt(1. - r**2)
+    return ndtr(h)*ndtr(k) + np.sum(integrand*w, axis=-1)/(2.*np.pi)
+
+
+def polychoric_pair(table, tau_i, tau_j, max_rho=0.995):
+    """Maximum likelihood polychoric correlation of one K x K table
+    given the thresholds of both items
+    """
+    a = np.concatenate([[-np.inf], tau_i, [np.inf]])
+    b = np.concatenate([[-np.inf], tau_j, [np.inf]])
+    A, B = np.meshgrid(a, b, indexing='ij')
+
+    def negative_log_likelihood(rho):
+        F = bivariate_normal_cdf(A, B, rho)
+        probs = F[1:, 1:] - F[:-1, 1:] - F[1:, :-1] + F[:-1, :-1]
+        return -np.sum(table*np.log(np.maximum(probs, 1e-300)))
+
+    if np.sum(table) == 0:
+        return 0.
+    result = minimize_scalar(
+        negative_log_likelihood, bounds=(-max_rho, max_rho),
+        method='bounded')
+    return float(result.x)
+
+
+def nearest_correlation(corr, min_eigenvalue=1e-3):
+    """Clip the eigenvalues of a pairwise correlation matrix, which need
+    not be positive definite, and rescale to a unit diagonal
+    """
+    values, vectors = np.linalg.eigh((corr + corr.T)/2.)
+    fixed = (vectors*np.maximum(values, min_eigenvalue)) @ vectors.T
+    d = np.sqrt(np.diag(fixed))
+    return fixed/np.outer(d, d)
+
+
+def grm_initialization(loadings, thresholds, max_discrimination=4.,
+                       max_difficulty=4.):
+    """GRM discriminations and difficulties from a normal-ogive factor
+    solution
+
+    In one dimension P(x >= k) = Phi((lambda theta - tau_k)/sqrt(1 -
+    lambda^2)), so the discrimination is lambda/sqrt(1 - h^2) on the
+    logistic scale and the difficulties are tau_k/lambda.
+
+    Args:
+        loadings (np.ndarray): I x D
+        thresholds (np.ndarray): I x (K-1)
+
+    Returns:
+        (np.ndarray, np.ndarray): discriminations D x I, difficulties
+            D x I x (K-1), sorted along the last axis
+    """
+    loadings = np.abs(loadings)
+    communality = np.minimum(np.sum(loadings**2, axis=1), 0.95)
+    discriminations = LOGISTIC_SCALE*loadings/np.sqrt(
+        1. - communality)[:, np.newaxis]
+    discriminations = np.clip(discriminations, 0.05, max_discrimination).T
+    difficulties = thresholds[np.newaxis, :, :]/np.maximum(
+        loadings.T[..., np.newaxis], 0.1)
+    difficulties = np.sort(
+        np.clip(difficulties, -max_difficulty, max_difficulty), axis=-1)
+    return discriminations, difficulties
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 import itertools
+from functools import partial
 
 import numpy as np
-import pandas as pd
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -10,10 +10,20 @@ from factor_analyzer import (
     FactorAnalyzer)
 
 from autoencirt.irt import IRTModel
+from autoencirt.irt.abilities import AbilityStore
+from autoencirt.irt.blocked import StepSizeAdapter, mala_step, unit_sum
+from autoencirt.irt.compiled import tf_function
+from autoencirt.irt.factor import StreamingCorrelation, grm_initialization
+from autoencirt.irt.moments import expectation, factorized_moments, unwrap
+from autoencirt.irt.priors import (
+    abs_horseshoe_log_prob, event_sum, half_normal_log_prob,
+    inverse_gamma_log_prob, normal_log_prob, sqrt_inverse_gamma_log_prob)
+from autoencirt.irt.persistence import (
+    assign_surrogate_arrays, surrogate_arrays)
 from bayesianquilts.util import (
     build_trainable_InverseGamma_dist,
     build_trainable_normal_dist, build_surrogate_posterior,
-    run_chain)
+    run_chain, tf_data_cardinality)
 
 from bayesianquilts.distributions import SqrtInverseGamma, AbsHorseshoe
 
@@ -40,32 +50,181 @@ class GRModel(IRTModel):
         [type] -- [description]
     """
     response_type = "polytomous"
+    hybrid = False
+    fused_prior = True
+    recompute = False
+    # arguments of grm_model_prob_d / response_log_prob
+    item_vars = ['discriminations', 'difficulties0', 'ddifficulties']
+    # GRM variables that a subclass does without
+    omitted_vars = []
+    # variables with a dimension axis at position 1
+    dimension_vars = [
+        'abilities', 'discriminations', 'difficulties0', 'ddifficulties',
+        'mu', 'xi', 'xi_a']
+    # groups of items with their own global scale xi, item_groups maps
+    # every item to its group (None for a single group)
+    num_scale_groups = 1
+    item_groups = None
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, factor_init='pairwise', ability_store=None,
+                 **kwargs):
+        """
+        Keyword Arguments:
+            factor_init {str} -- 'pairwise' or 'polychoric' correlations
+                for the factor-analytic initialization of the item
+                parameters, or None to skip it (default: {'pairwise'})
+            ability_store {dict} -- Keep the abilities surrogate in an
+                AbilityStore built with these arguments, see
+                use_ability_store, so that the dense N x D surrogate is
+                never allocated (default: {None})
+        """
         super(GRModel, self).__init__(*args, **kwargs)
-        if self.data is not None:
+        if ability_store is not None:
+            self.paged_vars = ['abilities']
+        self.create_distributions(set_expectations=False)
+        if ability_store is not None:
+            self.use_ability_store(**ability_store)
+        if self.data is not None and factor_init is not None:
             print("Computing a factor analysis")
-            _batch_size = min(self.data_cardinality, 100)
-            df = next(iter(self.data.shuffle(200).batch(self.data_cardinality)))
-            df = {
-                k: v.numpy() for k, v in df.items() if k in self.item_keys
-            }
-            df = pd.DataFrame(df)
-            df[df < 0] = np.nan
-            df = df.dropna()
-            if len(df) > 5:
-                fa = FactorAnalyzer(n_factors=self.dimensions)
-                fa.fit(df)
-                self.factor_loadings = fa.loadings_
-                
-            else:
-                print("Not doing a factor analysis because we have too much missingness")
-        self.create_distributions()
-
-    def grm_model_prob(self, abilities, discriminations, difficulties):
+            self.factor_analysis(polychoric=(factor_init == 'polychoric'))
+        self.set_calibration_expectations()
+
+    def factor_analysis(self, polychoric=False, batch_size=10000,
+                        min_pairs=5, seed_surrogate=True):
+        """Exploratory factor analysis from one streaming pass
+
+        Pairwise-complete (optionally polychoric) correlations are
+        accumulated batch by batch in O(I^2) memory, factored with
+        FactorAnalyzer, and turned into discriminations and difficulties
+        that seed the surrogate locations.
+
+        Keyword Arguments:
+            polychoric {bool} -- (default: {False})
+            batch_size {int} -- People per batch (default: {10000})
+            min_pairs {int} -- Skip if any item pair has fewer jointly
+                observed people (default: {5})
+            seed_surrogate {bool} -- (default: {True})
+        """
+        solution = self._factor_solution(
+            self.data, self.item_keys, self.response_cardinality,
+            polychoric, batch_size, min_pairs)
+        if solution is None:
+            return
+        (self.item_correlation, self.factor_loadings,
+         self.item_thresholds) = solution
+        if seed_surrogate:
+            self.set_surrogate_from_factors()
+
+    def _factor_solution(self, data, item_keys, response_cardinality,
+                         polychoric, batch_size, min_pairs):
+        """(correlation, loadings, thresholds) of one set of items, None
+        if there is too much missingness
+        """
+        moments = StreamingCorrelation(
+            len(item_keys), response_cardinality, polychoric)
+        for batch in data.batch(batch_size):
+            moments.update(np.stack(
+                [batch[k].numpy() for k in item_keys], axis=-1))
+        if np.min(moments.count) < min_pairs:
+            print(
+                "Not doing a factor analysis because we have too much "
+                "missingness")
+            return None
+        correlation = moments.correlation()
+        fa = FactorAnalyzer(
+            n_factors=self.dimensions, is_corr_matrix=True,
+            rotation=(None if self.dimensions == 1 else 'varimax'))
+        fa.fit(correlation)
+        return correlation, fa.loadings_, moments.item_thresholds()
+
+    def set_surrogate_from_factors(self):
+        """Move the item surrogate locations to the factor solution
+        """
+        locations = self._factor_locations(
+            self.factor_loadings, self.item_thresholds)
+        for k, loc in locations.items():
+            if k not in self.surrogate_distribution.model:
+                continue
+            _, base = unwrap(self.surrogate_distribution.model[k])
+            base.loc.assign(loc)
+
+    def _factor_locations(self, factor_loadings, item_thresholds):
+        """Unconstrained surrogate locations of the item variables for a
+        factor solution, each 1 x D x I x .
+        """
+        discriminations, difficulties = grm_initialization(
+            factor_loadings, item_thresholds)
+        discriminations = tf.cast(
+            discriminations[np.newaxis, ..., np.newaxis], self.dtype)
+        difficulties = tf.cast(difficulties[np.newaxis, ...], self.dtype)
+        ddifficulties = tf.maximum(
+            difficulties[..., 1:] - difficulties[..., :-1], 1e-2)
+        return {
+            'discriminations': tfp.math.softplus_inverse(discriminations),
+            'difficulties0': difficulties[..., :1],
+            'mu': difficulties[..., :1],
+            'ddifficulties': tfp.math.softplus_inverse(ddifficulties)
+        }
+
+    def use_ability_store(self, directory=None, dtype='float32',
+                          partition_size=2**20, store=None):
+        """Move the abilities surrogate into a disk-backed AbilityStore
+
+        The per-person locations and scales then live in partitioned,
+        memory-mapped files and are paged in one batch at a time during
+        calibrate_advi, with optimizer state kept only for the touched
+        rows. A dense abilities surrogate, if there is one, is copied into
+        the store and dropped.
+
+        Keyword Arguments:
+            directory {str} -- Store files (default: {temporary})
+            dtype {str} -- Storage dtype (default: {'float32'})
+            partition_size {int} -- People per file (default: {2**20})
+            store {AbilityStore} -- Use this store instead of creating
+                one (default: {None})
+
+        Returns:
+            AbilityStore
+        """
+        if store is None:
+            store = AbilityStore(
+                self.num_people, [self.dimensions, 1, 1], directory,
+                dtype=dtype, model_dtype=self.dtype,
+                partition_size=partition_size)
+        dense = self.surrogate_distribution.model.get('abilities')
+        if dense is not None:
+            _, base = unwrap(dense)
+            loc = tf.convert_to_tensor(base.loc).numpy()
+            scale = tf.convert_to_tensor(base.scale).numpy()
+            rows = np.arange(self.num_people)
+            store.put('loc', rows, loc.astype(store.storage_dtype))
+            store.put(
+                'raw_scale', rows,
+                tfp.math.softplus_inverse(scale).numpy().astype(
+                    store.storage_dtype))
+        self.paged_vars = ['abilities']
+        self.row_stores = {'abilities': store}
+        if dense is not None:
+            arrays = {
+                k: v for k, v in surrogate_arrays(self).items()
+                if not k.startswith("surrogate/abilities/")}
+            self.create_distributions(set_expectations=False)
+            assign_surrogate_arrays(self, arrays)
+            if self.hybrid:
+                self.conjugate_update()
+            self.surrogate_sample = None
+            self._compiled_functions = None
+            self.set_calibration_expectations()
+        return store
+
+    def grm_model_prob(self, abilities, discriminations, difficulties,
+                       category_mask=None):
         offsets = difficulties - abilities  # N x D x I x K-1
         scaled = offsets*discriminations
         logits = 1.0/(1+tf.exp(scaled))
+        if category_mask is not None:
+            # P(X >= k) = 0 for the thresholds an item does not have
+            logits = logits*category_mask
         logits = tf.pad(
             logits,
             paddings=(
@@ -105,11 +264,58 @@ class GRModel(IRTModel):
     def log_likelihood(
             self, responses, discriminations,
             difficulties0, ddifficulties,
-            abilities, *args, **kwargs):
-        # check if responses are a batch
+            abilities, *args, reduce_batch=True, chunk=True, per_item=False,
+            **kwargs):
+        return self._response_log_likelihood(
+            responses, abilities, {
+                'discriminations': discriminations,
+                'difficulties0': difficulties0,
+                'ddifficulties': ddifficulties},
+            reduce_batch=reduce_batch, chunk=chunk, per_item=per_item)
+
+    def response_log_prob(self, abilities, choices, discriminations,
+                          difficulties0, ddifficulties, category_mask=None):
+        """Log probability of every choice, S x B x I, given the abilities
+        of the people who made them
+        """
         difficulties = tf.concat(
             [difficulties0, ddifficulties], axis=-1)
         difficulties = tf.cumsum(difficulties, axis=-1)
+        response_probs = self.grm_model_prob(
+            abilities, discriminations, difficulties, category_mask)
+
+        rv_responses = tfd.Categorical(
+            probs=response_probs)
+
+        return rv_responses.log_prob(choices)
+
+    def _response_log_likelihood(
+            self, responses, abilities, items, reduce_batch=True, chunk=True,
+            per_item=False):
+        """log_likelihood for any response_log_prob
+
+        Args:
+            items (dict): item parameters passed on to response_log_prob
+        """
+        if chunk and self.memory_planner is not None:
+            # split the people in the batch to fit the memory budget
+            batch_size = responses[self.person_key].shape[0]
+            num_samples = int(np.prod(abilities.shape[:-4]))
+            if batch_size is not None:
+                size = self.memory_planner.likelihood_chunk(
+                    self, num_samples, batch_size)
+                if size < batch_size:
+                    parts = [
+                        self._response_log_likelihood(
+                            {
+                                k: v[start:(start + size)]
+                                for k, v in responses.items()},
+                            abilities, items, reduce_batch=reduce_batch,
+                            chunk=False, per_item=per_item)
+                        for start in range(0, batch_size, size)]
+                    if reduce_batch or per_item:
+                        return tf.add_n(parts)
+                    return tf.concat(parts, axis=-1)
 
         # gather abilities and item parameters corresponding to responses
 
@@ -119,9 +325,7 @@ class GRModel(IRTModel):
 
         people = tf.cast(
             responses[self.person_key], tf.int32)
-        choices = tf.concat(
-            [responses[i][:, tf.newaxis] for i in self.item_keys],
-            axis=-1)
+        choices = self.response_choices(responses)
 
         bad_choices = tf.less(choices, 0)
 
@@ -143,27 +347,65 @@ class GRModel(IRTModel):
             abilities, transpose1
         )
 
-        response_probs = self.grm_model_prob(
-            abilities, discriminations, difficulties)
+        items = self.record_items(responses, items)
+        names = list(items.keys())
 
-        rv_responses = tfd.Categorical(
-            probs=response_probs)
+        def response_log_probs(abilities, *values):
+            return self.response_log_prob(
+                abilities, choices, **dict(zip(names, values)))
 
-        log_probs = rv_responses.log_prob(choices)
+        if self.recompute:
+            # keep only the inputs for backprop and rebuild the
+            # S x B x D x I x K intermediates in the backward pass
+            response_log_probs = tf.recompute_grad(response_log_probs)
+        log_probs = response_log_probs(
+            abilities, *[items[k] for k in names])
         log_probs = tf.where(
             bad_choices[tf.newaxis, ...],
             tf.zeros_like(log_probs),
             log_probs
         )
 
+        if per_item:
+            return self.item_totals(responses, log_probs)
         log_probs = tf.reduce_sum(log_probs, axis=-1)
-        log_probs = tf.reduce_sum(log_probs, axis=-1)
+        if reduce_batch:
+            log_probs = tf.reduce_sum(log_probs, axis=-1)
 
         return log_probs
 
-    def create_distributions(self):
+    def response_choices(self, responses):
+        """Responses of a batch, B x I
+        """
+        return tf.concat(
+            [responses[i][:, tf.newaxis] for i in self.item_keys],
+            axis=-1)
+
+    def record_items(self, responses, items):
+        """Item parameters lined up with the columns of response_choices
+        """
+        return items
+
+    def item_totals(self, responses, log_probs):
+        """Summed over the people of the batch, one value per item
+        """
+        return tf.reduce_sum(log_probs, axis=-2)
+
+    def item_scale(self, eta, xi):
+        """Horseshoe scale eta*xi of the discriminations, xi taken from
+        the scale group of each item
+        """
+        if self.item_groups is not None:
+            xi = tf.gather(xi, self.item_groups, axis=-2)
+        return eta*xi
+
+    def create_distributions(self, set_expectations=True):
         """Joint probability with measure over observations
 
+        Args:
+            set_expectations (bool, optional): Compute calibrated
+                expectations from the fresh surrogate. Defaults to True.
+
         Returns:
             tf.distributions.JointDistributionNamed -- Joint distribution
         """
@@ -216,7 +458,7 @@ class GRModel(IRTModel):
             ),  # difficulties0
             discriminations=(
                 lambda eta, xi: tfd.Independent(
-                    AbsHorseshoe(scale=eta*xi),
+                    AbsHorseshoe(scale=self.item_scale(eta, xi)),
                     reinterpreted_batch_ndims=4
                 )),
             ddifficulties=tfd.Independent(
@@ -242,10 +484,10 @@ class GRModel(IRTModel):
             xi_a=tfd.Independent(
                 tfd.InverseGamma(
                     0.5*tf.ones(
-                        (1, self.dimensions, 1, 1),
+                        (1, self.dimensions, self.num_scale_groups, 1),
                         dtype=self.dtype),
                     tf.ones(
-                        (1, self.dimensions, 1, 1),
+                        (1, self.dimensions, self.num_scale_groups, 1),
                         dtype=self.dtype)/self.xi_scale**2
                 ),
                 reinterpreted_batch_ndims=4
@@ -253,7 +495,7 @@ class GRModel(IRTModel):
             xi=lambda xi_a: tfd.Independent(
                 SqrtInverseGamma(
                     0.5*tf.ones(
-                        (1, self.dimensions, 1, 1),
+                        (1, self.dimensions, self.num_scale_groups, 1),
                         dtype=self.dtype),
                     1.0/xi_a
                 ),
@@ -322,9 +564,8 @@ class GRModel(IRTModel):
             ),
             'discriminations': self.bijectors['discriminations'](
                 build_trainable_normal_dist(
-                    #tf.cast(
-                    #    (1.+np.abs(self.factor_loadings.T)),
-                    #    self.dtype)[tf.newaxis, ..., tf.newaxis],
+                    # set_surrogate_from_factors moves this when there
+                    # is data
                     -4.*tf.ones(
                         (1, self.dimensions, self.num_items, 1),
                         dtype=self.dtype),
@@ -360,10 +601,10 @@ class GRModel(IRTModel):
             'xi': self.bijectors['xi'](
                 build_trainable_InverseGamma_dist(
                     0.5*tf.ones(
-                        (1, self.dimensions, 1, 1),
+                        (1, self.dimensions, self.num_scale_groups, 1),
                         dtype=self.dtype),
                     tf.ones(
-                        (1, self.dimensions, 1, 1),
+                        (1, self.dimensions, self.num_scale_groups, 1),
                         dtype=self.dtype),
                     4
                 )
@@ -382,10 +623,10 @@ class GRModel(IRTModel):
         surrogate_distribution_dict["xi_a"] = self.bijectors['xi_a'](
             build_trainable_InverseGamma_dist(
                 2*tf.ones(
-                    (1, self.dimensions, 1, 1),
+                    (1, self.dimensions, self.num_scale_groups, 1),
                     dtype=self.dtype),
                 tf.ones(
-                    (1, self.dimensions, 1, 1),
+                    (1, self.dimensions, self.num_scale_groups, 1),
                     dtype=self.dtype),
                 4
             )
@@ -411,6 +652,13 @@ class GRModel(IRTModel):
             )
         )
 
+        for k in self.omitted_vars:
+            self.bijectors.pop(k)
+        for k in self.paged_vars + self.omitted_vars:
+            # paged_vars are kept in self.row_stores
+            grm_joint_distribution_dict.pop(k)
+            surrogate_distribution_dict.pop(k)
+
         self.joint_prior_distribution = tfd.JointDistributionNamed(
             grm_joint_distribution_dict)
         self.surrogate_distribution = tfd.JointDistributionNamed(
@@ -418,9 +666,346 @@ class GRModel(IRTModel):
 
         self.surrogate_vars = self.surrogate_distribution.variables
         self.var_list = list(surrogate_distribution_dict.keys())
+        if self.hybrid:
+            self._set_conjugate_surrogates()
+        if set_expectations:
+            self.set_calibration_expectations()
+
+    def hessian_blocks(self):
+        """Given the abilities and the global scale xi the items are
+        independent, so the item parameters decouple along the item axis
+        """
+        blocks = super(GRModel, self).hessian_blocks()
+        for k in self.item_vars + ['eta', 'eta_a']:
+            if k in self.var_list:
+                blocks[k] = [-2]
+        return blocks
+
+    def _conjugate_parents(self):
+        # auxiliary -> (scale mixture variable it is the scale of, prior
+        # scale)
+        return {
+            'xi_a': ('xi', self.xi_scale),
+            'eta_a': ('eta', self.eta_scale)
+        }
+
+    def _set_conjugate_surrogates(self):
+        surrogate_distribution_dict = dict(self.surrogate_distribution.model)
+        self.conjugate_scales = {}
+        for k, (child, _) in self._conjugate_parents().items():
+            shape = surrogate_distribution_dict[child].event_shape
+            self.conjugate_scales[k] = tf.Variable(
+                tf.ones(shape, dtype=self.dtype), trainable=False,
+                name=f"{k}_scale")
+            surrogate_distribution_dict[k] = tfd.Independent(
+                tfd.InverseGamma(
+                    tf.ones(shape, dtype=self.dtype),
+                    self.conjugate_scales[k]
+                ),
+                reinterpreted_batch_ndims=4
+            )
+        self.surrogate_distribution = tfd.JointDistributionNamed(
+            surrogate_distribution_dict)
+        self.surrogate_vars = self.surrogate_distribution.variables
+        self.conjugate_vars = list(self.conjugate_scales.keys())
+        self.conjugate_update()
+
+    def enable_conjugate_updates(self):
+        """Hybrid VI: closed-form updates for the horseshoe auxiliaries
+
+        With xi_a ~ IG(1/2, 1/xi_scale^2) and xi^2 | xi_a ~ IG(1/2, 1/xi_a)
+        the complete conditional of xi_a is IG(1, 1/xi_scale^2 + 1/xi^2),
+        so the optimal mean-field factor is
+        q(xi_a) = IG(1, 1/xi_scale^2 + E_q[1/xi^2]), and likewise for eta_a.
+        Their surrogates are replaced by these factors, which are no longer
+        trained by gradient; calibrate_advi refreshes them between steps.
+        """
+        self.hybrid = True
+        self._set_conjugate_surrogates()
+
+    def conjugate_update(self):
+        """Set q(xi_a) and q(eta_a) to their coordinate-ascent optimum
+        """
+        for k, (child, scale) in self._conjugate_parents().items():
+            inverse_square = expectation(
+                self.surrogate_distribution.model[child],
+                lambda x: x**-2)
+            self.conjugate_scales[k].assign(
+                tf.cast(scale, self.dtype)**-2 + inverse_square)
+
+    def conjugate_variables(self):
+        if not self.hybrid:
+            return []
+        return list(self.conjugate_scales.values())
+
+    def collapsed_dimensions(self, xi_threshold=1e-2, weight_threshold=2e-2):
+        """Dimensions whose horseshoe has shrunk them away
+
+        A dimension has collapsed when the surrogate mean of its global
+        scale xi is below `xi_threshold` and its share of the
+        discrimination weights in grm_model_prob is below
+        `weight_threshold` for every item.
+
+        Returns:
+            np.ndarray: boolean mask over dimensions
+        """
+        mean, _ = factorized_moments(self.surrogate_distribution)
+        xi = np.reshape(mean['xi'].numpy(), [self.dimensions])
+        weights = np.abs(
+            mean['discriminations'].numpy()[0, ..., 0])**self.weight_exponent
+        weights = weights/np.sum(weights, axis=0, keepdims=True)
+        return (xi < xi_threshold) & (
+            np.max(weights, axis=1) < weight_threshold)
+
+    def prune_dimensions(self, xi_threshold=1e-2, weight_threshold=2e-2,
+                         min_dimensions=1, keep=None):
+        """Drop collapsed dimensions from every surrogate variable
+
+        The remaining variational parameters are carried over, so training
+        continues with smaller tensors. Posterior draws and compiled
+        functions are discarded, and checkpoints of the larger model can
+        no longer be restored into this one.
+
+        Keyword Arguments:
+            xi_threshold {float} -- (default: {1e-2})
+            weight_threshold {float} -- (default: {2e-2})
+            min_dimensions {int} -- Never prune below this many
+                (default: {1})
+            keep {list} -- Indices of the dimensions to keep, overriding
+                the detection (default: {None})
+
+        Returns:
+            np.ndarray -- indices of the kept dimensions in the old model
+        """
+        self._check_dense("prune_dimensions")
+        D = self.dimensions
+        if keep is None:
+            collapsed = self.collapsed_dimensions(
+                xi_threshold, weight_threshold)
+            keep = np.where(~collapsed)[0]
+            if len(keep) < min_dimensions:
+                # keep the strongest of the collapsed ones
+                mean, _ = factorized_moments(self.surrogate_distribution)
+                xi = np.reshape(mean['xi'].numpy(), [D])
+                keep = np.sort(np.argsort(-xi)[:min_dimensions])
+        keep = np.asarray(keep, dtype=np.int64)
+        if len(keep) == D:
+            return keep
+        print(f"Pruning dimensions {sorted(set(range(D)) - set(keep))}")
+
+        arrays = surrogate_arrays(self)
+        for name, value in arrays.items():
+            k = name.split("/")[1]
+            if k in self.dimension_vars and value.shape[1] == D:
+                arrays[name] = np.take(value, keep, axis=1)
+        if np.ndim(self.kappa_scale) > 1 and (
+                np.shape(self.kappa_scale)[1] == D):
+            self.kappa_scale = np.take(self.kappa_scale, keep, axis=1)
+        if getattr(self, 'factor_loadings', None) is not None:
+            self.factor_loadings = self.factor_loadings[:, keep]
+
+        self.dimensions = len(keep)
+        self.create_distributions(set_expectations=False)
+        assign_surrogate_arrays(self, arrays)
+        if self.hybrid:
+            self.conjugate_update()
+        self.surrogate_sample = None
+        self._compiled_functions = None
         self.set_calibration_expectations()
+        return keep
+
+    def _item_log_prior(self, params):
+        """Log prior of the item block, one value per item
+        """
+        one = tf.ones([], dtype=self.dtype)
+        terms = [
+            normal_log_prob(params['mu'], 0., one),
+            normal_log_prob(params['difficulties0'], params['mu'], one),
+            abs_horseshoe_log_prob(
+                params['discriminations'],
+                self.item_scale(params['eta'], params['xi'])),
+            sqrt_inverse_gamma_log_prob(
+                params['eta'], 0.5*one, 1.0/params['eta_a'])
+        ]
+        if 'ddifficulties' in params:
+            terms += [half_normal_log_prob(params['ddifficulties'], one)]
+        return tf.add_n([unit_sum(t, -2) for t in terms])
+
+    def calibrate_mcmc_blocked(
+            self, data=None, num_steps=1000, burnin=500, init_state=None,
+            step_sizes=None, thin=1, seed=None):
+        """Blocked Metropolis-within-Gibbs over the GRM
+
+        Given the item parameters the people are independent, and given
+        the abilities and the global scale xi the items are independent.
+        Every iteration therefore takes
+
+        1. one MALA step on all abilities at once, accepted per person,
+        2. one MALA step on (discriminations, difficulties0,
+           ddifficulties, mu, eta), accepted per item,
+        3. one MALA step on xi,
+        4. exact Gibbs draws of xi_a and eta_a from their inverse gamma
+           complete conditionals,
+
+        in the unconstrained space of the model bijectors. Each block's
+        step size is adapted toward 0.574 acceptance during burnin. The
+        cost of an iteration is two likelihood gradients per block,
+        independent of how many people or items share a step.
+
+        Keyword Arguments:
+            data {tf.data.Dataset} -- held in memory as one batch
+                (default: {self.data})
+            num_steps {int} -- kept iterations (default: {1000})
+            burnin {int} -- (default: {500})
+            init_state {dict} -- constrained starting point
+                (default: {calibrated_expectations})
+            step_sizes {dict} -- initial step size of the 'abilities',
+                'items' and 'xi' blocks (default: {0.1 each})
+            thin {int} -- keep every thin-th iteration (default: {1})
+            seed {int} -- (default: {None})
+
+        Returns:
+            (dict, dict) -- draws by variable, and the acceptance rate and
+                final step size of each block
+        """
+        self._check_dense("calibrate_mcmc_blocked")
+        # every iteration splits its own stateless seeds off this one
+        seed = tfp.random.sanitize_seed(seed)
+        data = self.data if data is None else data
+        card = self.data_cardinality if data is self.data else None
+        if card is None:
+            card = tf_data_cardinality(data)
+        batch = next(iter(data.batch(card)))
+        people = tf.cast(batch[self.person_key], tf.int32)
+        if init_state is None:
+            init_state = self.calibrated_expectations
+        blocks = {
+            'abilities': (['abilities'], 0),
+            'items': (
+                [k for k in [
+                    'discriminations', 'difficulties0', 'ddifficulties',
+                    'mu', 'eta'] if k in self.var_list], -2),
+            'xi': (['xi'], None)
+        }
+        state = {
+            k: self.bijectors[k].inverse(
+                tf.cast(np.asarray(init_state[k]), self.dtype))
+            for k in self.var_list}
+        step_sizes = {} if step_sizes is None else step_sizes
+        adapters = {
+            b: StepSizeAdapter(step_sizes.get(b, 1e-1)) for b in blocks}
+
+        def constrained(u):
+            return {k: self.bijectors[k].forward(v) for k, v in u.items()}
+
+        def log_jacobian(names, u, axis):
+            return tf.add_n([
+                unit_sum(self.bijectors[k].forward_log_det_jacobian(
+                    u[k], event_ndims=0), axis) for k in names])
+
+        def log_likelihood(params, **kwargs):
+            return self.log_likelihood(
+                batch, **{
+                    k: v[tf.newaxis, ...] for k, v in params.items()},
+                **kwargs)[0]
+
+        def abilities_log_prob(params, u):
+            per_record = log_likelihood(params, reduce_batch=False)
+            return tf.math.unsorted_segment_sum(
+                per_record, people, self.num_people) + unit_sum(
+                    self.local_log_prior(params)['abilities'], 0
+            ) + log_jacobian(['abilities'], u, 0)
+
+        def items_log_prob(params, u):
+            return log_likelihood(params, per_item=True) + (
+                self._item_log_prior(params)) + log_jacobian(
+                    blocks['items'][0], u, -2)
+
+        def xi_log_prob(params, u):
+            log_prob = sqrt_inverse_gamma_log_prob(
+                params['xi'], 0.5*tf.ones([], dtype=self.dtype),
+                1.0/params['xi_a'])
+            return unit_sum(log_prob, None) + unit_sum(abs_horseshoe_log_prob(
+                params['discriminations'],
+                self.item_scale(params['eta'], params['xi'])
+            ), None) + log_jacobian(['xi'], u, None)
 
-    def score(self, responses, samples=400):
+        block_log_prob = {
+            'abilities': abilities_log_prob,
+            'items': items_log_prob,
+            'xi': xi_log_prob
+        }
+
+        def block_step(name, u, step_size, seed):
+            names, axis = blocks[name]
+
+            def log_prob_fn(x):
+                v = {**u, **dict(zip(names, x))}
+                return block_log_prob[name](constrained(v), v)
+
+            x, accept = mala_step(
+                log_prob_fn, [u[k] for k in names], [axis]*len(names),
+                step_size, seed=seed)
+            return dict(zip(names, x)), tf.reduce_mean(
+                tf.cast(accept, self.dtype))
+
+        steps = {b: tf_function(partial(block_step, b)) for b in blocks}
+
+        def gibbs(u, seed):
+            params = constrained(u)
+            parents = self._conjugate_parents()
+            seeds = tfp.random.split_seed(seed, n=len(parents))
+            for (k, (child, scale)), s in zip(parents.items(), seeds):
+                value = tfd.InverseGamma(
+                    tf.ones_like(params[k]),
+                    tf.cast(scale, self.dtype)**-2 + params[child]**-2
+                ).sample(seed=s)
+                u[k] = self.bijectors[k].inverse(value)
+            return u
+
+        draws = {k: [] for k in self.var_list}
+        acceptance = {b: [] for b in blocks}
+        for t in range(burnin + num_steps):
+            seed, gibbs_seed, *block_seeds = tfp.random.split_seed(
+                seed, n=len(blocks) + 2)
+            for b, block_seed in zip(blocks, block_seeds):
+                update, rate = steps[b](
+                    state, tf.constant(adapters[b].step_size, self.dtype),
+                    block_seed)
+                state = {**state, **update}
+                if t < burnin:
+                    adapters[b].update(float(rate))
+                else:
+                    acceptance[b] += [float(rate)]
+            state = gibbs(state, gibbs_seed)
+            if t >= burnin and (t - burnin) % thin == 0:
+                for k, v in constrained(state).items():
+                    draws[k] += [v.numpy()]
+        self.surrogate_sample = {k: np.stack(v) for k, v in draws.items()}
+        self.set_calibration_expectations(variational=False)
+        return self.surrogate_sample, {
+            'acceptance': {
+                b: float(np.mean(a)) for b, a in acceptance.items()},
+            'step_size': {b: a.step_size for b, a in adapters.items()}
+        }
+
+    def get_config(self):
+        config = super(GRModel, self).get_config()
+        if self.hybrid:
+            config['hybrid'] = True
+        if len(self.paged_vars) > 0:
+            config['paged_vars'] = list(self.paged_vars)
+        return config
+
+    def _init_from_config(self, config):
+        config = dict(config)
+        self.hybrid = config.pop('hybrid', False)
+        # the stores themselves are attached by load_model
+        self.paged_vars = config.pop('paged_vars', [])
+        super(GRModel, self)._init_from_config(config)
+
+    def score(self, responses, samples=400, num_splits=1,
+              response_chunk=None, memory_budget=None):
         responses = tf.cast(responses, tf.int32)
         """Compute expections by importance sampling
 
@@ -429,67 +1014,132 @@ class GRModel(IRTModel):
 
         Keyword Arguments:
             samples {int} -- Number of samples to use (default: {1000})
+            num_splits {int} -- Average the response probabilities over
+                the posterior draws this many draws at a time (default: {1})
+            response_chunk {int} -- Score this many response patterns at a
+                time (default: {all})
+            memory_budget {int or str} -- Choose num_splits and
+                response_chunk with a MemoryPlanner (default: {None})
         """
+        loc, scale = self.ability_population_moments()
         sampling_rv = tfd.Independent(
-            tfd.Normal(
-                loc=tf.reduce_mean(
-                    self.calibrated_expectations['abilities'],
-                    axis=0),
-                scale=tf.math.reduce_std(
-                    self.calibrated_expectations['abilities'],
-                    axis=0)
-            ),
+            tfd.Normal(loc=loc, scale=scale),
             reinterpreted_batch_ndims=2
         )
         trait_samples = sampling_rv.sample(samples)
 
         sample_log_p = sampling_rv.log_prob(trait_samples)
 
-        response_probs = self.grm_model_prob_d(
-            abilities=trait_samples[..., tf.newaxis, tf.newaxis, :, :, :],
-            discriminations=tf.expand_dims(
-                self.surrogate_sample[
-                    'discriminations'
-                ],
-                0),
-            difficulties0=tf.expand_dims(
-                self.surrogate_sample[
-                    'difficulties0'
-                ],
-                0),
-            ddifficulties=tf.expand_dims(
-                self.surrogate_sample[
-                    'ddifficulties'
-                ],
-                0)
-        )
+        num_draws = int(
+            self.surrogate_sample['discriminations'].shape[0])
+        num_responses = int(responses.shape[0])
+        planner = self._planner(memory_budget)
+        if planner is not None:
+            plan = planner.plan_score(
+                self, num_responses, samples, num_draws)
+            num_splits = plan['num_splits']
+            response_chunk = plan['response_chunk']
+        if response_chunk is None:
+            response_chunk = num_responses
+        edges = np.linspace(
+            0, num_draws, min(num_splits, num_draws) + 1).astype(int)
+        response_probs = 0.
+        for start, stop in zip(edges[:-1], edges[1:]):
+            split_probs = self.grm_model_prob_d(
+                abilities=trait_samples[..., tf.newaxis, tf.newaxis, :, :, :],
+                **{
+                    k: tf.expand_dims(
+                        self.surrogate_sample[k][start:stop], 0)
+                    for k in self.item_vars}
+            )
+            response_probs += tf.reduce_sum(split_probs, axis=-4)
 
-        response_probs = tf.reduce_mean(response_probs, axis=-4)
+        response_probs = response_probs/num_draws
 
         response_rv = tfd.Independent(
             tfd.Categorical(
                 probs=response_probs),
             reinterpreted_batch_ndims=1
         )
-        lp = response_rv.log_prob(responses)
-        l_w = lp[..., tf.newaxis] - sample_log_p[:, tf.newaxis, :]
-        # l_w = l_w - tf.reduce_max(l_w, axis=0, keepdims=True)
-        w = tf.math.exp(l_w)/tf.reduce_sum(
-            tf.math.exp(l_w), axis=0, keepdims=True)
-        mean = tf.reduce_sum(
-            w*trait_samples[:, tf.newaxis, :, 0, 0],
-            axis=0)
-        mean2 = tf.math.reduce_sum(
-            w*trait_samples[:, tf.newaxis, :, 0, 0]**2,
-            axis=0)
-        std = tf.sqrt(mean2-mean**2)
+        means = []
+        stds = []
+        ws = []
+        for start in range(0, num_responses, response_chunk):
+            lp = response_rv.log_prob(
+                responses[start:(start + response_chunk)])
+            l_w = lp[..., tf.newaxis] - sample_log_p[:, tf.newaxis, :]
+            # l_w = l_w - tf.reduce_max(l_w, axis=0, keepdims=True)
+            w = tf.math.exp(l_w)/tf.reduce_sum(
+                tf.math.exp(l_w), axis=0, keepdims=True)
+            mean = tf.reduce_sum(
+                w*trait_samples[:, tf.newaxis, :, 0, 0],
+                axis=0)
+            mean2 = tf.math.reduce_sum(
+                w*trait_samples[:, tf.newaxis, :, 0, 0]**2,
+                axis=0)
+            means += [mean]
+            stds += [tf.sqrt(mean2-mean**2)]
+            ws += [w]
+        mean = tf.concat(means, axis=0)
+        std = tf.concat(stds, axis=0)
+        w = tf.concat(ws, axis=1)
         return mean, std, w, trait_samples
 
     def loss(self, responses, scores):
         pass
 
+    def log_prior_terms(self, params):
+        """Log prior of each variable, with plain tensor ops
+
+        The same density as joint_prior_distribution, without building
+        and resolving the JointDistributionNamed or any distribution
+        object on every call.
+
+        Returns:
+            dict: one tensor per variable, shaped like the sample dims
+        """
+        one = tf.ones([], dtype=self.dtype)
+        half = 0.5*one
+        xi_scale = tf.cast(self.xi_scale, self.dtype)
+        eta_scale = tf.cast(self.eta_scale, self.dtype)
+        terms = {
+            'mu': event_sum(normal_log_prob(params['mu'], 0., one)),
+            'difficulties0': event_sum(normal_log_prob(
+                params['difficulties0'], params['mu'], one)),
+            'discriminations': event_sum(abs_horseshoe_log_prob(
+                params['discriminations'],
+                self.item_scale(params['eta'], params['xi']))),
+            'xi_a': event_sum(inverse_gamma_log_prob(
+                params['xi_a'], half, xi_scale**-2)),
+            'xi': event_sum(sqrt_inverse_gamma_log_prob(
+                params['xi'], half, 1.0/params['xi_a'])),
+            'eta': event_sum(sqrt_inverse_gamma_log_prob(
+                params['eta'], half, 1.0/params['eta_a'])),
+            'eta_a': event_sum(inverse_gamma_log_prob(
+                params['eta_a'], half, eta_scale**-2))
+        }
+        if 'ddifficulties' in params:
+            terms['ddifficulties'] = event_sum(half_normal_log_prob(
+                params['ddifficulties'], one))
+        if 'abilities' in params:
+            # absent when the abilities are paged from a row store
+            terms['abilities'] = event_sum(normal_log_prob(
+                params['abilities'], 0., one))
+        return terms
+
+    def local_log_prior(self, params):
+        return {
+            'abilities': normal_log_prob(
+                params['abilities'], 0., tf.ones([], dtype=self.dtype))
+        }
+
+    def log_prior(self, params):
+        if not self.fused_prior:
+            return super(GRModel, self).log_prior(params)
+        return tf.add_n(list(self.log_prior_terms(params).values()))
+
     def unormalized_log_prob(self, data, **params):
-        log_prior = self.joint_prior_distribution.log_prob(params)
+        log_prior = self.log_prior(params)
         log_likelihood = self.log_likelihood(data, **params)
         return log_prior + log_likelihood
 
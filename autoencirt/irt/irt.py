@@ -4,6 +4,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
 from bayesianquilts.nn.dense import Dense, DenseHorseshoe
+from autoencirt.irt.abilities import StoreMoment
 # from bayesianquilts.model import BayesianModel
 from autoencirt.irt.model import BayesianModel
 from bayesianquilts.util import (clip_gradients,
@@ -29,6 +30,13 @@ class IRTModel(BayesianModel):
     bijectors = None
     dimensional_decay = 0.25
     surrogate_sample = None
+    local_vars = ['abilities']
+    item_vars = ['discriminations', 'difficulties0', 'ddifficulties']
+    parameter_groups = {
+        'abilities': ['abilities'],
+        'items': ['discriminations', 'difficulties0', 'ddifficulties', 'mu'],
+        'horseshoe': ['eta', 'xi', 'eta_a', 'xi_a']
+    }
     xi_scale = None
     kappa_scale = None
     positive_discriminations = True
@@ -75,6 +83,34 @@ class IRTModel(BayesianModel):
         self.num_people = num_people
         # self.create_distributions()
 
+    def get_config(self):
+        return {
+            'item_keys': list(self.item_keys),
+            'num_people': int(self.num_people),
+            'response_cardinality': int(self.response_cardinality),
+            'person_key': self.person_key,
+            'dim': int(self.dimensions),
+            'decay': float(self.dimensional_decay),
+            'positive_discriminations': bool(self.positive_discriminations),
+            'missing_val': self.missing_val,
+            'xi_scale': np.asarray(self.xi_scale).tolist(),
+            'eta_scale': np.asarray(self.eta_scale).tolist(),
+            'kappa_scale': np.asarray(self.kappa_scale).tolist(),
+            'weight_exponent': float(self.weight_exponent),
+            'dtype': tf.as_dtype(self.dtype).name
+        }
+
+    def _init_from_config(self, config):
+        config = dict(config)
+        config['dtype'] = tf.as_dtype(config['dtype'])
+        IRTModel.__init__(self, **config)
+        self.create_distributions(set_expectations=False)
+
+    def count_responses(self, batch):
+        return int(tf.add_n([
+            tf.reduce_sum(tf.cast(batch[k] >= 0, tf.int64))
+            for k in self.item_keys]))
+
     def set_dimension(self, dim, decay=0.25):
         self.dimensions = dim
         self.dimensional_decay = decay
@@ -91,9 +127,26 @@ class IRTModel(BayesianModel):
             return
         self.set_calibration_expectations()
 
-    def create_distributions(self):
+    def create_distributions(self, set_expectations=True):
         pass
 
+    def ability_population_moments(self):
+        """Mean and standard deviation over people of the calibrated
+        ability expectations, one store partition at a time when paged
+
+        Returns:
+            (tf.Tensor, tf.Tensor)
+        """
+        abilities = self.calibrated_expectations['abilities']
+        if isinstance(abilities, StoreMoment):
+            mean, std = abilities.population_moments()
+            return (
+                tf.constant(mean, dtype=self.dtype),
+                tf.constant(std, dtype=self.dtype))
+        return (
+            tf.reduce_mean(abilities, axis=0),
+            tf.math.reduce_std(abilities, axis=0))
+
     def obtain_scoring_nn(self, hidden_layers=None):
         if self.calibrated_traits is None:
             print("Please calibrate the IRT model first")
@@ -122,15 +175,26 @@ class IRTModel(BayesianModel):
             return -ability_distribution.log_prob(dnn_fun(self.response_data))
 
     def simulate_data(self, shape, sparsity=0.5):
+        """Responses of new people drawn like the calibrated abilities
+
+        Everything is built as one tensor, for large numbers of people
+        use autoencirt.data.synthetic.simulate_from_model, which streams
+        chunks to disk.
+
+        Arguments:
+            shape {int or list} -- number of people, or a batch shape
+
+        Keyword Arguments:
+            sparsity {float} -- Probability that a discrimination is set
+                to zero (default: {0.5})
+
+        Returns:
+            (tf.Tensor, tf.Tensor, tf.Tensor) -- responses, the
+                discriminations used and the simulated abilities
+        """
+        loc, scale = self.ability_population_moments()
         sampling_rv = tfd.Independent(
-            tfd.Normal(
-                loc=tf.reduce_mean(
-                    self.calibrated_expectations['abilities'],
-                    axis=0),
-                scale=tf.math.reduce_std(
-                    self.calibrated_expectations['abilities'],
-                    axis=0)
-            ),
+            tfd.Normal(loc=loc, scale=scale),
             reinterpreted_batch_ndims=2
         )
         trait_samples = sampling_rv.sample(shape)
@@ -138,12 +202,10 @@ class IRTModel(BayesianModel):
         rv = tfd.Bernoulli(
             tf.ones_like(discrimination, dtype=self.dtype)*(1.0-sparsity))
         discrimination = discrimination*tf.cast(rv.sample(), dtype=self.dtype)
-        probs = self.grm_model_prob_d(
-            self.calibrated_expectations['abilities'],
-            discrimination,
-            self.calibrated_expectations['difficulties0'],
-            self.calibrated_expectations['ddifficulties']
-        )
+        items = {
+            k: self.calibrated_expectations[k] for k in self.item_vars}
+        items['discriminations'] = discrimination
+        probs = self.grm_model_prob_d(abilities=trait_samples, **items)
         response_rv = tfd.Categorical(
             probs=probs
         )
@@ -0,0 +1,128 @@
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from autoencirt.irt.moments import unwrap
+
+tfd = tfp.distributions
+
+
+class Flattener(object):
+    """Map a dict of tensors to one flat vector and back
+    """
+
+    def __init__(self, structure):
+        self.keys = list(structure.keys())
+        self.shapes = [structure[k].shape for k in self.keys]
+        self.sizes = [int(np.prod(s)) for s in self.shapes]
+
+    def flatten(self, structure):
+        return tf.concat(
+            [tf.reshape(structure[k], [-1]) for k in self.keys], axis=0)
+
+    def unflatten(self, vector):
+        parts = tf.split(vector, self.sizes)
+        return {
+            k: tf.reshape(p, s)
+            for k, p, s in zip(self.keys, parts, self.shapes)
+        }
+
+
+def block_probes(flattener, blocks=None):
+    """Indicator probes that read off a Hessian diagonal exactly
+
+    Entries of a variable along its axes in `blocks` must not interact,
+    e.g. the abilities of different people. Each probe is the indicator
+    of one index into the remaining axes of one variable, so H v at an
+    entry it covers is that entry's diagonal element. Variables without
+    blocks take one probe per element.
+
+    Args:
+        flattener (Flattener): layout of the flat vector
+        blocks (dict, optional): {variable: [axes]}. Defaults to None.
+
+    Yields:
+        np.ndarray: probes, every flat index is covered by exactly one
+    """
+    blocks = {} if blocks is None else blocks
+    dim = int(np.sum(flattener.sizes))
+    offset = 0
+    for k, shape, size in zip(
+            flattener.keys, flattener.shapes, flattener.sizes):
+        shape = [int(s) for s in shape]
+        axes = [a % len(shape) for a in blocks.get(k, [])]
+        other = [a for a in range(len(shape)) if a not in axes]
+        for index in np.ndindex(*[shape[a] for a in other]):
+            where = [slice(None)]*len(shape)
+            for a, j in zip(other, index):
+                where[a] = j
+            indicator = np.zeros(shape)
+            indicator[tuple(where)] = 1.
+            probe = np.zeros([dim])
+            probe[offset:(offset + size)] = indicator.ravel()
+            yield probe
+        offset += size
+
+
+def probe_diagonal(hvp_fn, probes, dtype):
+    """diag(H) as the sum of v*(H v) over non-overlapping block probes
+    """
+    total = None
+    for probe in probes:
+        v = tf.constant(probe, dtype=dtype)
+        term = v*hvp_fn(v)
+        total = term if total is None else total + term
+    return total
+
+
+def inverse_gamma_from_moments(mean, sd):
+    """(concentration, scale) of the InverseGamma with this mean and sd
+    """
+    concentration = 2. + (mean/sd)**2
+    return concentration, mean*(concentration - 1.)
+
+
+def _assign(variable, value):
+    # fixed (non-variable) parameters are left alone
+    if isinstance(variable, (tf.Variable, tfp.util.TransformedVariable)):
+        variable.assign(tf.cast(value, variable.dtype))
+
+
+def set_surrogate_from_laplace(surrogate_distribution, loc, scale,
+                               skip=None, min_location=1e-2):
+    """Move a factorized surrogate to a Laplace approximation
+
+    loc and scale live in the space of the surrogate base distributions,
+    i.e. before their bijectors. Normal bases take them directly,
+    InverseGamma bases are moment matched, with loc taken as the mean
+    and clipped to `min_location` since they are supported on the
+    positive reals.
+    Without scales only the locations move, and InverseGamma bases keep
+    their concentration and take loc as their mode.
+
+    Args:
+        surrogate_distribution (tfd.JointDistributionNamed):
+        loc (dict): unconstrained modes
+        scale (dict or None): unconstrained standard deviations
+        skip (list, optional): variables to leave alone. Defaults to None.
+        min_location (float, optional): Defaults to 1e-2.
+    """
+    skip = [] if skip is None else skip
+    for k, distribution in surrogate_distribution.model.items():
+        if k in skip or k not in loc:
+            continue
+        _, base = unwrap(distribution)
+        if isinstance(base, tfd.Normal):
+            _assign(base.loc, loc[k])
+            if scale is not None:
+                _assign(base.scale, scale[k])
+        elif isinstance(base, tfd.InverseGamma):
+            location = tf.maximum(loc[k], min_location)
+            if scale is None:
+                concentration = tf.convert_to_tensor(base.concentration)
+                _assign(base.scale, location*(concentration + 1.))
+            else:
+                concentration, ig_scale = inverse_gamma_from_moments(
+                    location, scale[k])
+                _assign(base.concentration, concentration)
+                _assign(base.scale, ig_scale)
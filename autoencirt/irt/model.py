@@ -1,6 +1,8 @@
 import inspect
+import os
+import time
+import warnings
 from itertools import cycle
-import dill
 import arviz as az
 
 import tensorflow as tf
@@ -8,15 +10,33 @@ import tensorflow as tf
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+import tensorflow_probability as tfp
 from functools import partial
 
 from tensorflow.python.data.ops.dataset_ops import BatchDataset
 from tensorflow.python.distribute.input_lib import DistributedDataset
 
 from bayesianquilts.util import (
-    clip_gradients, fit_surrogate_posterior,
-    run_chain, tf_data_cardinality)
-from bayesianquilts.distributions import FactorizedDistributionMoments
+    clip_gradients, run_chain, tf_data_cardinality)
+
+from autoencirt.irt.abilities import AbilityPage, StoreMoment
+from autoencirt.irt.advi import (
+    finite_gradients, fit_surrogate_posterior_minibatch)
+from autoencirt.irt.callbacks import (
+    ConvergenceMonitor, CoordinateUpdateCallback, TrainingState)
+from autoencirt.irt.compiled import (
+    TracedFunction, batch_signature, pad_batch, sample_signature,
+    tf_function)
+from autoencirt.irt.estimators import (
+    elementwise_negative_log_q, linear_control_variate, negative_log_q,
+    negative_log_q_terms)
+from autoencirt.irt.laplace import (
+    Flattener, block_probes, probe_diagonal, set_surrogate_from_laplace)
+from autoencirt.irt.moments import factorized_moments
+from autoencirt.irt.persistence import (
+    assign_surrogate_arrays, load_model, save_model, surrogate_arrays)
+from autoencirt.irt.planner import MemoryPlanner
+from autoencirt.irt.samples import PosteriorSampleStore
 
 
 class BayesianModel(object):
@@ -25,6 +45,14 @@ class BayesianModel(object):
     prior_distribution = None
     data = None
     var_list = []
+    local_vars = []
+    # local_vars kept in row stores (see abilities.AbilityStore) instead
+    # of the surrogate distribution
+    paged_vars = []
+    row_stores = None
+    parameter_groups = None
+    memory_planner = None
+    conjugate_vars = []
     bijectors = []
 
     def __init__(self, data=None, data_transform_fn=None,
@@ -34,11 +62,18 @@ class BayesianModel(object):
             data {[type]} -- [description]
         Keyword Arguments:
             data_transform_fn {[type]} -- [description] (default: {None})
-            strategy {[type]} -- [description] (default: {None})
+            strategy {tf.distribute.Strategy} -- Deprecated and unused,
+                data-parallel training goes through
+                calibrate_advi_distributed (default: {None})
         Raises:
             AttributeError: [description]
         """
         super(BayesianModel, self).__init__()
+        if strategy is not None:
+            warnings.warn(
+                "strategy is deprecated and ignored, use "
+                "distributed.calibrate_advi_distributed for data-parallel "
+                "training", DeprecationWarning, stacklevel=2)
         if data is not None and self.data is None:
             self.set_data(data, data_transform_fn)
 
@@ -69,14 +104,286 @@ class BayesianModel(object):
         self.data_cardinality = tf_data_cardinality(data)
         self.data_transform_fn = data_transform_fn
 
-    #  @tf.function
+    def _batch_data(self, data, data_batches, drop_remainder=True,
+                    pad=False):
+        """Batch a dataset unless it is batched already
+
+        With `pad` the last short batch is kept and padded with missing
+        responses, so that every batch has the same static shape.
+
+        Returns:
+            (tf.data.Dataset, int): batched dataset, number of batches
+        """
+        # check if data is batched
+        batched = False
+        root = False
+        up = data
+        while (not batched) and (not root):
+            if hasattr(up, "_batch_size"):
+                batched = True
+                break
+            if hasattr(up, "_input_dataset"):
+                up = up._input_dataset
+            else:
+                root = True
+
+        person_key = getattr(self, 'person_key', None)
+        if batched:
+            num_batches = int(tf_data_cardinality(data))
+            if pad:
+                batch_size = int(tf.nest.flatten(
+                    next(iter(data.take(1))))[0].shape[0])
+                data = data.map(
+                    lambda x: pad_batch(x, batch_size, person_key))
+            return data, max(num_batches, 1)
+
+        card = self.data_cardinality if data is self.data else None
+        if card is None:
+            card = tf_data_cardinality(data)
+        if card < 1:
+            print("We can't determine cardinality of the dataset, defaulting to batch size of 100")
+            batch_size = 100
+            num_batches = 1
+        else:
+            batch_size = max(int(np.floor(card/data_batches)), 1)
+            num_batches = int(card//batch_size)
+            if pad or not drop_remainder:
+                num_batches = int(np.ceil(card/batch_size))
+
+        if pad:
+            return data.batch(batch_size).map(
+                lambda x: pad_batch(x, batch_size, person_key)), num_batches
+        return data.batch(
+            batch_size, drop_remainder=drop_remainder), num_batches
+
+    def compiled_log_likelihood(self, batch_size, sample_size,
+                                jit_compile=True):
+        """log_likelihood as a tf.function with a fixed input signature
+
+        Batches must have exactly `batch_size` records (see pad_batch) and
+        parameters `sample_size` draws. Functions are cached per signature.
+
+        Returns:
+            TracedFunction: (batch, params) -> log likelihood per draw
+        """
+        if getattr(self, '_compiled_functions', None) is None:
+            self._compiled_functions = {}
+        key = ('log_likelihood', batch_size, sample_size, jit_compile)
+        if key not in self._compiled_functions:
+            self._compiled_functions[key] = TracedFunction(
+                lambda batch, params: self.log_likelihood(batch, **params),
+                input_signature=[
+                    batch_signature(self.data.element_spec, batch_size),
+                    sample_signature(
+                        self.surrogate_distribution, sample_size)],
+                jit_compile=jit_compile)
+        return self._compiled_functions[key]
+
+    def trace_statistics(self):
+        """Calls, traces and cache hits of the compiled functions
+        """
+        return {
+            k: f.stats() for k, f in getattr(
+                self, '_compiled_functions', {}).items()
+        }
+
+    def set_memory_budget(self, budget, **kwargs):
+        """Let a MemoryPlanner choose batch, chunk and split sizes
+
+        calibrate_advi, waic, score and log_likelihood follow the plan
+        instead of their data_batches/num_splits arguments.
+
+        Args:
+            budget (int or str): bytes, e.g. 2**32 or '4GB'. None removes
+                the budget.
+            **kwargs: passed on to MemoryPlanner
+        """
+        self.memory_planner = None if budget is None else (
+            MemoryPlanner.for_model(self, budget, **kwargs))
+
+    def _planner(self, memory_budget=None):
+        if memory_budget is not None:
+            return MemoryPlanner.for_model(self, memory_budget)
+        return self.memory_planner
+
+    def log_prior(self, params):
+        """Log prior density of a dict of (possibly batched) parameters
+        """
+        return self.joint_prior_distribution.log_prob(params)
+
+    def log_prior_terms(self, params):
+        """Log prior of each variable, summed over its elements
+        """
+        distributions, _ = (
+            self.joint_prior_distribution.sample_distributions(
+                value=params))
+        return {
+            k: distributions[k].log_prob(params[k]) for k in self.var_list
+            if k in params}
+
+    def local_log_prior(self, params):
+        """Elementwise log prior of each of local_vars
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} needs local_log_prior, the "
+            "elementwise log prior of its local_vars, for paged_vars")
+
+    def local_stores(self):
+        """{variable: row store} of the paged_vars
+        """
+        return {} if self.row_stores is None else dict(self.row_stores)
+
+    def _check_dense(self, method):
+        if len(self.local_stores()) > 0:
+            raise ValueError(
+                f"{method} needs the local variables in the surrogate, "
+                f"not in row stores ({', '.join(self.local_stores())})")
+
+    def conjugate_update(self):
+        """Closed-form coordinate updates of the conjugate_vars surrogates
+        """
+        pass
+
+    def conjugate_variables(self):
+        """Non-trainable variables set by conjugate_update
+        """
+        return []
+
+    def _variable_groups(self):
+        """{group: [surrogate variables]} from parameter_groups
+        """
+        if self.parameter_groups is None:
+            return None
+        model = self.surrogate_distribution.model
+        return {
+            name: [
+                v for k in keys if k in model
+                for v in model[k].trainable_variables]
+            for name, keys in self.parameter_groups.items()
+        }
+
+    def hessian_blocks(self):
+        """{variable: axes} along which its entries don't interact in the
+        posterior, see laplace.block_probes
+
+        Different people only meet through the global variables, so the
+        local_vars decouple along their leading axis.
+        """
+        return {k: [0] for k in self.local_vars}
+
+    def count_responses(self, batch):
+        """Number of observed responses in a batch, for throughput
+        """
+        return int(tf.shape(tf.nest.flatten(batch)[0])[0])
+
+    def _elbo_loss_fn(self, num_batches, sample_size=4,
+                      estimator='standard', control_variate=False,
+                      shard=None):
+        """Negative ELBO contribution of one batch, in three parts
+
+        The surrogate is sampled once per step by sample_fn. loss_fn gives
+        the likelihood term of a batch, or of a microbatch chunk of it,
+        so the chunks of a step share one draw, of which the likelihood
+        only gathers the chunk's ability rows. global_loss_fn gives the
+        prior and entropy, divided by the number of batches so that one
+        epoch of batch losses sums to the full negative ELBO.
+
+        On a data-parallel shard the global terms are further divided by
+        the number of workers, whose losses are summed. The local_vars of
+        a shard's model only hold the rows of the people it owns, so
+        their terms count in full.
+
+        Args:
+            estimator (str, optional): 'standard', 'stl' or 'analytic',
+                see estimators.negative_log_q. Defaults to 'standard'.
+            control_variate (bool, optional): Subtract a linear control
+                variate from the likelihood, costing one extra likelihood
+                gradient at the surrogate mean. Defaults to False.
+            shard (dict, optional): num_workers. Defaults to None.
+
+        Returns:
+            (callable, callable, callable): sample_fn() -> draws,
+                loss_fn(batch, draws) and global_loss_fn(draws), see
+                fit_surrogate_posterior_minibatch
+        """
+        def shard_terms(q_samples):
+            prior = self.log_prior_terms(q_samples)
+            entropy = negative_log_q_terms(
+                self.surrogate_distribution, q_samples, estimator)
+            global_terms = tf.add_n([
+                prior[k] + entropy[k] for k in self.var_list
+                if k not in self.local_vars])
+            local_terms = tf.add_n([
+                prior[k] + entropy[k] for k in self.local_vars])
+            return global_terms/shard['num_workers'] + local_terms
+
+        def sample_fn():
+            return self.surrogate_distribution.sample(sample_size)
+
+        def global_loss_fn(q_samples):
+            if shard is None:
+                prior_and_entropy = self.log_prior(q_samples) + (
+                    negative_log_q(
+                        self.surrogate_distribution, q_samples, estimator))
+            else:
+                prior_and_entropy = shard_terms(q_samples)
+            return -tf.reduce_mean(prior_and_entropy)/num_batches
+
+        def loss_fn(batch, q_samples):
+            log_likelihood = self.log_likelihood(batch, **q_samples)
+            if control_variate:
+                log_likelihood = log_likelihood - linear_control_variate(
+                    lambda params: self.log_likelihood(batch, **params),
+                    self.surrogate_distribution, q_samples)
+            return -tf.reduce_mean(log_likelihood)
+        return sample_fn, loss_fn, global_loss_fn
+
+    def _paged_elbo_loss_fn(self, num_batches, pages, sample_size=4,
+                            estimator='standard'):
+        """Negative ELBO of one batch with the local variables paged in
+
+        The person indices of the batch must already point into the pages.
+        Every person is in exactly one batch per epoch, so their prior and
+        entropy enter at full weight, while the global terms are divided by
+        the number of batches as in _elbo_loss_fn.
+
+        Args:
+            pages (dict): {variable: abilities.AbilityPage}
+        """
+        def loss_fn(batch):
+            q_samples = self.surrogate_distribution.sample(sample_size)
+            global_terms = self.log_prior(q_samples) + negative_log_q(
+                self.surrogate_distribution, q_samples, estimator)
+            local_q = {k: page.distribution() for k, page in pages.items()}
+            local_samples = {
+                k: q.sample(sample_size) for k, q in local_q.items()}
+            local_prior = self.local_log_prior(local_samples)
+            local_terms = tf.add_n([
+                tf.reduce_sum(
+                    local_prior[k] + elementwise_negative_log_q(
+                        local_q[k], local_samples[k], estimator),
+                    axis=[-4, -3, -2, -1])
+                for k in pages])
+            log_likelihood = self.log_likelihood(
+                batch, **q_samples, **local_samples)
+            elbo = log_likelihood + global_terms/num_batches + local_terms
+            return -tf.reduce_mean(elbo)
+        return loss_fn
+
     def calibrate_advi(
             self, num_epochs=100, learning_rate=0.1,
             opt=None, abs_tol=1e-10, rel_tol=1e-8,
             clip_value=5., max_decay_steps=25, lr_decay_factor=0.99,
             check_every=25, set_expectations=True, sample_size=4,
             data=None, data_batches=25, prefetch_batches=2,
-            **kwargs):
+            checkpoint_dir=None, checkpoint_every=1, max_to_keep=3,
+            checkpoint_steps=None, resume=True, nan_lr_factor=0.5,
+            max_rollbacks=5, num_samples=100, sample_mode='memmap',
+            sample_dir=None, callbacks=None, memory_budget=None,
+            compiled=False, estimator='standard', control_variate=False,
+            conjugate_every=1, prune_every=None, prune_kwargs=None,
+            microbatches=1, recompute=False, shard=None, convergence=None,
+            refine_epochs=0, decay_count=0, **kwargs):
         """Calibrate using ADVI
 
         Args:
@@ -94,66 +401,652 @@ class BayesianModel(object):
             data ([type], optional): [description]. Defaults to None.
             data_batches (int, optional): Ignored if data is already batched. 
                 Defaults to 25.
+            prefetch_batches (int, optional): Defaults to 2.
+            checkpoint_dir (str, optional): Checkpoint surrogate variables,
+                optimizer slots, learning-rate decay state and the position
+                in the epoch here, resuming from the latest checkpoint.
+                Defaults to None.
+            checkpoint_every (int, optional): Epochs between checkpoints.
+                Defaults to 1.
+            checkpoint_steps (int, optional): Also checkpoint every this
+                many batches within an epoch, so a resumed run continues
+                mid-epoch. Defaults to None.
+            max_to_keep (int, optional): Number of checkpoints retained.
+                Defaults to 3.
+            resume (bool, optional): Defaults to True.
+            nan_lr_factor (float, optional): On a non-finite loss roll back
+                to the last finite checkpoint and multiply the learning
+                rate by this. Defaults to 0.5.
+            max_rollbacks (int, optional): Defaults to 5.
+            num_samples (int, optional): Posterior draws kept in
+                surrogate_sample. Defaults to 100.
+            sample_mode (str, optional): 'memmap' spills per-person draws to
+                float32 memory-mapped files, 'summary' keeps only their
+                moments and quantiles. Defaults to 'memmap'.
+            sample_dir (str, optional): Where to spill per-person draws.
+                Defaults to a temporary directory.
+            callbacks (list, optional): autoencirt.irt.callbacks.Callback
+                instances, e.g. TelemetryCallback. Defaults to None.
+            memory_budget (int or str, optional): Choose data_batches with
+                a MemoryPlanner. Defaults to the budget from
+                set_memory_budget.
+            compiled (bool, optional): Pad batches to a fixed shape and
+                XLA-compile the loss and gradients against that input
+                signature, so the step is traced once. Defaults to False.
+            estimator (str, optional): Gradient estimator of the entropy
+                term. 'stl' (sticking-the-landing) and 'analytic' have
+                lower variance near the optimum and allow a smaller
+                sample_size. Defaults to 'standard'.
+            control_variate (bool, optional): Linear control variate on
+                the likelihood. Defaults to False.
+            conjugate_every (int, optional): Gradient steps between
+                closed-form updates of conjugate_vars, if the model has
+                any. Defaults to 1.
+            prune_every (int, optional): Train in rounds of this many
+                epochs and call prune_dimensions(**prune_kwargs) between
+                rounds. Each round continues the learning rate and decay
+                count of the last, while the convergence check starts a
+                new window, so rounds need at least 2*check_every epochs.
+                Can't be combined with checkpoint_dir. Defaults to None.
+            prune_kwargs (dict, optional): Defaults to None.
+            microbatches (int, optional): Evaluate each batch in this many
+                person chunks, one after the other, and accumulate their
+                gradients, so peak memory follows the chunk size while the
+                gradient uses the whole batch. Defaults to 1.
+            recompute (bool, optional): Recompute the response
+                probabilities in the backward pass instead of storing
+                them (gradient checkpointing). Defaults to False.
+            shard (dict, optional): Set by calibrate_advi_distributed on
+                each worker: num_workers and gradient_hook.
+                Defaults to None.
+            convergence (dict, optional): Stop early with a
+                ConvergenceMonitor built with these arguments, by default
+                once the smoothed loss and the item parameters settle. The
+                monitor is kept as self.convergence_monitor.
+                Defaults to None.
+            refine_epochs (int, optional): Afterwards train only the
+                local_vars (abilities) for up to this many epochs, with
+                the other surrogates held fixed. Defaults to 0.
+            decay_count (int, optional): Learning-rate decays already
+                taken, to continue an earlier run's schedule together
+                with its final learning_rate, see callbacks.TrainingState.
+                Defaults to 0.
+
+        With row stores (paged_vars) the people of each batch are paged in
+        and their rows updated by the store's lazy Adam, which can't be
+        combined with compiled, microbatches, control_variate,
+        prune_every or shard. The lazy Adam takes the current learning
+        rate, including rollback cuts, and skips steps and rows with
+        non-finite gradients, but a rollback does not restore rows
+        already written in the failed epoch.
         """
+        stores = self.local_stores()
+        if len(stores) > 1:
+            raise ValueError(
+                f"Only one row store is supported, got paged_vars "
+                f"{sorted(stores)}")
+        if len(stores) > 0 and (
+                compiled or microbatches > 1 or control_variate
+                or prune_every is not None or shard is not None):
+            raise ValueError(
+                "Paged local variables can't be combined with compiled, "
+                "microbatches, control_variate, prune_every or shard")
+        if prune_every is not None and checkpoint_dir is not None:
+            raise ValueError(
+                "prune_every changes the variables and can't be combined "
+                "with checkpoint_dir")
+        if prune_every is not None and prune_every < 2*check_every:
+            raise ValueError(
+                f"prune_every={prune_every} leaves no room for a "
+                f"convergence check, it needs at least 2*check_every="
+                f"{2*check_every} epochs")
         data = self.data if data is None else data
-        # check if data is batched
-        batched = False
-        root = False
-        up = data
-        while (not batched) and (not root):
-            if hasattr(up, "._batch_size"):
-                batch_size = up._batch_size
-                batched = True
-                break
-            if hasattr(up, "._input_dataset"):
-                up = up._input_dataset
-            else:
-                root = True
+        planner = self._planner(memory_budget)
+        if planner is not None:
+            plan = planner.plan_calibration(self, sample_size)
+            # the plan bounds the chunk, batches hold microbatches chunks
+            data_batches = int(np.ceil(plan['data_batches']/microbatches))
+            print(
+                f"Planned {data_batches} batches of {plan['batch_size']}, "
+                f"predicted peak {plan['predicted_bytes']/2**20:.0f} MiB")
+        _data, num_batches = self._batch_data(
+            data, data_batches, pad=compiled)
+        _data = _data.prefetch(prefetch_batches)
+        input_signature = _data.element_spec if compiled else None
 
-        if not batched:
-            _have_cardinality = False
-            card = self.data_cardinality
-            if card is None:
-                card = tf_data_cardinality(data)
-            if card < 1:
-                print("We can't determine cardinality of the dataset, defaulting to batch size of 100")
-                batch_size = 100
-            else:
-                batch_size = int(np.floor(card/data_batches))
+        callbacks = [] if callbacks is None else list(callbacks)
+        if convergence is not None:
+            def groups():
+                # pruning rebuilds the surrogate, so resolve every round
+                groups = self._variable_groups()
+                if groups is None:
+                    groups = {
+                        'all': self.surrogate_distribution.trainable_variables}
+                return groups
 
-            _data = data.batch(batch_size, drop_remainder=True)
-            # data = data.batch
+            self.convergence_monitor = ConvergenceMonitor(
+                groups, **convergence)
+            callbacks += [self.convergence_monitor]
+        checkpoint_objects = None
+        if len(self.conjugate_vars) > 0:
+            callbacks = [CoordinateUpdateCallback(
+                self.conjugate_update, conjugate_every)] + callbacks
+            checkpoint_objects = {'conjugate': self.conjugate_variables()}
 
-        _data = _data.prefetch(2)
+        pages = {k: AbilityPage(store) for k, store in stores.items()}
+        if len(pages) > 0:
+            page, = pages.values()
+            loss_fn = self._paged_elbo_loss_fn(
+                num_batches, pages, sample_size, estimator)
+            sample_fn = global_loss_fn = None
+        else:
+            page = None
+            # microbatches share the step's draw and its global terms
+            sample_fn, loss_fn, global_loss_fn = self._elbo_loss_fn(
+                num_batches, sample_size, estimator, control_variate,
+                shard)
 
-        def run_approximation(num_epochs):
-            losses = fit_surrogate_posterior(
-                target_log_prob_fn=self.unormalized_log_prob,
-                surrogate_posterior=self.surrogate_distribution,
+        def run_approximation(num_epochs, trainable_variables=None,
+                              callbacks=callbacks, checkpoint_dir=None,
+                              learning_rate=learning_rate,
+                              decay_count=decay_count):
+            if trainable_variables is None:
+                trainable_variables = (
+                    self.surrogate_distribution.trainable_variables)
+            losses = fit_surrogate_posterior_minibatch(
+                loss_fn=loss_fn,
+                trainable_variables=trainable_variables,
+                batched_dataset=_data,
                 num_epochs=num_epochs,
-                sample_size=sample_size,
                 learning_rate=learning_rate,
+                optimizer=opt,
                 max_decay_steps=max_decay_steps,
                 decay_rate=lr_decay_factor,
                 abs_tol=abs_tol,
                 rel_tol=rel_tol,
                 clip_value=clip_value,
                 check_every=check_every,
-                strategy=self.strategy,
-                batched_dataset=_data
+                checkpoint_dir=checkpoint_dir,
+                checkpoint_every=checkpoint_every,
+                checkpoint_steps=checkpoint_steps,
+                max_to_keep=max_to_keep,
+                resume=resume,
+                nan_lr_factor=nan_lr_factor,
+                max_rollbacks=max_rollbacks,
+                callbacks=callbacks,
+                checkpoint_objects=checkpoint_objects,
+                variable_groups=self._variable_groups(),
+                count_fn=self.count_responses,
+                jit_compile=compiled,
+                input_signature=input_signature,
+                microbatches=microbatches,
+                gradient_hook=(
+                    None if shard is None else shard['gradient_hook']),
+                local_variables=None if page is None else page.variables,
+                local_update=None if page is None else page.apply_gradients,
+                batch_fn=None if page is None else (
+                    lambda batch: page.page_in(batch, self.person_key)),
+                decay_count=decay_count,
+                sample_fn=sample_fn,
+                global_loss_fn=global_loss_fn
             )
             return(losses)
 
-        losses = run_approximation(num_epochs)
-        if set_expectations:
+        recompute_default = getattr(self, 'recompute', False)
+        self.recompute = recompute
+        try:
+            if prune_every is None:
+                losses = run_approximation(num_epochs, checkpoint_dir=(
+                    checkpoint_dir))
+            else:
+                losses = np.zeros([0])
+                schedule = TrainingState(learning_rate, decay_count)
+                while len(losses) < num_epochs:
+                    epochs = min(prune_every, num_epochs - len(losses))
+                    # continue the learning-rate schedule across rounds
+                    round_losses = run_approximation(
+                        epochs, callbacks=callbacks + [schedule],
+                        learning_rate=schedule.learning_rate,
+                        decay_count=schedule.decay_count)
+                    losses = np.concatenate([losses, round_losses])
+                    if len(round_losses) < epochs or not np.isfinite(
+                            round_losses[-1]):
+                        # converged or stopped
+                        break
+                    self.prune_dimensions(**(prune_kwargs or {}))
+            if refine_epochs > 0 and len(losses) > 0 and np.isfinite(
+                    losses[-1]):
+                print("Refining the abilities")
+                # local rows still train through the page with a row store
+                local = [
+                    v for k in self.local_vars
+                    if k in self.surrogate_distribution.model
+                    for v in self.surrogate_distribution.model[
+                        k].trainable_variables]
+                run_approximation(
+                    refine_epochs, trainable_variables=local, callbacks=[
+                        cb for cb in callbacks
+                        if not isinstance(cb, ConvergenceMonitor)])
+        finally:
+            self.recompute = recompute_default
+            for store in stores.values():
+                store.flush()
+        if set_expectations and len(losses) > 0:
             if (not np.isnan(losses[-1])) and (not np.isinf(losses[-1])):
-                self.surrogate_sample = self.surrogate_distribution.sample(100)
+                self.sample_posterior(
+                    num_samples, mode=sample_mode, directory=sample_dir)
                 self.set_calibration_expectations()
         return(losses)
 
+    def calibrate_advi_staged(
+            self, stages, learning_rate=0.1, data_batches=25, opt=None,
+            checkpoint_dir=None, set_expectations=True, num_samples=100,
+            sample_mode='memmap', sample_dir=None, **kwargs):
+        """Calibrate through a declarative sequence of ADVI stages
+
+        Each stage is a dict of calibrate_advi arguments overriding the
+        shared ones, typically num_epochs, learning_rate and data_batches,
+        e.g. ramping the batch size up while the learning rate goes down:
+
+            [{'num_epochs': 100, 'learning_rate': .01, 'data_batches': 10},
+             {'num_epochs': 100, 'learning_rate': .001, 'data_batches': 2}]
+
+        All stages share one optimizer, so its moment estimates carry over,
+        and the posterior is sampled and the expectations set only once at
+        the end instead of after every stage. A stage ends early on
+        convergence or when a callback stops it, and the next one starts
+        from there. A memory planner overrides the stages' data_batches.
+
+        Args:
+            stages (list): dicts of calibrate_advi arguments
+            learning_rate (float, optional): Defaults to 0.1.
+            data_batches (int, optional): Defaults to 25.
+            opt (tf.optimizers.Optimizer, optional): Defaults to Adam.
+            checkpoint_dir (str, optional): Stage j checkpoints to
+                checkpoint_dir/stage{j} and, once finished, leaves its
+                losses and surrogate there in done.npz. A resumed plan
+                restores the surrogate of the last finished stage, skips
+                the finished ones and resumes the next from its
+                checkpoint, or with fresh optimizer moments if it hadn't
+                saved one. Defaults to None.
+            set_expectations (bool, optional): Defaults to True.
+            num_samples (int, optional): Defaults to 100.
+            sample_mode (str, optional): Defaults to 'memmap'.
+            sample_dir (str, optional): Defaults to None.
+            **kwargs: shared calibrate_advi arguments
+
+        Returns:
+            list: losses of every stage
+        """
+        opt = tf.optimizers.Adam(learning_rate=learning_rate) if (
+            opt is None) else opt
+
+        def stage_dir(j):
+            return None if checkpoint_dir is None else os.path.join(
+                checkpoint_dir, f"stage{j}")
+
+        def marker(j):
+            return None if checkpoint_dir is None else os.path.join(
+                stage_dir(j), "done.npz")
+
+        finished = 0
+        while finished < len(stages) and marker(finished) is not None and (
+                os.path.exists(marker(finished))):
+            finished += 1
+        stage_losses = []
+        for j in range(finished):
+            with np.load(marker(j)) as done:
+                stage_losses += [done['losses']]
+                if j == finished - 1:
+                    assign_surrogate_arrays(self, {
+                        k.replace(".", "/"): done[k]
+                        for k in done.files if k.startswith("surrogate.")})
+        if finished > 0:
+            print(f"Resuming after {finished} finished stages")
+        for j, stage in enumerate(stages):
+            if j < finished:
+                continue
+            config = {
+                'learning_rate': learning_rate,
+                'data_batches': data_batches,
+                **kwargs,
+                **stage}
+            print(
+                f"Stage {j + 1}/{len(stages)}: "
+                f"learning rate {config['learning_rate']}, "
+                f"{config['data_batches']} batches")
+            losses = self.calibrate_advi(
+                opt=opt, set_expectations=False,
+                checkpoint_dir=stage_dir(j), **config)
+            stage_losses += [losses]
+            if len(losses) > 0 and not np.isfinite(losses[-1]):
+                print(f"Stopping after a non-finite loss in stage {j + 1}")
+                break
+            if marker(j) is not None:
+                # written whole, so a marker always belongs to a finished
+                # stage
+                os.makedirs(stage_dir(j), exist_ok=True)
+                with open(marker(j) + ".tmp", "wb") as file:
+                    np.savez(file, losses=np.asarray(losses), **{
+                        k.replace("/", "."): v
+                        for k, v in surrogate_arrays(self).items()})
+                os.replace(marker(j) + ".tmp", marker(j))
+        losses = stage_losses[-1] if len(stage_losses) > 0 else []
+        if set_expectations and len(losses) > 0 and np.isfinite(losses[-1]):
+            self.sample_posterior(
+                num_samples, mode=sample_mode, directory=sample_dir)
+            self.set_calibration_expectations()
+        return stage_losses
+
+    def calibrate_online(
+            self, stream, batch_size=1000, population_size=None,
+            learning_rate=0.05, forgetting_rate=0.6, delay=1.,
+            local_steps=10, local_learning_rate=0.1, sample_size=4,
+            estimator='standard', clip_value=5., max_batches=None,
+            opt=None, callbacks=None, set_expectations=True):
+        """Stochastic VI over an unbounded stream of per-person records
+
+        Each batch of new people first gets `local_steps` updates of only
+        their abilities, with the global surrogate fixed, and those rows
+        are written to the row store, which grows to hold every person
+        index seen. Then one step updates the global (item and horseshoe)
+        surrogate at the Robbins-Monro rate
+
+            learning_rate*(t + delay)**-forgetting_rate
+
+        with forgetting_rate in (0.5, 1], so that the item bank tracks the
+        stream without refitting. The likelihood is scaled to a population
+        of `population_size`, by default the number of people seen so far.
+
+        Args:
+            stream (tf.data.Dataset or iterable): unbatched records, or
+                batches of records if not a Dataset
+            batch_size (int, optional): Defaults to 1000.
+            population_size (int, optional): Defaults to None.
+            learning_rate (float, optional): Defaults to 0.05.
+            forgetting_rate (float, optional): Defaults to 0.6.
+            delay (float, optional): Defaults to 1..
+            local_steps (int, optional): Defaults to 10.
+            local_learning_rate (float, optional): Defaults to 0.1.
+            sample_size (int, optional): Defaults to 4.
+            estimator (str, optional): Defaults to 'standard'.
+            clip_value (float, optional): Defaults to 5..
+            max_batches (int, optional): Stop after this many batches.
+                Defaults to None (until the stream ends).
+            opt (tf.optimizers.Optimizer, optional): Defaults to Adam.
+            callbacks (list, optional): Step hooks only, stop_training is
+                honored. Defaults to None.
+            set_expectations (bool, optional): Defaults to True.
+
+        Returns:
+            np.ndarray: loss per batch
+        """
+        stores = self.local_stores()
+        if len(stores) != 1:
+            raise ValueError(
+                "calibrate_online needs one row store, see use_ability_store")
+        store, = stores.values()
+        page = AbilityPage(store)
+        pages = {k: page for k in stores}
+        num_batches = tf.Variable(1., dtype=store.dtype, trainable=False)
+        loss_fn = self._paged_elbo_loss_fn(
+            num_batches, pages, sample_size, estimator)
+        global_variables = list(
+            self.surrogate_distribution.trainable_variables)
+        if opt is None:
+            opt = tf.optimizers.Adam(learning_rate=learning_rate)
+
+        def clip(grads):
+            if clip_value is None:
+                return grads
+            return [
+                None if g is None else tf.clip_by_value(
+                    g, -clip_value, clip_value) for g in grads]
+
+        def local_step(batch):
+            with tf.GradientTape() as tape:
+                loss = loss_fn(batch)
+            grads = clip(tape.gradient(loss, page.variables))
+            return loss, grads, finite_gradients(loss, grads)
+
+        def global_step(batch):
+            with tf.GradientTape() as tape:
+                loss = loss_fn(batch)
+            grads = clip(tape.gradient(loss, global_variables))
+            return loss, grads, finite_gradients(loss, grads)
+
+        local_step = tf_function(local_step)
+        global_step = tf_function(global_step)
+
+        if isinstance(stream, tf.data.Dataset):
+            stream = stream.batch(batch_size)
+        callbacks = [] if callbacks is None else list(callbacks)
+        for cb in callbacks:
+            cb.on_train_begin({'num_variables': len(global_variables)})
+        if len(self.conjugate_vars) > 0:
+            self.conjugate_update()
+        losses = []
+        skipped = 0
+        for t, batch in enumerate(stream):
+            if max_batches is not None and t >= max_batches:
+                break
+            t0 = time.perf_counter()
+            batch = tf.nest.map_structure(tf.convert_to_tensor, batch)
+            people = batch[self.person_key].numpy()
+            store.grow(int(np.max(people)) + 1)
+            self.num_people = store.num_people
+            size = len(people)
+            num_batches.assign(
+                (store.num_people if population_size is None
+                 else population_size)/max(size, 1))
+            batch = page.page_in(batch, self.person_key)
+            for _ in range(local_steps):
+                _, grads, finite = local_step(batch)
+                if not bool(finite):
+                    break
+                page.apply_gradients(grads, local_learning_rate)
+                page.refresh()
+            opt.learning_rate = float(
+                learning_rate*(t + delay)**(-forgetting_rate))
+            loss, grads, finite = global_step(batch)
+            if not bool(finite):
+                skipped += 1
+                continue
+            opt.apply_gradients([
+                (g, v) for g, v in zip(grads, global_variables)
+                if g is not None])
+            if len(self.conjugate_vars) > 0:
+                self.conjugate_update()
+            losses += [float(loss.numpy())]
+            logs = {
+                'step': t,
+                'loss': losses[-1],
+                'step_time': time.perf_counter() - t0,
+                'num_responses': self.count_responses(batch),
+                'learning_rate': float(tf.convert_to_tensor(
+                    opt.learning_rate).numpy()),
+                'num_people': int(store.num_people)
+            }
+            for cb in callbacks:
+                cb.on_step_end(t, logs)
+            if any(cb.stop_training for cb in callbacks):
+                break
+        store.flush()
+        if skipped > 0:
+            print(f"Skipped {skipped} batches with non-finite gradients")
+        for cb in callbacks:
+            cb.on_train_end({'batches': len(losses) + skipped})
+        if set_expectations and len(losses) > 0:
+            self.set_calibration_expectations()
+        return np.array(losses)
+
+    def calibrate_map(
+            self, data=None, data_batches=1, max_iterations=500,
+            tolerance=1e-8, init_state=None, hessian=True,
+            min_precision=1e-2, max_scale=1., set_surrogate=True):
+        """MAP by L-BFGS on the unconstrained joint density, then a
+        Laplace warm start for calibrate_advi
+
+        The objective is -log p(data, T(u)) - log|det dT/du| over all the
+        data, with T the model's bijectors. `data_batches` only splits the
+        computation; every L-BFGS evaluation sees the full data set. The
+        exact Hessian diagonal gives the surrogate scales. It is read off
+        with one Hessian-vector product per probe of block_probes over
+        hessian_blocks, e.g. one per ability dimension for all people
+        at once.
+
+        Args:
+            data (tf.data.Dataset, optional): Defaults to self.data.
+            data_batches (int, optional): Defaults to 1.
+            max_iterations (int, optional): Defaults to 500.
+            tolerance (float, optional): Gradient tolerance. Defaults to
+                1e-8.
+            init_state (dict, optional): Constrained starting point.
+                Defaults to calibrated_expectations.
+            hessian (bool, optional): False only moves the locations.
+                Defaults to True.
+            min_precision (float, optional): Floor on the Hessian diagonal.
+                Defaults to 1e-2.
+            max_scale (float, optional): Cap on the surrogate scales.
+                Defaults to 1..
+            set_surrogate (bool, optional): Move the surrogate to the
+                Laplace approximation. Defaults to True.
+
+        Returns:
+            dict: converged, num_iterations, objective, and the
+                constrained MAP estimate under 'map'
+        """
+        self._check_dense("calibrate_map")
+        data = self.data if data is None else data
+        _data, _ = self._batch_data(
+            data, data_batches, drop_remainder=False)
+        if init_state is None:
+            init_state = self.calibrated_expectations
+        var_list = [
+            k for k in self.var_list if k not in self.conjugate_vars]
+        position = {
+            k: self.bijectors[k].inverse(
+                tf.cast(np.asarray(init_state[k]), self.dtype))
+            for k in var_list
+        }
+        flat = Flattener(position)
+
+        def negative_log_density(u, batch, prior=True):
+            unconstrained = flat.unflatten(u)
+            params = {
+                k: self.bijectors[k].forward(v)[tf.newaxis, ...]
+                for k, v in unconstrained.items()}
+            if len(self.conjugate_vars) > 0:
+                # the conjugate auxiliaries enter at their surrogate means
+                params = {**params, **{
+                    k: tf.cast(self.calibrated_expectations[k], self.dtype)[
+                        tf.newaxis, ...]
+                    for k in self.conjugate_vars}}
+            value = tf.reduce_sum(self.log_likelihood(batch, **params))
+            if prior:
+                value += tf.reduce_sum(self.log_prior(params))
+                value += tf.add_n([
+                    tf.reduce_sum(self.bijectors[k].forward_log_det_jacobian(
+                        v, event_ndims=0))
+                    for k, v in unconstrained.items()])
+            return -value
+
+        def value_and_gradients(u):
+            total = tf.zeros([], dtype=self.dtype)
+            grad = tf.zeros_like(u)
+            for j, batch in enumerate(_data):
+                with tf.GradientTape() as tape:
+                    tape.watch(u)
+                    value = negative_log_density(u, batch, prior=(j == 0))
+                total += value
+                grad += tape.gradient(value, u)
+            return total, grad
+
+        result = tfp.optimizer.lbfgs_minimize(
+            value_and_gradients,
+            initial_position=flat.flatten(position),
+            tolerance=tolerance,
+            max_iterations=max_iterations)
+        mode = result.position
+        print(
+            f"L-BFGS {'converged' if bool(result.converged) else 'stopped'}"
+            f" after {int(result.num_iterations)} iterations, "
+            f"objective {float(result.objective_value):.6g}")
+
+        if set_surrogate:
+            scale = None
+            if hessian:
+                def hvp(v):
+                    total = tf.zeros_like(mode)
+                    for j, batch in enumerate(_data):
+                        with tf.GradientTape() as outer:
+                            outer.watch(mode)
+                            with tf.GradientTape() as inner:
+                                inner.watch(mode)
+                                value = negative_log_density(
+                                    mode, batch, prior=(j == 0))
+                            grad = inner.gradient(value, mode)
+                        total += outer.gradient(
+                            grad, mode, output_gradients=v)
+                    return total
+                diagonal = probe_diagonal(
+                    hvp, block_probes(flat, self.hessian_blocks()),
+                    self.dtype)
+                scale = flat.unflatten(tf.minimum(
+                    tf.math.rsqrt(tf.maximum(diagonal, min_precision)),
+                    max_scale))
+            set_surrogate_from_laplace(
+                self.surrogate_distribution, flat.unflatten(mode), scale,
+                skip=self.conjugate_vars)
+            if len(self.conjugate_vars) > 0:
+                self.conjugate_update()
+            self.set_calibration_expectations()
+
+        return {
+            'converged': bool(result.converged),
+            'num_iterations': int(result.num_iterations),
+            'objective': float(result.objective_value),
+            'map': {
+                k: self.bijectors[k].forward(v)
+                for k, v in flat.unflatten(mode).items()}
+        }
+
+    def sample_posterior(
+            self, num_samples=100, mode='memmap', directory=None,
+            chunk_size=10000):
+        """Draw surrogate_sample into a PosteriorSampleStore
+
+        Args:
+            num_samples (int, optional): Defaults to 100.
+            mode (str, optional): 'memmap' or 'summary'. Defaults to 'memmap'.
+            directory (str, optional): Defaults to None.
+            chunk_size (int, optional): People per sampling chunk.
+                Defaults to 10000.
+
+        Returns:
+            PosteriorSampleStore: also stored as self.surrogate_sample
+        """
+        self.surrogate_sample = PosteriorSampleStore(
+            self.surrogate_distribution, num_samples=num_samples,
+            local_vars=self.local_vars, mode=mode, directory=directory,
+            chunk_size=chunk_size, local_distributions=self.local_stores())
+        return self.surrogate_sample
+
     def set_calibration_expectations(self, samples=50, variational=True):
+        """Set calibrated_expectations and calibrated_sd
+
+        Args:
+            samples (int, optional): Monte Carlo draws, only used for
+                surrogate families without closed-form or quadrature
+                moments. Defaults to 50.
+            variational (bool, optional): Use the surrogate distribution
+                rather than surrogate_sample. Defaults to True.
+
+        The expectations of the paged_vars stay in their row stores, as
+        lazy abilities.StoreMoment views.
+        """
         if variational:
-            mean, var = FactorizedDistributionMoments(
+            mean, var = factorized_moments(
                 self.surrogate_distribution, samples=samples)
             self.calibrated_expectations = {
                 k: tf.Variable(v) for k, v in mean.items()
@@ -161,6 +1054,18 @@ class BayesianModel(object):
             self.calibrated_sd = {
                 k: tf.Variable(tf.math.sqrt(v)) for k, v in var.items()
             }
+            for k, store in self.local_stores().items():
+                self.calibrated_expectations[k] = StoreMoment(store, 'mean')
+                self.calibrated_sd[k] = StoreMoment(store, 'stddev')
+        elif isinstance(self.surrogate_sample, PosteriorSampleStore):
+            self.calibrated_expectations = {
+                k: tf.Variable(self.surrogate_sample.mean(k))
+                for k in self.surrogate_sample.variables
+            }
+            self.calibrated_sd = {
+                k: tf.Variable(self.surrogate_sample.sd(k))
+                for k in self.surrogate_sample.variables
+            }
         else:
             self.calibrated_expectations = {
                 k: tf.Variable(tf.reduce_mean(v, axis=0))
@@ -174,12 +1079,22 @@ class BayesianModel(object):
 
     def calibrate_mcmc(self, data=None, num_steps=1000, burnin=500,
                        init_state=None, step_size=1e-1, nuts=True,
-                       num_leapfrog_steps=10, clip=None):
+                       num_leapfrog_steps=10, clip=None, blocked=False,
+                       **kwargs):
         """Calibrate using HMC/NUT
         Keyword Arguments:
             num_chains {int} -- [description] (default: {1})
+            blocked {bool} -- Use the model's blocked sampler,
+                calibrate_mcmc_blocked, instead of one joint kernel over
+                every variable. Extra keyword arguments go to it
+                (default: {False})
         """
+        if blocked:
+            return self.calibrate_mcmc_blocked(
+                data=data, num_steps=num_steps, burnin=burnin,
+                init_state=init_state, **kwargs)
 
+        self._check_dense("calibrate_mcmc")
         if init_state is None:
             init_state = self.calibrated_expectations
 
@@ -215,6 +1130,13 @@ class BayesianModel(object):
 
         return samples, sampler_stat
 
+    def calibrate_mcmc_blocked(self, *args, **kwargs):
+        """Metropolis-within-Gibbs exploiting the model's conditional
+        independence
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} has no blocked sampler")
+
     def log_likelihood(self, *args, **kwargs):
         pass
 
@@ -244,79 +1166,107 @@ class BayesianModel(object):
                 k: v for k, v in zip(
                     likelihood_vars, split)} for split in zip(*splits)]
 
+    def _likelihood_vars(self, params):
+        # drop self and the data argument
+        likelihood_vars = inspect.getfullargspec(
+            self.log_likelihood).args[2:]
+        if len(likelihood_vars) == 0:
+            likelihood_vars = list(params.keys())
+        return likelihood_vars
+
+    def _param_splits(self, params, likelihood_vars, num_splits, batch):
+        """Yield (params, batch) pairs that together cover all draws
+
+        Per-person draws held in a PosteriorSampleStore are gathered for
+        the people in the batch only, and the batch is re-indexed to match.
+        """
+        if isinstance(params, PosteriorSampleStore):
+            local = [v for v in likelihood_vars if params.is_local(v)]
+            people = None
+            if len(local) > 0:
+                person_key = self.person_key
+                people = batch[person_key].numpy().astype(np.int64)
+                batch = {
+                    **batch,
+                    person_key: tf.range(
+                        len(people), dtype=batch[person_key].dtype)
+                }
+            for start, stop in params.sample_splits(num_splits):
+                yield {
+                    v: tf.convert_to_tensor(
+                        params.gather(
+                            v, rows=people if v in local else None,
+                            start=start, stop=stop))
+                    for v in likelihood_vars
+                }, batch
+            return
+        S = int(tf.shape(params[likelihood_vars[0]])[0])
+        edges = np.linspace(0, S, min(num_splits, S) + 1).astype(int)
+        for start, stop in zip(edges[:-1], edges[1:]):
+            yield {
+                v: params[v][start:stop] for v in likelihood_vars
+            }, batch
+
     def waic(
             self, data=None, params=None, num_samples=100,
-            num_splits=20, data_batches=25):
-        data = self.data if data is None else data
-        # check if data is batched
-        batched = False
-        root = False
-        up = data
-        while (not batched) and (not root):
-            if hasattr(up, "._batch_size"):
-                batch_size = up._batch_size
-                batched = True
-                break
-            if hasattr(up, "._input_dataset"):
-                up = up._input_dataset
-            else:
-                root = True
+            num_splits=20, data_batches=25, memory_budget=None):
+        """Widely applicable information criterion
 
-        if not batched:
-            card = tf.data.experimental.cardinality(data)
-            batch_size = int(np.floor(card/data_batches))
-            data = data.batch(batch_size, drop_remainder=True)
-            # data = data.batch
+        Accumulated one batch of people, and one split of posterior draws,
+        at a time.
 
-        data = data.prefetch(2)
-        
-        likelihood_vars = inspect.getfullargspec(
-            self.log_likelihood).args[1:]
+        Args:
+            data (tf.data.Dataset, optional): Defaults to self.data.
+            params (dict or PosteriorSampleStore, optional): Posterior
+                draws. Defaults to self.surrogate_sample.
+            num_samples (int, optional): Draws taken if there are no
+                params. Defaults to 100.
+            num_splits (int, optional): Defaults to 20.
+            data_batches (int, optional): Defaults to 25.
+            memory_budget (int or str, optional): Choose num_splits and
+                data_batches with a MemoryPlanner. Defaults to the budget
+                from set_memory_budget.
 
-        # split param samples
+        Returns:
+            dict: waic, se, lppd, pwaic
+        """
+        data = self.data if data is None else data
         params = self.surrogate_sample if params is None else params
-        if 'data' in likelihood_vars:
-            likelihood_vars.remove('data')
-        params = self.surrogate_distribution.sample(num_samples) if (
-            params is None) else params
-        if len(likelihood_vars) == 0:
-            likelihood_vars = params.keys()
-        if 'data' in likelihood_vars:
-            likelihood_vars.remove('data')
-        splits = [
-            tf.split(
-                params[v],
-                num_splits) for v in likelihood_vars]
+        if params is None:
+            params = self.surrogate_distribution.sample(num_samples)
+        likelihood_vars = self._likelihood_vars(params)
+        missing = [v for v in likelihood_vars if v not in params]
+        if len(missing) > 0:
+            raise ValueError(
+                f"waic needs posterior draws of {', '.join(missing)}, "
+                "sample them with sample_posterior(mode='memmap') or pass "
+                "params; mode='summary' only keeps their moments")
 
-        # reshape the splits
-        splits = [
-            {
-                k: v for k, v in zip(
-                    likelihood_vars, split)} for split in zip(*splits)]
-        """
-        if not isinstance(data, BatchDataset):
-            N = list(data.shape)[0]
-            data = tf.data.Dataset.from_tensor_slices(data)
-            data = data.batch(int(N/num_splits))
-        """
+        planner = self._planner(memory_budget)
+        if planner is not None:
+            plan = planner.plan_waic(
+                self, int(params[likelihood_vars[0]].shape[0]))
+            num_splits = plan['num_splits']
+            data_batches = plan['data_batches']
+
+        data, _ = self._batch_data(data, data_batches, drop_remainder=False)
+        data = data.prefetch(2)
 
-        sum_S_log_likelihoods = 0.
-        sum_N_log_likelihoods = 0.
-        sum_S_sq_log_likes = 0.
-        sum_N_sq_log_likes = 0.
-        sum_S_likelihoods = 0.
-        sum_N_likelihoods = 0.
+        lppd = 0.
+        pwaic = 0.
+        sum_elpd = 0.
+        sum_sq_elpd = 0.
         N = 0
-        S = tf.shape(tf.nest.flatten(params)[0])[0]
 
         for batch in data:
             # This should have shape S x N, where S is the number of param
             # samples and N is the batch size
             batch_log_likelihoods = [
                 self.log_likelihood(
-                    **this_split, data=batch
+                    this_batch, **this_split, reduce_batch=False
                 )
-                for this_split in splits
+                for this_split, this_batch in self._param_splits(
+                    params, likelihood_vars, num_splits, batch)
             ]
             batch_log_likelihoods = tf.concat(
                 batch_log_likelihoods, axis=0
@@ -326,57 +1276,86 @@ class BayesianModel(object):
                 batch_log_likelihoods,
                 tf.zeros_like(batch_log_likelihoods))
             min_val = tf.math.reduce_min(finite_part)
-            #  batch_ll = tf.clip_by_value(batch_ll, min_val-1000, 0.)
             batch_log_likelihoods = tf.where(
                 tf.math.is_finite(batch_log_likelihoods),
                 batch_log_likelihoods,
                 tf.ones_like(batch_log_likelihoods)*min_val - 1000.
             )
             batch_log_likelihoods = tf.cast(batch_log_likelihoods, tf.float64)
-            sum_S_log_likelihoods = sum_S_log_likelihoods + tf.reduce_sum(
-                batch_log_likelihoods, axis=0)
-            sum_N_log_likelihoods = sum_N_log_likelihoods + tf.reduce_sum(
-                batch_log_likelihoods, axis=1)
-            sum_S_sq_log_likes = sum_S_sq_log_likes + tf.reduce_sum(
-                batch_log_likelihoods**2, axis=0)
-            sum_N_sq_log_likes = sum_N_sq_log_likes + tf.reduce_sum(
-                batch_log_likelihoods**2, axis=1)
-            sum_S_likelihoods = sum_S_likelihoods + tf.reduce_sum(
-                tf.math.exp(batch_log_likelihoods), axis=0)
-            sum_N_likelihoods = sum_N_likelihoods + tf.reduce_sum(
-                tf.math.exp(batch_log_likelihoods), axis=1)
-            N += tf.shape(tf.nest.flatten(batch)[0])[0]
-
-        # These stats are over the samples
-        mean_S_likelihood = (
-            sum_S_likelihoods/tf.cast(N, sum_S_likelihoods.dtype))
-        lppdi = tf.math.log(
-            tf.cast(mean_S_likelihood, tf.float64)
-        )
-        lppd = tf.reduce_sum(lppdi).numpy()
-
-        mean_sq_S_log_likelihood = (
-            sum_S_sq_log_likes/tf.cast(N, sum_S_sq_log_likes.dtype))
-        mean__S_log_likelihood = (
-            sum_S_log_likelihoods/tf.cast(N, sum_S_log_likelihoods.dtype))
-        pwaici = mean_sq_S_log_likelihood - mean__S_log_likelihood**2
+            S = tf.cast(tf.shape(batch_log_likelihoods)[0], tf.float64)
 
-        pwaic = tf.reduce_sum(pwaici).numpy()
+            # pointwise statistics over the samples
+            lppdi = tf.math.reduce_logsumexp(
+                batch_log_likelihoods, axis=0) - tf.math.log(S)
+            pwaici = tf.math.reduce_variance(batch_log_likelihoods, axis=0)
+            elpdi = lppdi - pwaici
 
-        elpdi = lppdi-pwaici
+            lppd += tf.reduce_sum(lppdi).numpy()
+            pwaic += tf.reduce_sum(pwaici).numpy()
+            sum_elpd += tf.reduce_sum(elpdi).numpy()
+            sum_sq_elpd += tf.reduce_sum(elpdi**2).numpy()
+            N += int(tf.shape(batch_log_likelihoods)[1])
 
         waic = 2*(-lppd + pwaic)
-
-        se = 2.0*tf.math.sqrt(
-            tf.cast(N, tf.float64) *
-            tf.cast(tf.math.reduce_variance(elpdi), dtype=tf.float64))
+        var_elpd = sum_sq_elpd/N - (sum_elpd/N)**2
+        se = 2.0*np.sqrt(N*var_elpd)
 
         return {
-            'waic': waic, 'se': se.numpy(), 'lppd': lppd, 'pwaic': pwaic}
+            'waic': waic, 'se': se, 'lppd': lppd, 'pwaic': pwaic}
 
-    def save(self, filename="model_save.pkl"):
-        with open(filename, 'wb') as file:
-            dill.dump(self, file)
+    def save(self, path="model_save", include_samples=False,
+             sample_dtype=None):
+        """Save to a versioned directory of typed arrays
+
+        Args:
+            path (str, optional): Output directory. Defaults to "model_save".
+            include_samples (bool, optional): Also store surrogate_sample.
+                Defaults to False.
+            sample_dtype (str, optional): Cast stored draws, e.g. 'float32'.
+                Defaults to None.
+        """
+        save_model(
+            self, path, include_samples=include_samples,
+            sample_dtype=sample_dtype)
+
+    @classmethod
+    def load(cls, path="model_save", mmap_mode="r", load_samples=True):
+        """Load a model written by `save` without re-sampling the surrogate
+
+        Args:
+            path (str, optional): Directory written by `save`.
+                Defaults to "model_save".
+            mmap_mode (str, optional): Memory-map the stored expectations
+                and draws, None reads them into memory. Defaults to "r".
+            load_samples (bool, optional): Defaults to True.
+
+        Returns:
+            BayesianModel: the saved model
+        """
+        model = load_model(
+            path, mmap_mode=mmap_mode, load_samples=load_samples)
+        if not isinstance(model, cls):
+            raise TypeError(
+                f"{path} holds a {type(model).__name__}, not a {cls.__name__}")
+        return model
+
+    def get_config(self):
+        """JSON-serializable constructor arguments used by `save`
+
+        The constructor arguments of a model can't be recovered from its
+        variables, so every saveable subclass implements this, see
+        IRTModel.get_config.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} can't be saved, it needs to implement "
+            "get_config and _init_from_config")
+
+    def _init_from_config(self, config):
+        """Rebuild structure (but not values) from `get_config` output
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} can't be loaded, it needs to implement "
+            "_init_from_config to rebuild itself from get_config")
 
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -412,6 +1391,7 @@ class BayesianModel(object):
                     if not isinstance(state[k], tf.dtypes.DType):
                         del state[k]
         state['strategy'] = None
+        state.pop('_compiled_functions', None)
         return(state)
 
     def unormalized_log_prob_list(self, data, params):
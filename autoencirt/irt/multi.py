@@ -0,0 +1,433 @@
+import numpy as np
+import tensorflow as tf
+
+from autoencirt.irt.grm import GRModel
+from autoencirt.irt.moments import factorized_moments, unwrap
+from autoencirt.irt.persistence import (
+    assign_surrogate_arrays, surrogate_arrays)
+from bayesianquilts.util import tf_data_cardinality
+
+
+class MultiGRModel(GRModel):
+    """Many independent graded response instruments calibrated as one model
+
+    The items of all instruments are laid end to end along the item axis
+    and their people along the person axis, and every instrument has its
+    own global horseshoe scales xi and xi_a, so the joint density is the
+    product of the instruments' GRM densities. Records keep the instrument
+    index and its responses padded to the longest instrument; item
+    parameters are gathered per record, so a batch costs
+    people x max_items whatever the number of instruments. Categories are
+    padded to the largest cardinality, and a mask sets the probability of
+    the categories an item does not have to zero. One calibrate_advi run
+    then fits every instrument in the same vectorized steps.
+
+    Args:
+        instruments (list): one dict per instrument with item_keys,
+            num_people, data (tf.data.Dataset, optional),
+            response_cardinality (default 5), person_key (default
+            'person') and name (default 'instrument<b>'). Person indices
+            are local to each instrument.
+        seed (int, optional): seed for interleaving the instruments'
+            records. Defaults to None.
+
+    The remaining arguments are those of GRModel, shared by all
+    instruments.
+    """
+    person_key = "person"
+    instruments = None
+    instrument_data = None
+
+    def __init__(self, instruments, dim=1, decay=0.25,
+                 positive_discriminations=True, missing_val=-9999,
+                 xi_scale=1e-2, eta_scale=1e-2, kappa_scale=1e-2,
+                 weight_exponent=1.0, dtype=tf.float64,
+                 factor_init='pairwise', seed=None):
+        instruments = [dict(x) for x in instruments]
+        data = [x.pop('data', None) for x in instruments]
+        layout = self._set_layout(instruments)
+        self.instrument_data = data
+        merged = None
+        if any(d is not None for d in data):
+            if any(d is None for d in data):
+                raise ValueError("Either every instrument has data or none")
+            merged = self._merge_data(seed)
+        super(MultiGRModel, self).__init__(
+            data=merged, dim=dim, decay=decay,
+            positive_discriminations=positive_discriminations,
+            missing_val=missing_val, xi_scale=xi_scale,
+            eta_scale=eta_scale, kappa_scale=kappa_scale,
+            weight_exponent=weight_exponent, dtype=dtype,
+            factor_init=factor_init, **layout)
+
+    def _set_layout(self, instruments):
+        """Offsets, padding and masks of the stacked instruments
+
+        Returns:
+            dict: item_keys, num_people, response_cardinality and
+                person_key of the combined model
+        """
+        specs = []
+        for b, x in enumerate(instruments):
+            specs += [{
+                'name': x.get('name', f"instrument{b}"),
+                'item_keys': list(x['item_keys']),
+                'num_people': int(x['num_people']),
+                'response_cardinality': int(
+                    x.get('response_cardinality', 5)),
+                'person_key': x.get('person_key', 'person')
+            }]
+        names = [x['name'] for x in specs]
+        if len(set(names)) < len(names):
+            raise ValueError("Instrument names must be unique")
+        self.instruments = specs
+        self.num_instruments = len(specs)
+        self.num_scale_groups = len(specs)
+
+        num_items = [len(x['item_keys']) for x in specs]
+        cardinality = [x['response_cardinality'] for x in specs]
+        self.item_offsets = np.cumsum([0] + num_items)
+        self.person_offsets = np.cumsum(
+            [0] + [x['num_people'] for x in specs])
+        self.max_items = max(num_items)
+        K = max(cardinality)
+
+        self.item_groups = np.repeat(
+            np.arange(len(specs)), num_items).astype(np.int32)
+        # padded slots point at item 0, their responses are missing
+        self.item_index = np.zeros(
+            (len(specs), self.max_items), dtype=np.int32)
+        self.category_mask = np.zeros((sum(num_items), K - 1))
+        for b, (I, K_b) in enumerate(zip(num_items, cardinality)):
+            start = self.item_offsets[b]
+            self.item_index[b, :I] = np.arange(start, start + I)
+            self.category_mask[start:(start + I), :(K_b - 1)] = 1.
+        return {
+            'item_keys': [
+                f"{x['name']}/{k}" for x in specs for k in x['item_keys']],
+            'num_people': int(self.person_offsets[-1]),
+            'response_cardinality': K,
+            'person_key': self.person_key
+        }
+
+    def instrument_index(self, instrument):
+        """Position of an instrument given by name or position
+        """
+        if isinstance(instrument, str):
+            return [x['name'] for x in self.instruments].index(instrument)
+        return int(instrument)
+
+    def _instrument_data(self, b):
+        """Calibration records of instrument b, absent after loading
+        """
+        if self.instrument_data[b] is None:
+            raise ValueError(
+                f"Instrument {self.instruments[b]['name']} has no data, "
+                "as after loading a saved model. Pass its records, e.g. "
+                "waic(data={name: dataset}).")
+        return self.instrument_data[b]
+
+    def instrument_dataset(self, instrument, data=None):
+        """Records of one instrument in the stacked layout
+
+        Each record holds the global person index, the instrument and its
+        responses padded with missing values to max_items.
+
+        Args:
+            data (tf.data.Dataset, optional): records in the instrument's
+                own format. Defaults to its calibration data.
+        """
+        b = self.instrument_index(instrument)
+        spec = self.instruments[b]
+        data = self._instrument_data(b) if data is None else data
+        offset = int(self.person_offsets[b])
+        padding = self.max_items - len(spec['item_keys'])
+
+        def stack(x):
+            responses = tf.stack(
+                [tf.cast(x[k], tf.int32) for k in spec['item_keys']])
+            return {
+                self.person_key: tf.cast(
+                    x[spec['person_key']], tf.int64) + offset,
+                'instrument': tf.constant(b, dtype=tf.int32),
+                'responses': tf.pad(
+                    responses, [[0, padding]], constant_values=-1)
+            }
+        return data.map(stack)
+
+    def _merge_data(self, seed=None):
+        """All instruments' records, interleaved at random so that every
+        batch mixes instruments in proportion to their size
+        """
+        parts = [
+            self.instrument_dataset(b) for b in range(self.num_instruments)]
+        sizes = np.array(
+            [tf_data_cardinality(d) for d in self.instrument_data],
+            dtype=np.float64)
+        merged = tf.data.experimental.sample_from_datasets(
+            parts, weights=list(sizes/np.sum(sizes)), seed=seed)
+        return merged.apply(
+            tf.data.experimental.assert_cardinality(int(np.sum(sizes))))
+
+    def count_responses(self, batch):
+        return int(tf.reduce_sum(
+            tf.cast(batch['responses'] >= 0, tf.int64)))
+
+    def _record_index(self, responses):
+        # padded records have instrument -1
+        instruments = tf.maximum(
+            tf.cast(responses['instrument'], tf.int32), 0)
+        return tf.gather(self.item_index, instruments)
+
+    @staticmethod
+    def _gather_items(value, index):
+        """... x 1 x D x I x K item parameters at B x I' record slots,
+        ... x B x D x I' x K
+        """
+        rank = len(value.shape)
+        value = tf.squeeze(
+            tf.gather(value, index, axis=rank - 2), axis=rank - 4)
+        return tf.transpose(
+            value,
+            list(range(rank - 4)) + [rank - 3, rank - 4, rank - 2, rank - 1])
+
+    def response_choices(self, responses):
+        return responses['responses']
+
+    def record_items(self, responses, items):
+        index = self._record_index(responses)
+        records = {
+            k: self._gather_items(v, index) for k, v in items.items()}
+        records['category_mask'] = tf.cast(
+            tf.gather(self.category_mask, index),
+            items['discriminations'].dtype)[:, tf.newaxis, ...]
+        return records
+
+    def item_totals(self, responses, log_probs):
+        index = self._record_index(responses)
+        rank = len(log_probs.shape)
+        totals = tf.math.unsorted_segment_sum(
+            tf.transpose(
+                log_probs, [rank - 2, rank - 1] + list(range(rank - 2))),
+            index, self.num_items)
+        return tf.transpose(totals, list(range(1, rank - 1)) + [0])
+
+    def factor_analysis(self, polychoric=False, batch_size=10000,
+                        min_pairs=5, seed_surrogate=True):
+        """GRModel.factor_analysis of every instrument on its own
+        """
+        B = self.num_instruments
+        self.item_correlation = [None]*B
+        self.factor_loadings = [None]*B
+        self.item_thresholds = [None]*B
+        for b, spec in enumerate(self.instruments):
+            solution = self._factor_solution(
+                self._instrument_data(b), spec['item_keys'],
+                spec['response_cardinality'], polychoric, batch_size,
+                min_pairs)
+            if solution is not None:
+                (self.item_correlation[b], self.factor_loadings[b],
+                 self.item_thresholds[b]) = solution
+        if seed_surrogate:
+            self.set_surrogate_from_factors()
+
+    def set_surrogate_from_factors(self):
+        model = self.surrogate_distribution.model
+        bases = {
+            k: unwrap(model[k])[1] for k in [
+                'discriminations', 'difficulties0', 'mu', 'ddifficulties']
+            if k in model}
+        locations = {
+            k: tf.convert_to_tensor(base.loc).numpy()
+            for k, base in bases.items()}
+        for b in range(self.num_instruments):
+            if self.factor_loadings[b] is None:
+                continue
+            start, stop = self.item_offsets[b:(b + 2)]
+            factor_locations = self._factor_locations(
+                self.factor_loadings[b], self.item_thresholds[b])
+            for k, loc in factor_locations.items():
+                if k in locations:
+                    width = loc.shape[-1]
+                    locations[k][..., start:stop, :width] = loc.numpy()
+        for k, base in bases.items():
+            base.loc.assign(locations[k])
+
+    def instrument_slice(self, instrument, k, value):
+        """The part of variable k belonging to one instrument
+
+        Works on anything indexed like the variable over its last four
+        axes, e.g. surrogate parameters, expectations and draws.
+        """
+        b = self.instrument_index(instrument)
+        everything = slice(None)
+        people = slice(
+            int(self.person_offsets[b]), int(self.person_offsets[b + 1]))
+        items = slice(
+            int(self.item_offsets[b]), int(self.item_offsets[b + 1]))
+        if k == 'abilities':
+            index = (
+                people,
+                everything, everything, everything)
+        elif k in ['xi', 'xi_a']:
+            index = (everything, everything, slice(b, b + 1), everything)
+        else:
+            categories = everything
+            if k == 'ddifficulties':
+                categories = slice(
+                    0, self.instruments[b]['response_cardinality'] - 2)
+            index = (everything, everything, items, categories)
+        return value[(Ellipsis,) + index]
+
+    def instrument_model(self, instrument):
+        """A GRModel of one instrument with its part of the calibration
+
+        Surrogate parameters, calibrated expectations and posterior draws
+        are sliced out of this model, so the result can be scored,
+        saved or calibrated further on its own.
+
+        Returns:
+            GRModel
+        """
+        self._check_dense("instrument_model")
+        b = self.instrument_index(instrument)
+        spec = self.instruments[b]
+        model = GRModel(
+            item_keys=spec['item_keys'], num_people=spec['num_people'],
+            data=self.instrument_data[b],
+            response_cardinality=spec['response_cardinality'],
+            person_key=spec['person_key'], dim=self.dimensions,
+            decay=self.dimensional_decay,
+            positive_discriminations=self.positive_discriminations,
+            missing_val=self.missing_val, xi_scale=self.xi_scale,
+            eta_scale=self.eta_scale, kappa_scale=self.kappa_scale,
+            weight_exponent=self.weight_exponent, dtype=self.dtype,
+            factor_init=None)
+        if self.hybrid:
+            model.enable_conjugate_updates()
+        assign_surrogate_arrays(model, {
+            name: self.instrument_slice(b, name.split("/")[1], value)
+            for name, value in surrogate_arrays(self).items()})
+        if self.calibrated_expectations is not None:
+            model.calibrated_expectations = {
+                k: tf.Variable(self.instrument_slice(b, k, v))
+                for k, v in self.calibrated_expectations.items()}
+            model.calibrated_sd = {
+                k: tf.Variable(self.instrument_slice(b, k, v))
+                for k, v in self.calibrated_sd.items()}
+        if self.surrogate_sample is not None:
+            # memory-mapped draws are read for this instrument's rows only
+            model.surrogate_sample = {
+                k: np.asarray(self.instrument_slice(
+                    b, k, self.surrogate_sample[k]))
+                for k in self.surrogate_sample}
+        return model
+
+    def score(self, responses, instrument=None, **kwargs):
+        """GRModel.score per instrument
+
+        Args:
+            responses (dict): {instrument: people x items responses}, or
+                one response matrix with `instrument`
+            instrument (str or int, optional): Defaults to None.
+
+        Returns:
+            dict: {name: (mean, std, w, trait_samples)}, or one tuple
+        """
+        if instrument is not None:
+            return self.instrument_model(instrument).score(
+                responses, **kwargs)
+        return {
+            self.instruments[self.instrument_index(k)]['name']:
+                self.score(v, instrument=k, **kwargs)
+            for k, v in responses.items()}
+
+    def waic(self, data=None, params=None, instrument=None, **kwargs):
+        """BayesianModel.waic per instrument
+
+        All instruments are evaluated on the same posterior draws.
+
+        Args:
+            data (dict, optional): {instrument: tf.data.Dataset} in the
+                instruments' own formats, or one dataset with
+                `instrument`. Defaults to the calibration data.
+            instrument (str or int, optional): Defaults to None.
+
+        Returns:
+            dict: {name: waic dict}, or one waic dict
+        """
+        params = self.surrogate_sample if params is None else params
+        if params is None:
+            params = self.surrogate_distribution.sample(
+                kwargs.pop('num_samples', 100))
+        if instrument is not None:
+            return super(MultiGRModel, self).waic(
+                data=self.instrument_dataset(instrument, data),
+                params=params, **kwargs)
+        data = {} if data is None else {
+            self.instrument_index(k): v for k, v in data.items()}
+        return {
+            spec['name']: self.waic(
+                data=data.get(b), params=params, instrument=b, **kwargs)
+            for b, spec in enumerate(self.instruments)}
+
+    def collapsed_dimensions_by_instrument(
+            self, xi_threshold=1e-2, weight_threshold=2e-2):
+        """GRModel.collapsed_dimensions of every instrument
+
+        Returns:
+            np.ndarray: boolean mask, instruments x dimensions
+        """
+        mean, _ = factorized_moments(self.surrogate_distribution)
+        xi = mean['xi'].numpy()[0, :, :, 0].T
+        weights = np.abs(
+            mean['discriminations'].numpy()[0, ..., 0])**self.weight_exponent
+        weights = weights/np.sum(weights, axis=0, keepdims=True)
+        strongest = np.stack([
+            np.max(weights[:, start:stop], axis=1)
+            for start, stop in zip(
+                self.item_offsets[:-1], self.item_offsets[1:])])
+        return (xi < xi_threshold) & (strongest < weight_threshold)
+
+    def collapsed_dimensions(self, xi_threshold=1e-2, weight_threshold=2e-2):
+        """Dimensions that have collapsed in every instrument
+
+        Returns:
+            np.ndarray: boolean mask over dimensions
+        """
+        return np.all(self.collapsed_dimensions_by_instrument(
+            xi_threshold, weight_threshold), axis=0)
+
+    def prune_dimensions(self, *args, **kwargs):
+        """The instruments share their dimensions, prune an
+        instrument_model instead
+        """
+        raise NotImplementedError(
+            "The instruments of a MultiGRModel share their dimensions, "
+            "prune an instrument_model instead")
+
+    def calibrate_advi(self, *args, prune_every=None, **kwargs):
+        """GRModel.calibrate_advi, without prune_every
+        """
+        if prune_every is not None:
+            raise ValueError(
+                "The instruments of a MultiGRModel share their dimensions "
+                "and can't be pruned in calibrate_advi, calibrate and "
+                "prune an instrument_model instead")
+        return super(MultiGRModel, self).calibrate_advi(*args, **kwargs)
+
+    def get_config(self):
+        config = super(MultiGRModel, self).get_config()
+        for k in [
+                'item_keys', 'num_people', 'response_cardinality',
+                'person_key']:
+            config.pop(k)
+        config['instruments'] = [dict(x) for x in self.instruments]
+        return config
+
+    def _init_from_config(self, config):
+        config = dict(config)
+        instruments = config.pop('instruments')
+        self.instrument_data = [None]*len(instruments)
+        config.update(self._set_layout(instruments))
+        super(MultiGRModel, self)._init_from_config(config)
@@ -0,0 +1,205 @@
+import importlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from autoencirt.irt.abilities import StoreMoment
+
+FORMAT_NAME = "autoencirt-model"
+FORMAT_VERSION = 1
+HEADER_FILE = "header.json"
+
+
+def _to_numpy(x):
+    if isinstance(x, (tf.Tensor, tf.Variable)):
+        return x.numpy()
+    return np.asarray(x)
+
+
+def _class_path(obj):
+    cls = obj.__class__
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _resolve_class(path):
+    module, _, name = path.rpartition(".")
+    return getattr(importlib.import_module(module), name)
+
+
+def _array_file(name):
+    return name.replace("/", ".") + ".npy"
+
+
+def surrogate_arrays(model):
+    """Variational parameters of a model, keyed by variable name
+
+    Args:
+        model (BayesianModel): model with a JointDistributionNamed surrogate
+
+    Returns:
+        dict: {'surrogate/<var>/<i>': np.ndarray} in the order of
+            `surrogate_distribution.model[var].variables`
+    """
+    arrays = {}
+    for k in model.var_list:
+        for j, v in enumerate(model.surrogate_distribution.model[k].variables):
+            arrays[f"surrogate/{k}/{j}"] = v.numpy()
+    return arrays
+
+
+def assign_surrogate_arrays(model, arrays):
+    """Inverse of `surrogate_arrays`, assigns in place
+    """
+    for k in model.var_list:
+        variables = model.surrogate_distribution.model[k].variables
+        for j, v in enumerate(variables):
+            name = f"surrogate/{k}/{j}"
+            if name not in arrays:
+                raise KeyError(f"{name} is missing from the saved model")
+            v.assign(np.asarray(arrays[name], dtype=v.dtype.as_numpy_dtype))
+
+
+def save_model(model, path, include_samples=False, sample_dtype=None):
+    """Write a model to a directory of typed .npy arrays plus a json header
+
+    Args:
+        model (BayesianModel): model implementing `get_config`
+        path (str): directory to write, created if needed
+        include_samples (bool, optional): Also store `surrogate_sample`.
+            Defaults to False.
+        sample_dtype (str, optional): Cast stored draws, e.g. 'float32'.
+            Defaults to None (keep dtype).
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = surrogate_arrays(model)
+    # the expectations of paged variables are kept by their stores
+    stores = model.local_stores()
+    if getattr(model, "calibrated_expectations", None) is not None:
+        for k, v in model.calibrated_expectations.items():
+            if k not in stores:
+                arrays[f"expectations/{k}"] = _to_numpy(v)
+    if getattr(model, "calibrated_sd", None) is not None:
+        for k, v in model.calibrated_sd.items():
+            if k not in stores:
+                arrays[f"sd/{k}"] = _to_numpy(v)
+    samples = getattr(model, "surrogate_sample", None)
+    if include_samples and samples is not None:
+        for k in model.var_list:
+            if k not in samples.keys():
+                continue
+            v = _to_numpy(samples[k])
+            if sample_dtype is not None:
+                v = v.astype(sample_dtype)
+            arrays[f"samples/{k}"] = v
+
+    header = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "class": _class_path(model),
+        "config": model.get_config(),
+        "var_list": list(model.var_list),
+        "arrays": {},
+        "stores": {}
+    }
+    for name, value in arrays.items():
+        fname = _array_file(name)
+        np.save(os.path.join(path, fname), value, allow_pickle=False)
+        header["arrays"][name] = {
+            "file": fname,
+            "dtype": str(value.dtype),
+            "shape": list(value.shape)
+        }
+    for k, store in model.local_stores().items():
+        directory = f"store.{k}"
+        store.save(os.path.join(path, directory))
+        header["stores"][k] = {
+            "class": _class_path(store),
+            "directory": directory
+        }
+    # header last so that a partially written directory is not loadable
+    with open(os.path.join(path, HEADER_FILE), "w") as file:
+        json.dump(header, file, indent=1)
+
+
+def read_header(path):
+    with open(os.path.join(path, HEADER_FILE), "r") as file:
+        header = json.load(file)
+    if header.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not a saved autoencirt model")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(
+            f"{path} has format version {header['version']}, "
+            f"this version of autoencirt reads up to {FORMAT_VERSION}")
+    return header
+
+
+def load_arrays(path, header=None, prefix=None, mmap_mode="r"):
+    header = read_header(path) if header is None else header
+    arrays = {}
+    for name, meta in header["arrays"].items():
+        if prefix is not None and not name.startswith(prefix):
+            continue
+        arrays[name] = np.load(
+            os.path.join(path, meta["file"]),
+            mmap_mode=mmap_mode, allow_pickle=False)
+    return arrays
+
+
+def load_model(path, mmap_mode="r", load_samples=True):
+    """Rebuild a model saved with `save_model`, without re-sampling
+
+    Args:
+        path (str): directory written by `save_model`
+        mmap_mode (str, optional): numpy memmap mode for the stored
+            expectations and draws, None reads them into memory. Row
+            stores are always memory-mapped, read-write for None.
+            Defaults to "r".
+        load_samples (bool, optional): Attach stored draws as
+            `surrogate_sample`. Defaults to True.
+
+    Returns:
+        BayesianModel: the reconstituted model
+    """
+    header = read_header(path)
+    model_class = _resolve_class(header["class"])
+    model = model_class.__new__(model_class)
+    model._init_from_config(header["config"])
+
+    arrays = load_arrays(path, header, mmap_mode=mmap_mode)
+    assign_surrogate_arrays(
+        model,
+        {k: v for k, v in arrays.items() if k.startswith("surrogate/")})
+
+    def strip(prefix):
+        return {
+            k[len(prefix):]: v for k, v in arrays.items()
+            if k.startswith(prefix)}
+
+    # row stores stay on disk, opened in place
+    store_mode = "r+" if mmap_mode is None else mmap_mode
+    stores = {
+        k: _resolve_class(meta["class"]).open(
+            os.path.join(path, meta["directory"]), mmap_mode=store_mode,
+            model_dtype=model.dtype)
+        for k, meta in header.get("stores", {}).items()}
+    if len(stores) > 0:
+        model.row_stores = stores
+
+    expectations = strip("expectations/")
+    sd = strip("sd/")
+    if mmap_mode is None:
+        expectations = {k: tf.Variable(v) for k, v in expectations.items()}
+        sd = {k: tf.Variable(v) for k, v in sd.items()}
+    if len(expectations) > 0:
+        for k, store in stores.items():
+            expectations[k] = StoreMoment(store, 'mean')
+            sd[k] = StoreMoment(store, 'stddev')
+    model.calibrated_expectations = expectations
+    model.calibrated_sd = sd
+
+    samples = strip("samples/")
+    if load_samples and len(samples) > 0:
+        model.surrogate_sample = samples
+    return model
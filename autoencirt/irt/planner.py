@@ -0,0 +1,152 @@
+import re
+
+import numpy as np
+
+_UNITS = {
+    '': 1, 'b': 1,
+    'k': 2**10, 'kb': 2**10, 'kib': 2**10,
+    'm': 2**20, 'mb': 2**20, 'mib': 2**20,
+    'g': 2**30, 'gb': 2**30, 'gib': 2**30,
+    't': 2**40, 'tb': 2**40, 'tib': 2**40,
+}
+
+
+def parse_bytes(budget):
+    """Bytes from an int or a string such as '512MB' or '4 GiB'
+    """
+    if isinstance(budget, (int, np.integer, float)):
+        return int(budget)
+    match = re.fullmatch(
+        r"\s*([0-9.]+)\s*([a-zA-Z]*)\s*", str(budget))
+    if match is None or match.group(2).lower() not in _UNITS:
+        raise ValueError(f"Can't parse memory budget {budget}")
+    return int(float(match.group(1))*_UNITS[match.group(2).lower()])
+
+
+class MemoryPlanner(object):
+    """Predict peak intermediate sizes of the GRM entry points and pick
+    batch, chunk and split sizes that fit an explicit memory budget
+
+    The largest intermediates of the graded response likelihood have shape
+    samples x people x D x I x K. `intermediate_factor` counts how many
+    such tensors are alive at once in the forward pass (offsets, logits,
+    the two pads, probabilities and weights), and `gradient_factor` the
+    extra cost of keeping them for backpropagation.
+    """
+
+    def __init__(
+            self, budget, itemsize=8, intermediate_factor=8.,
+            gradient_factor=2., min_batch_size=1):
+        """
+        Args:
+            budget (int or str): bytes, or a string such as '4GB'
+            itemsize (int, optional): bytes per element. Defaults to 8.
+            intermediate_factor (float, optional): Defaults to 8..
+            gradient_factor (float, optional): Defaults to 2..
+            min_batch_size (int, optional): Defaults to 1.
+        """
+        self.budget = parse_bytes(budget)
+        self.itemsize = itemsize
+        self.intermediate_factor = intermediate_factor
+        self.gradient_factor = gradient_factor
+        self.min_batch_size = min_batch_size
+
+    @classmethod
+    def for_model(cls, model, budget, **kwargs):
+        return cls(budget, itemsize=model.dtype.size, **kwargs)
+
+    @staticmethod
+    def _shapes(model):
+        return (
+            int(model.num_people), int(model.dimensions),
+            int(model.num_items), int(model.response_cardinality))
+
+    def likelihood_bytes(self, model, samples, batch_size, training=False):
+        """Predicted peak bytes of one log_likelihood call
+        """
+        _, D, I, K = self._shapes(model)
+        factor = self.intermediate_factor*(
+            self.gradient_factor if training else 1.)
+        return int(factor*samples*batch_size*D*I*K*self.itemsize)
+
+    def calibration_bytes(self, model, sample_size, batch_size):
+        """Predicted peak bytes of one ADVI step
+
+        Every step also draws the full ability array for each sample.
+        """
+        N, D, _, _ = self._shapes(model)
+        fixed = 4*sample_size*N*D*self.itemsize
+        return fixed + self.likelihood_bytes(
+            model, sample_size, batch_size, training=True)
+
+    def _max_elements(self, model, budget, training=False):
+        _, D, I, K = self._shapes(model)
+        factor = self.intermediate_factor*(
+            self.gradient_factor if training else 1.)
+        return int(budget//(factor*D*I*K*self.itemsize))
+
+    def likelihood_chunk(self, model, samples, batch_size):
+        """Largest person chunk for which log_likelihood fits the budget
+        """
+        chunk = self._max_elements(model, self.budget, training=True)//max(
+            samples, 1)
+        return int(np.clip(chunk, self.min_batch_size, batch_size))
+
+    def plan_calibration(self, model, sample_size):
+        """Returns:
+            dict: batch_size, data_batches, predicted_bytes. Batching N
+                people into data_batches batches never makes them larger
+                than batch_size.
+        """
+        N, D, _, _ = self._shapes(model)
+        fixed = 4*sample_size*N*D*self.itemsize
+        if fixed >= self.budget:
+            raise MemoryError(
+                f"Sampling {sample_size} ability draws for {N} people "
+                f"needs {fixed} bytes, more than the budget of {self.budget}")
+        batch_size = self._max_elements(
+            model, self.budget - fixed, training=True)//sample_size
+        batch_size = int(np.clip(batch_size, self.min_batch_size, N))
+        return {
+            'batch_size': batch_size,
+            # rounded up, so that N/data_batches never exceeds batch_size
+            'data_batches': int(np.ceil(N/batch_size)),
+            'predicted_bytes': self.calibration_bytes(
+                model, sample_size, batch_size)
+        }
+
+    def plan_waic(self, model, num_samples, min_batch_size=256):
+        """Returns:
+            dict: data_batches, num_splits, predicted_bytes
+        """
+        N, _, _, _ = self._shapes(model)
+        elements = max(self._max_elements(model, self.budget), 1)
+        min_batch_size = min(min_batch_size, N)
+        # prefer all draws at once, then wide batches
+        split_size = int(np.clip(
+            elements//max(min_batch_size, 1), 1, num_samples))
+        batch_size = int(np.clip(elements//split_size, 1, N))
+        return {
+            'data_batches': int(np.ceil(N/batch_size)),
+            'num_splits': int(np.ceil(num_samples/split_size)),
+            'predicted_bytes': self.likelihood_bytes(
+                model, split_size, batch_size)
+        }
+
+    def plan_score(self, model, num_responses, trait_samples, num_draws):
+        """Returns:
+            dict: num_splits over posterior draws, response_chunk,
+                predicted_bytes
+        """
+        _, D, I, K = self._shapes(model)
+        half = self.budget//2
+        per_draw = self.intermediate_factor*trait_samples*D*I*K*self.itemsize
+        split_size = int(np.clip(half//per_draw, 1, num_draws))
+        per_response = self.intermediate_factor*trait_samples*I*self.itemsize
+        response_chunk = int(np.clip(half//per_response, 1, num_responses))
+        return {
+            'num_splits': int(np.ceil(num_draws/split_size)),
+            'response_chunk': response_chunk,
+            'predicted_bytes': int(
+                split_size*per_draw + response_chunk*per_response)
+        }
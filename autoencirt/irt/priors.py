@@ -0,0 +1,61 @@
+import numpy as np
+import tensorflow as tf
+
+EVENT_AXES = [-4, -3, -2, -1]
+
+
+def normal_log_prob(x, loc, scale):
+    z = (x - loc)/scale
+    return -0.5*z**2 - (0.5*np.log(2.*np.pi) + tf.math.log(scale))
+
+
+def half_normal_log_prob(x, scale):
+    z = x/scale
+    log_prob = 0.5*np.log(2./np.pi) - tf.math.log(scale) - 0.5*z**2
+    return tf.where(
+        x < 0, tf.constant(-np.inf, dtype=log_prob.dtype), log_prob)
+
+
+def inverse_gamma_log_prob(x, concentration, scale):
+    return (
+        concentration*tf.math.log(scale) - tf.math.lgamma(concentration)
+        - (concentration + 1.)*tf.math.log(x) - scale/x)
+
+
+def sqrt_inverse_gamma_log_prob(x, concentration, scale):
+    """Density of sqrt(Y) with Y ~ InverseGamma(concentration, scale), as
+    bayesianquilts' SqrtInverseGamma
+    """
+    return inverse_gamma_log_prob(x**2, concentration, scale) + (
+        np.log(2.) + tf.math.log(x))
+
+
+def horseshoe_log_prob(x, scale):
+    """Horseshoe(scale) log density
+
+    The marginal has no closed form, this is the approximation of
+    tfd.Horseshoe.log_prob, term for term.
+    """
+    xx = (x/scale)**2/2
+    g = 0.5614594835668851
+    b = 1.0420764938351215
+    h_inf = 1.0801359952503342
+    q = 20./47.*xx**1.0919284281983377
+    h = 1./(1 + xx**1.5) + h_inf*q/(1 + q)
+    c = -0.5*np.log(2*np.pi**3) - tf.math.log(g*scale)
+    z = np.log1p(-g) - np.log(g)
+    return -tf.math.softplus(z - xx/(1 - g)) + tf.math.log(
+        tf.math.log1p(g/xx - (1 - g)/(h + b*xx)**2)) + c
+
+
+def abs_horseshoe_log_prob(x, scale):
+    """Density of |Y| with Y ~ Horseshoe(scale), as bayesianquilts'
+    AbsHorseshoe
+    """
+    return np.log(2.) + horseshoe_log_prob(tf.math.abs(x), scale)
+
+
+def event_sum(log_prob):
+    """Sum over the four reinterpreted event axes of the IRT variables
+    """
+    return tf.reduce_sum(log_prob, axis=EVENT_AXES)
@@ -0,0 +1,234 @@
+import os
+import shutil
+import tempfile
+import weakref
+from collections.abc import Mapping
+
+import arviz as az
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+tfd = tfp.distributions
+
+
+def _sample_rows(distribution, start, stop, num_samples, seed=None):
+    """Draw `num_samples` of rows [start, stop) of a per-person surrogate
+
+    Factorized Normal surrogates (optionally behind a bijector) are sliced
+    so that only the requested rows are ever sampled. Anything else falls
+    back to a full draw that is then sliced.
+
+    An integer seed is combined with `start` into a stateless seed, so
+    every chunk gets its own, reproducible draws.
+    """
+    if seed is not None:
+        seed = tfp.random.sanitize_seed([seed, start])
+    bijector = None
+    inner = distribution
+    if isinstance(inner, tfd.TransformedDistribution):
+        bijector = inner.bijector
+        inner = inner.distribution
+    if isinstance(inner, tfd.Independent):
+        inner = inner.distribution
+    if isinstance(inner, tfd.Normal):
+        loc = tf.convert_to_tensor(inner.loc)[start:stop]
+        scale = tf.convert_to_tensor(inner.scale)[start:stop]
+        draw = tfd.Normal(loc=loc, scale=scale).sample(num_samples, seed=seed)
+        if bijector is not None:
+            draw = bijector.forward(draw)
+        return draw
+    return distribution.sample(num_samples, seed=seed)[:, start:stop]
+
+
+class PosteriorSampleStore(Mapping):
+    """Posterior draws with per-person variables kept out of RAM
+
+    Global variables are sampled and held in memory at the model dtype.
+    Per-person (local) variables are sampled a chunk of people at a time and
+    either spilled to float32 memory-mapped files (`mode='memmap'`), or
+    reduced to their mean, standard deviation and quantiles
+    (`mode='summary'`). Summaries are computed in both modes. Local draws
+    are not available in summary mode.
+
+    Behaves as a read-only dict of draws, so existing code indexing
+    `surrogate_sample[k]` keeps working.
+    """
+
+    def __init__(
+            self, surrogate_distribution, num_samples=100, local_vars=None,
+            mode='memmap', directory=None, chunk_size=10000,
+            quantiles=(0.025, 0.5, 0.975), local_dtype='float32',
+            seed=None, local_distributions=None):
+        """Draw and store samples from a factorized surrogate
+
+        Args:
+            surrogate_distribution (tfd.JointDistributionNamed): factorized
+                surrogate posterior
+            num_samples (int, optional): Defaults to 100.
+            local_vars (list, optional): Variables whose leading axis
+                indexes people. Defaults to None.
+            mode (str, optional): 'memmap' or 'summary'.
+                Defaults to 'memmap'.
+            directory (str, optional): Where to spill local draws. A
+                temporary directory removed with the store if None.
+            chunk_size (int, optional): People per sampling chunk.
+                Defaults to 10000.
+            quantiles (tuple, optional): Defaults to (0.025, 0.5, 0.975).
+            local_dtype (str, optional): Defaults to 'float32'.
+            seed (int, optional): Defaults to None.
+            local_distributions (dict, optional): Per-person variables
+                kept outside of the surrogate, e.g. {'abilities':
+                AbilityStore}. Defaults to None.
+        """
+        if mode not in ('memmap', 'summary'):
+            raise ValueError("mode must be 'memmap' or 'summary'")
+        self.num_samples = int(num_samples)
+        self.mode = mode
+        self.chunk_size = int(chunk_size)
+        self.quantile_levels = np.array(quantiles, dtype=np.float64)
+        self.local_dtype = np.dtype(local_dtype)
+        self.local_vars = [] if local_vars is None else list(local_vars)
+        self.directory = None
+        self.dtypes = {}
+        self._memory = {}
+        self._memmap = {}
+        self._summaries = {}
+
+        model = dict(surrogate_distribution.model)
+        if local_distributions is not None:
+            model.update(local_distributions)
+            self.local_vars += [
+                k for k in local_distributions if k not in self.local_vars]
+        self.variables = list(model.keys())
+
+        if mode == 'memmap':
+            if directory is None:
+                directory = tempfile.mkdtemp(prefix="autoencirt_samples_")
+                self._finalizer = weakref.finalize(
+                    self, shutil.rmtree, directory, True)
+            else:
+                os.makedirs(directory, exist_ok=True)
+            self.directory = directory
+
+        for k in self.variables:
+            if k in self.local_vars:
+                self._draw_local(k, model[k], seed)
+            else:
+                draw = model[k].sample(self.num_samples, seed=seed)
+                self._memory[k] = draw.numpy()
+                self.dtypes[k] = self._memory[k].dtype
+
+    def _draw_local(self, k, distribution, seed=None):
+        shape = tf.TensorShape(
+            distribution.batch_shape).concatenate(
+                distribution.event_shape).as_list()
+        num_people = shape[0]
+        self.dtypes[k] = distribution.dtype.as_numpy_dtype
+        out = None
+        if self.mode == 'memmap':
+            out = np.lib.format.open_memmap(
+                os.path.join(self.directory, f"{k}.npy"), mode='w+',
+                dtype=self.local_dtype,
+                shape=tuple([self.num_samples] + shape))
+        summary = {
+            'mean': np.zeros(shape, dtype=np.float64),
+            'sd': np.zeros(shape, dtype=np.float64),
+            'quantiles': np.zeros(
+                [len(self.quantile_levels)] + shape, dtype=np.float64)
+        }
+        for start in range(0, num_people, self.chunk_size):
+            stop = min(start + self.chunk_size, num_people)
+            draw = _sample_rows(
+                distribution, start, stop, self.num_samples, seed).numpy()
+            summary['mean'][start:stop] = draw.mean(axis=0)
+            summary['sd'][start:stop] = draw.std(axis=0)
+            summary['quantiles'][:, start:stop] = np.quantile(
+                draw, self.quantile_levels, axis=0)
+            if out is not None:
+                out[:, start:stop] = draw.astype(self.local_dtype)
+        if out is not None:
+            out.flush()
+            self._memmap[k] = out
+        self._summaries[k] = summary
+
+    def __getitem__(self, k):
+        if k in self._memory:
+            return self._memory[k]
+        if k in self._memmap:
+            return self._memmap[k]
+        if k in self._summaries:
+            raise KeyError(
+                f"Draws of {k} were reduced to summaries, use mean/sd/quantiles")
+        raise KeyError(k)
+
+    def __setitem__(self, k, value):
+        self._memory[k] = np.asarray(value)
+        self.dtypes[k] = self._memory[k].dtype
+        self._memmap.pop(k, None)
+        self._summaries.pop(k, None)
+        if k not in self.variables:
+            self.variables += [k]
+
+    def __iter__(self):
+        for k in self.variables:
+            if (k in self._memory) or (k in self._memmap):
+                yield k
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def is_local(self, k):
+        return (k in self._memmap) or (k in self._summaries)
+
+    def mean(self, k):
+        if k in self._summaries:
+            return self._summaries[k]['mean'].astype(self.dtypes[k])
+        return np.mean(self[k], axis=0)
+
+    def sd(self, k):
+        if k in self._summaries:
+            return self._summaries[k]['sd'].astype(self.dtypes[k])
+        return np.std(self[k], axis=0)
+
+    def quantiles(self, k):
+        if k in self._summaries:
+            return self._summaries[k]['quantiles']
+        return np.quantile(self[k], self.quantile_levels, axis=0)
+
+    def sample_splits(self, num_splits):
+        """Contiguous sample index ranges, as tf.split would cut them
+        """
+        edges = np.linspace(0, self.num_samples, num_splits + 1).astype(int)
+        return [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+    def gather(self, k, rows=None, start=0, stop=None):
+        """Draws [start, stop) of variable k, restricted to `rows` if local
+
+        Local draws are cast back to the surrogate dtype.
+        """
+        stop = self.num_samples if stop is None else stop
+        value = self[k][start:stop]
+        if rows is not None and self.is_local(k):
+            value = np.take(value, np.asarray(rows), axis=1)
+        return np.asarray(value, dtype=self.dtypes[k])
+
+    def iter_chunks(self, k, chunk_size=None):
+        """Yield (start, stop, draws) over people for a local variable
+        """
+        chunk_size = self.chunk_size if chunk_size is None else chunk_size
+        value = self[k]
+        for start in range(0, value.shape[1], chunk_size):
+            stop = min(start + chunk_size, value.shape[1])
+            yield start, stop, np.asarray(
+                value[:, start:stop], dtype=self.dtypes[k])
+
+    def to_inference_data(self, var_names=None):
+        """Export to arviz.InferenceData as a single chain
+
+        Memory-mapped draws are handed to arviz as views, so they are paged
+        in only when accessed. Summarized local variables are skipped.
+        """
+        var_names = list(self) if var_names is None else var_names
+        posterior = {k: self[k][np.newaxis, ...] for k in var_names}
+        return az.from_dict(posterior=posterior)
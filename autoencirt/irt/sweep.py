@@ -0,0 +1,319 @@
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+
+def grid_space(space):
+    """Every combination of a grid
+
+    Args:
+        space (dict): {argument: list of values}, or a single fixed value
+
+    Returns:
+        list: dicts of constructor arguments
+    """
+    keys = list(space.keys())
+    values = [
+        v if isinstance(v, list) else [v] for v in space.values()]
+    return [
+        dict(zip(keys, combination))
+        for combination in itertools.product(*values)]
+
+
+def random_space(space, num_configs, seed=0):
+    """Random search over a space
+
+    Args:
+        space (dict): {argument: spec}, where a list is sampled uniformly
+            among its elements, (low, high) uniformly on the interval,
+            (low, high, 'log') log-uniformly, and anything else is fixed
+        num_configs (int): number of configurations
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        list: dicts of constructor arguments
+    """
+    rng = np.random.default_rng(seed)
+
+    def draw(spec):
+        if isinstance(spec, list):
+            return spec[rng.integers(len(spec))]
+        if isinstance(spec, tuple) and len(spec) == 3 and spec[2] == 'log':
+            return float(np.exp(
+                rng.uniform(np.log(spec[0]), np.log(spec[1]))))
+        if isinstance(spec, tuple):
+            return float(rng.uniform(spec[0], spec[1]))
+        return spec
+
+    return [
+        {k: draw(spec) for k, spec in space.items()}
+        for _ in range(num_configs)]
+
+
+def make_holdout(data_dir, path, fraction=0.1, seed=0, chunk_size=65536):
+    """Boolean people x items mask over a random `fraction` of the observed
+    responses of a load_synthetic directory
+    """
+    responses = np.load(
+        os.path.join(data_dir, "responses.npy"), mmap_mode="r")
+    mask = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.bool_, shape=responses.shape)
+    rng = np.random.default_rng(seed)
+    for start in range(0, responses.shape[0], chunk_size):
+        stop = min(start + chunk_size, responses.shape[0])
+        chunk = np.asarray(responses[start:stop])
+        mask[start:stop] = (chunk >= 0) & (
+            rng.random(chunk.shape) < fraction)
+    mask.flush()
+    return path
+
+
+def _report(rung_dir, rung, config_id, score, se, dominance):
+    """Record a score at a rung, and whether an earlier arrival at the
+    same rung clearly dominates it
+
+    Dominated means worse than the best score so far by more than
+    `dominance` standard errors of the difference, taking the two
+    estimates as independent.
+    """
+    directory = os.path.join(rung_dir, f"rung{rung}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{config_id}.json")
+    with open(path + ".tmp", "w") as file:
+        json.dump({'score': score, 'se': se}, file)
+    # others only ever see complete files
+    os.replace(path + ".tmp", path)
+    others = []
+    for other in glob.glob(os.path.join(directory, "*.json")):
+        if other == path:
+            continue
+        with open(other, "r") as file:
+            others += [json.load(file)]
+    finite = [o for o in others if np.isfinite(o['score'])]
+    if not np.isfinite(score):
+        return len(finite) > 0
+    if len(finite) == 0:
+        return False
+    best = min(finite, key=lambda o: o['score'])
+    return score - best['score'] > dominance*np.hypot(se, best['se'])
+
+
+def _evaluate(model, criterion, train, test, num_samples, sample_dir):
+    """(score, se, waic dict), lower scores are better
+    """
+    params = model.sample_posterior(num_samples, directory=sample_dir)
+    if criterion == 'waic':
+        result = model.waic(data=train, params=params)
+        return result['waic'], result['se'], result
+    # deviance of the held-out responses
+    result = model.waic(data=test, params=params)
+    return -2.*result['lppd'], result['se'], result
+
+
+def _run_config(job):
+    """Calibrate one configuration in rungs, stopping once dominated
+    """
+    import tensorflow as tf
+
+    from autoencirt.data.synthetic import load_synthetic
+    from autoencirt.irt.callbacks import TrainingState
+
+    if job['threads'] is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(job['threads'])
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.random.set_seed(job['seed'])
+    np.random.seed(job['seed'])
+
+    row = {'config': job['id'], **job['params'], 'status': 'running'}
+    job_dir = os.path.join(job['workdir'], f"config{job['id']}")
+    start = time.perf_counter()
+    try:
+        train, header = load_synthetic(
+            job['data_dir'], holdout=job['holdout'])
+        test = None
+        if job['holdout'] is not None:
+            test, _ = load_synthetic(
+                job['data_dir'], holdout=job['holdout'], held_out=True)
+        model = job['model_class'](
+            item_keys=header['item_keys'], num_people=header['num_people'],
+            data=train,
+            response_cardinality=header['response_cardinality'],
+            **{**job['model_kwargs'], **job['params']})
+        row['setup_s'] = time.perf_counter() - start
+
+        advi_kwargs = dict(job['advi_kwargs'])
+        callbacks = list(advi_kwargs.pop('callbacks', None) or [])
+        # one optimizer and learning-rate schedule across the rungs
+        schedule = TrainingState(
+            advi_kwargs.pop('learning_rate', 0.1),
+            advi_kwargs.pop('decay_count', 0))
+        opt = tf.optimizers.Adam(learning_rate=schedule.learning_rate)
+        edges = np.linspace(
+            0, job['num_epochs'], job['rungs'] + 1).astype(int)
+        row['fit_s'] = 0.
+        row['eval_s'] = 0.
+        row['status'] = 'completed'
+        for rung, (a, b) in enumerate(zip(edges[:-1], edges[1:])):
+            t = time.perf_counter()
+            losses = model.calibrate_advi(
+                num_epochs=int(b - a), opt=opt, set_expectations=False,
+                learning_rate=schedule.learning_rate,
+                decay_count=schedule.decay_count,
+                callbacks=callbacks + [schedule], **advi_kwargs)
+            row['fit_s'] += time.perf_counter() - t
+            t = time.perf_counter()
+            score, se, result = _evaluate(
+                model, job['criterion'], train, test, job['num_samples'],
+                os.path.join(job_dir, "samples"))
+            row['eval_s'] += time.perf_counter() - t
+            row.update({
+                'rung': rung, 'epochs': int(b),
+                'loss': float(losses[-1]) if len(losses) > 0 else np.nan,
+                'score': float(score), 'se': float(se),
+                **{k: float(v) for k, v in result.items()}})
+            if rung + 1 < job['rungs'] and _report(
+                    job['rung_dir'], rung, job['id'], row['score'],
+                    row['se'], job['dominance']):
+                row['status'] = 'cancelled'
+                break
+    except Exception:
+        row['status'] = 'failed'
+        row['error'] = traceback.format_exc(limit=3)
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    row['total_s'] = time.perf_counter() - start
+    return row
+
+
+def run_sweep(
+        data_dir, space, search='grid', num_configs=10, model_class=None,
+        model_kwargs=None, criterion='waic', holdout=0.1, num_epochs=100,
+        rungs=3, dominance=2., num_samples=100, num_workers=2,
+        threads=None, output=None, workdir=None, seed=0, **advi_kwargs):
+    """Hyperparameter sweep of model constructor arguments in a process
+    pool
+
+    Every configuration is calibrated by calibrate_advi in a fresh
+    worker process, which streams the responses from the memory-mapped
+    data directory, so the workers share one copy of the data in the page
+    cache. Training runs in `rungs` equal rounds of epochs, each followed
+    by an evaluation. A configuration whose score at a rung is clearly
+    dominated by one that reached the same rung earlier is cancelled
+    there, so poor regions of the space cost a fraction of a full fit.
+    The optimizer, learning rate and decay count carry over from rung to
+    rung, while the convergence check of calibrate_advi starts a new
+    window in every rung.
+
+    Args:
+        data_dir (str): directory written by simulate_grm or pack_dataset
+        space (dict): search space, see grid_space and random_space
+        search (str, optional): 'grid' or 'random'. Defaults to 'grid'.
+        num_configs (int, optional): Configurations of a random search.
+            Defaults to 10.
+        model_class (type, optional): Defaults to GRModel.
+        model_kwargs (dict, optional): Fixed constructor arguments, e.g.
+            dim. Defaults to None.
+        criterion (str, optional): 'waic' on the training responses, or
+            'holdout' for the deviance -2 lppd of a random `holdout`
+            fraction of the responses left out of training. Lower is
+            better. Defaults to 'waic'.
+        holdout (float, optional): Defaults to 0.1.
+        num_epochs (int, optional): Defaults to 100.
+        rungs (int, optional): Defaults to 3.
+        dominance (float, optional): Cancel when worse than the best
+            score at a rung by this many standard errors. Use np.inf to
+            never cancel. Defaults to 2.
+        num_samples (int, optional): Posterior draws per evaluation.
+            Defaults to 100.
+        num_workers (int, optional): Defaults to 2.
+        threads (int, optional): intra-op threads per worker. Defaults to
+            cpu_count // num_workers.
+        output (str, optional): Write the results table here as csv.
+            Defaults to None.
+        workdir (str, optional): Defaults to a temporary directory that
+            is removed afterwards.
+        seed (int, optional): Defaults to 0.
+        **advi_kwargs: passed on to calibrate_advi, e.g. learning_rate
+            and data_batches
+
+    Returns:
+        pd.DataFrame: one row per configuration with its arguments,
+            status, rung, score and timings, best first
+    """
+    if model_class is None:
+        from autoencirt.irt.grm import GRModel
+        model_class = GRModel
+    if criterion not in ['waic', 'holdout']:
+        raise ValueError(f"Unknown criterion {criterion}")
+    if search == 'grid':
+        configs = grid_space(space)
+    elif search == 'random':
+        configs = random_space(space, num_configs, seed)
+    else:
+        raise ValueError(f"Unknown search {search}")
+    if threads is None:
+        threads = max((os.cpu_count() or 1)//num_workers, 1)
+    cleanup = workdir is None
+    workdir = tempfile.mkdtemp(prefix="autoencirt_sweep_") if cleanup else (
+        workdir)
+    os.makedirs(workdir, exist_ok=True)
+
+    holdout_path = None
+    if criterion == 'holdout':
+        holdout_path = make_holdout(
+            data_dir, os.path.join(workdir, "holdout.npy"), holdout, seed)
+    jobs = [{
+        'id': j,
+        'params': params,
+        'data_dir': data_dir,
+        'holdout': holdout_path,
+        'model_class': model_class,
+        'model_kwargs': {} if model_kwargs is None else model_kwargs,
+        'criterion': criterion,
+        'num_epochs': num_epochs,
+        'rungs': rungs,
+        'dominance': dominance,
+        'num_samples': num_samples,
+        'threads': threads,
+        'seed': seed + j,
+        'workdir': workdir,
+        'rung_dir': os.path.join(workdir, "rungs"),
+        'advi_kwargs': advi_kwargs
+    } for j, params in enumerate(configs)]
+
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    try:
+        # a fresh process per configuration, so no graphs or memory pile up
+        with context.Pool(num_workers, maxtasksperchild=1) as pool:
+            for row in pool.imap_unordered(_run_config, jobs):
+                rows += [row]
+                print(
+                    f"Config {row['config']} {row['status']}: "
+                    f"score {row.get('score', np.nan):.1f} in "
+                    f"{row['total_s']:.1f}s ({len(rows)}/{len(jobs)})")
+                if output is not None:
+                    pd.DataFrame(rows).to_csv(output, index=False)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+    if 'score' in results:
+        # cancelled configurations stopped at an earlier rung
+        results = results.sort_values(
+            ['epochs', 'score'], ascending=[False, True],
+            na_position='last')
+    results = results.reset_index(drop=True)
+    if output is not None:
+        results.to_csv(output, index=False)
+    return results
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Benchmark the GRM hot paths on seeded synthetic data
+
+Example:
+    grm_benchmark.py --num-people 1000 100000 --items 20 --dims 2
+        --output bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from autoencirt.data.synthetic import simulate_grm, load_synthetic
+from autoencirt.irt import DichotomousModel, GRModel
+from autoencirt.irt.callbacks import Callback
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def timed(fn, repeats=1):
+    """Best-of-`repeats` wall time in seconds, and the last result
+    """
+    best = np.inf
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+class EpochTimer(Callback):
+    """Wall time and cumulative tracing count of every epoch
+    """
+
+    def __init__(self):
+        self.epoch_times = []
+        self.tracing_counts = []
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_times += [logs['epoch_time']]
+        self.tracing_counts += [logs['tracing_count']]
+
+
+def timed_epochs(model, num_epochs, **kwargs):
+    """Time the epochs of a single calibrate_advi run
+
+    The first epoch includes tracing (and XLA compilation), the later
+    ones reuse the traced step.
+
+    Returns:
+        dict: first_epoch_s, epoch_s (mean over epochs 2..num_epochs),
+            first_epoch_traces and retraces after the first epoch
+    """
+    timer = EpochTimer()
+    model.calibrate_advi(
+        num_epochs=num_epochs, set_expectations=False, callbacks=[timer],
+        **kwargs)
+    if len(timer.epoch_times) == 0:
+        # stopped on a non-finite loss
+        return {"first_epoch_s": None}
+    later = timer.epoch_times[1:]
+    return {
+        "first_epoch_s": timer.epoch_times[0],
+        "epoch_s": float(np.mean(later)) if len(later) > 0 else None,
+        "first_epoch_traces": timer.tracing_counts[0],
+        "retraces": timer.tracing_counts[-1] - timer.tracing_counts[0]
+    }
+
+
+def directory_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total/2**20
+
+
+def environment():
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "tensorflow": tf.__version__,
+        "tensorflow_probability": tfp.__version__,
+        "numpy": np.__version__
+    }
+
+
+def benchmark_case(
+        workdir, num_people, num_items, response_cardinality, dimensions,
+        missingness, seed=0, data_batches=25, sample_size=4, repeats=3,
+        score_people=1000, compiled=True, epochs=3):
+    case_dir = os.path.join(
+        workdir,
+        f"N{num_people}_I{num_items}_K{response_cardinality}_D{dimensions}")
+    result = {
+        "num_people": num_people,
+        "num_items": num_items,
+        "response_cardinality": response_cardinality,
+        "dimensions": dimensions,
+        "missingness": missingness,
+        "data_batches": data_batches,
+        "sample_size": sample_size,
+        "epochs": epochs
+    }
+
+    result["simulate_s"], header = timed(
+        lambda: simulate_grm(
+            os.path.join(case_dir, "data"), num_people, num_items,
+            response_cardinality, dimensions, missingness, seed))
+    dataset, header = load_synthetic(os.path.join(case_dir, "data"))
+
+    def build():
+        # the same starting point for every calibration compared below
+        tf.random.set_seed(seed)
+        return GRModel(
+            data=dataset,
+            item_keys=header["item_keys"],
+            num_people=num_people,
+            dim=dimensions,
+            response_cardinality=response_cardinality)
+
+    result["init_s"], grm = timed(build)
+
+    batch_size = max(num_people//data_batches, 1)
+    batch = next(iter(dataset.batch(batch_size)))
+    params = grm.surrogate_distribution.sample(sample_size)
+    grm.log_likelihood(batch, **params)
+    result["log_likelihood_s"], _ = timed(
+        lambda: grm.log_likelihood(batch, **params).numpy(), repeats)
+    result["log_likelihood_batch_size"] = batch_size
+
+    # the same computation traced once with a fixed signature, without
+    # and with XLA fusion
+    for name, jit_compile in [("tf_function", False), ("xla", True)]:
+        fn = grm.compiled_log_likelihood(
+            batch_size, sample_size, jit_compile=jit_compile)
+        fn(batch, params)
+        result[f"log_likelihood_{name}_s"], _ = timed(
+            lambda: fn(batch, params).numpy(), repeats)
+
+    # fused prior against JointDistributionNamed resolution
+    result["log_prior_jd_s"], jd = timed(
+        lambda: grm.joint_prior_distribution.log_prob(params).numpy(),
+        repeats)
+    result["log_prior_fused_s"], fused = timed(
+        lambda: grm.log_prior(params).numpy(), repeats)
+    result["log_prior_max_abs_diff"] = float(np.max(np.abs(jd - fused)))
+
+    def record_epochs(prefix, model, **kwargs):
+        for k, v in timed_epochs(
+                model, epochs, data_batches=data_batches,
+                sample_size=sample_size, **kwargs).items():
+            result[f"{prefix}_{k}"] = v
+
+    record_epochs("calibrate", grm)
+    if response_cardinality == 2:
+        # the Bernoulli fast path on the same data
+        dichotomous = DichotomousModel(
+            data=dataset, item_keys=header["item_keys"],
+            num_people=num_people, dim=dimensions)
+        params2 = dichotomous.surrogate_distribution.sample(sample_size)
+        dichotomous.log_likelihood(batch, **params2)
+        result["dichotomous_log_likelihood_s"], _ = timed(
+            lambda: dichotomous.log_likelihood(batch, **params2).numpy(),
+            repeats)
+        record_epochs("dichotomous_calibrate", dichotomous)
+    if compiled:
+        # a fresh model, grm has already been trained
+        record_epochs("calibrate_xla", build(), compiled=True)
+    result["trace_statistics"] = {
+        "_".join(str(x) for x in k): v
+        for k, v in grm.trace_statistics().items()}
+
+    result["sample_posterior_s"], _ = timed(
+        lambda: grm.sample_posterior(
+            100, directory=os.path.join(case_dir, "samples")))
+
+    responses = np.load(
+        os.path.join(case_dir, "data", "responses.npy"), mmap_mode="r")
+    responses = np.maximum(
+        np.asarray(responses[:score_people], dtype=np.int32), 0)
+    result["score_s"], _ = timed(lambda: grm.score(responses), repeats)
+    result["score_people"] = int(responses.shape[0])
+
+    result["waic_s"], _ = timed(
+        lambda: grm.waic(data=dataset, data_batches=data_batches))
+
+    save_dir = os.path.join(case_dir, "model")
+    result["save_s"], _ = timed(lambda: grm.save(save_dir), repeats)
+    result["save_mb"] = directory_size_mb(save_dir)
+    result["load_s"], _ = timed(lambda: GRModel.load(save_dir), repeats)
+
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--num-people", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--items", type=int, nargs="+", default=[20])
+    parser.add_argument("--cardinality", type=int, nargs="+", default=[5])
+    parser.add_argument("--dims", type=int, nargs="+", default=[2])
+    parser.add_argument(
+        "--missingness", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--data-batches", type=int, default=25)
+    parser.add_argument("--sample-size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--epochs", type=int, default=3,
+        help="calibration epochs timed, the first one includes tracing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--keep", action="store_true")
+    parser.add_argument(
+        "--no-compiled", dest="compiled", action="store_false",
+        help="skip the XLA-compiled calibration epochs")
+    parser.add_argument("--output", default="bench.json")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="autoencirt_bench_")
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for N in args.num_people:
+            for I in args.items:
+                for K in args.cardinality:
+                    for D in args.dims:
+                        for p in args.missingness:
+                            # a fresh process per case so that peak RSS
+                            # is not carried over from larger cases
+                            with context.Pool(1) as pool:
+                                result = pool.apply(
+                                    benchmark_case,
+                                    (workdir, N, I, K, D, p),
+                                    dict(
+                                        seed=args.seed,
+                                        data_batches=args.data_batches,
+                                        sample_size=args.sample_size,
+                                        repeats=args.repeats,
+                                        compiled=args.compiled,
+                                        epochs=args.epochs))
+                            print(json.dumps(result))
+                            results += [result]
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as file:
+        json.dump(
+            {"environment": environment(), "results": results},
+            file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Data-parallel calibration scaling from 1 to N local worker processes
+
+Example:
+    grm_scaling.py --num-people 100000 --items 20 --workers 1 2 4 8
+        --output scaling.json
+"""
+import argparse
+import functools
+import json
+import shutil
+import tempfile
+import time
+
+from autoencirt.data.synthetic import simulate_grm, load_synthetic
+from autoencirt.irt import GRModel
+from autoencirt.irt.distributed import calibrate_advi_distributed
+from autoencirt.scripts.grm_benchmark import environment
+
+
+def load_dataset(path):
+    return load_synthetic(path)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-people", type=int, default=100000)
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--cardinality", type=int, default=5)
+    parser.add_argument("--dims", type=int, default=2)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--data-batches", type=int, default=10)
+    parser.add_argument("--sample-size", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="scaling.json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="autoencirt_scaling_")
+    results = []
+    try:
+        header = simulate_grm(
+            workdir, args.num_people, args.items, args.cardinality,
+            args.dims, seed=args.seed)
+        data_fn = functools.partial(load_dataset, workdir)
+        for W in args.workers:
+            grm = GRModel(
+                data=data_fn(),
+                item_keys=header["item_keys"],
+                num_people=args.num_people,
+                dim=args.dims,
+                response_cardinality=args.cardinality)
+            start = time.perf_counter()
+            losses = calibrate_advi_distributed(
+                grm, data_fn, num_workers=W,
+                data_batches=max(args.data_batches//W, 1),
+                num_epochs=args.epochs, sample_size=args.sample_size,
+                set_expectations=False)
+            elapsed = time.perf_counter() - start
+            result = {
+                "workers": W,
+                "epochs": len(losses),
+                "seconds": elapsed,
+                "seconds_per_epoch": elapsed/max(len(losses), 1),
+                "final_loss": float(losses[-1]) if len(losses) else None
+            }
+            if len(results) > 0:
+                result["speedup"] = (
+                    results[0]["seconds_per_epoch"]
+                    / result["seconds_per_epoch"])
+            print(json.dumps(result))
+            results += [result]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as file:
+        json.dump(
+            {"environment": environment(), "results": results},
+            file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Parallel sweep of the GRM horseshoe scales and weight exponent
+
+Example:
+    grm_sweep.py --data simulated/ --xi-scale 1e-4 1e-3 1e-2
+        --weight-exponent 1 2 --workers 4 --output sweep.csv
+"""
+import argparse
+import shutil
+import tempfile
+
+from autoencirt.data.synthetic import simulate_grm
+from autoencirt.irt.sweep import run_sweep
+
+SWEPT = ['xi_scale', 'eta_scale', 'kappa_scale', 'weight_exponent', 'decay']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--data", default=None,
+        help="directory from simulate_grm or pack_dataset, simulated if "
+             "not given")
+    parser.add_argument("--num-people", type=int, default=10000)
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--cardinality", type=int, default=5)
+    parser.add_argument("--dims", type=int, default=2)
+    for k in SWEPT:
+        parser.add_argument(
+            "--" + k.replace("_", "-"), type=float, nargs="+", default=None)
+    parser.add_argument(
+        "--search", choices=["grid", "random"], default="grid")
+    parser.add_argument("--num-configs", type=int, default=10)
+    parser.add_argument(
+        "--ranges", action="store_true",
+        help="in a random search, draw log-uniformly between the two "
+             "values given for an argument")
+    parser.add_argument(
+        "--criterion", choices=["waic", "holdout"], default="waic")
+    parser.add_argument("--holdout", type=float, default=0.1)
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--rungs", type=int, default=3)
+    parser.add_argument("--dominance", type=float, default=2.)
+    parser.add_argument("--learning-rate", type=float, default=0.1)
+    parser.add_argument("--data-batches", type=int, default=25)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="sweep.csv")
+    args = parser.parse_args()
+
+    space = {}
+    for k in SWEPT:
+        values = getattr(args, k)
+        if values is None:
+            continue
+        if args.ranges and args.search == 'random' and len(values) == 2:
+            space[k] = (min(values), max(values), 'log')
+        else:
+            space[k] = values
+
+    data_dir = args.data
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix="autoencirt_sweep_data_")
+        simulate_grm(
+            data_dir, args.num_people, args.items, args.cardinality,
+            args.dims, missingness=0.1, seed=args.seed)
+    try:
+        results = run_sweep(
+            data_dir, space, search=args.search,
+            num_configs=args.num_configs, model_kwargs={'dim': args.dims},
+            criterion=args.criterion, holdout=args.holdout,
+            num_epochs=args.epochs, rungs=args.rungs,
+            dominance=args.dominance, num_workers=args.workers,
+            output=args.output, seed=args.seed,
+            learning_rate=args.learning_rate,
+            data_batches=args.data_batches)
+    finally:
+        if args.data is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    print(results.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -37,51 +37,14 @@ def main():
     # grm.log_likelihood(**p, responses=ds)
     # grm.unormalized_log_prob(**p, data=ds)
 
-    losses = grm.calibrate_advi(
-        num_epochs=50, rel_tol=1e-4,
-        learning_rate=.01, clip_value=4.,
-        data_batches=10
-    )
-
-    print(
-        grm.calibrated_expectations['discriminations'][0, ..., 0]
-    )
-
-    losses = grm.calibrate_advi(
-        num_epochs=50, rel_tol=1e-4,
-        learning_rate=.01, clip_value=4., data_batches=10)
-
-    print(
-        grm.calibrated_expectations['discriminations'][0, ..., 0]
-    )
-
-    losses = grm.calibrate_advi(
-        num_epochs=50, rel_tol=1e-4,
-        learning_rate=.005, clip_value=4., data_batches=10)
-
-    print(
-        grm.calibrated_expectations['discriminations'][0, ..., 0]
-    )
-
-    losses = grm.calibrate_advi(
-        num_epochs=50, rel_tol=1e-4,
-        learning_rate=.005, clip_value=4., data_batches=2)
-
-    print(
-        grm.calibrated_expectations['discriminations'][0, ..., 0]
-    )
-
-    losses = grm.calibrate_advi(
-        num_epochs=50, rel_tol=1e-4,
-        learning_rate=.001, clip_value=4., data_batches=2)
-
-    print(
-        grm.calibrated_expectations['discriminations'][0, ..., 0]
-    )
-
-    losses = grm.calibrate_advi(
-        num_epochs=50, rel_tol=1e-4,
-        learning_rate=.001, clip_value=4., data_batches=2)
+    losses = grm.calibrate_advi_staged(
+        stages=[
+            {'num_epochs': 100, 'learning_rate': .01, 'data_batches': 10},
+            {'num_epochs': 50, 'learning_rate': .005, 'data_batches': 10},
+            {'num_epochs': 50, 'learning_rate': .005, 'data_batches': 2},
+            {'num_epochs': 100, 'learning_rate': .001, 'data_batches': 2}
+        ],
+        rel_tol=1e-4, clip_value=4.)
 
     print(
         grm.calibrated_expectations['discriminations'][0, ..., 0]
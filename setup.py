@@ -36,6 +36,9 @@ setuptools.setup(
     python_requires='>=3.6',
     scripts=[
         'autoencirt/scripts/rwas_test.py',
-        'autoencirt/scripts/test_nn.py'
+        'autoencirt/scripts/test_nn.py',
+        'autoencirt/scripts/grm_benchmark.py',
+        'autoencirt/scripts/grm_scaling.py',
+        'autoencirt/scripts/grm_sweep.py'
     ]
 )
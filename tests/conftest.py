@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def synthetic_dir(tmp_path_factory):
+    """Directory of a small simulated GRM data set
+    """
+    pytest.importorskip("tensorflow")
+    synthetic = pytest.importorskip("autoencirt.data.synthetic")
+    path = str(tmp_path_factory.mktemp("synthetic"))
+    synthetic.simulate_grm(
+        path, num_people=60, num_items=4, response_cardinality=3,
+        dimensions=2, missingness=0.1, seed=0)
+    return path
+
+
+@pytest.fixture(scope="session")
+def synthetic_data(synthetic_dir):
+    """The small simulated GRM data set, (dataset, header)
+    """
+    synthetic = pytest.importorskip("autoencirt.data.synthetic")
+    return synthetic.load_synthetic(synthetic_dir)
+
+
+@pytest.fixture
+def small_grm(synthetic_data):
+    """A GRModel of the synthetic data, without factor initialization
+    """
+    grm = pytest.importorskip("autoencirt.irt.grm")
+    dataset, header = synthetic_data
+    return grm.GRModel(
+        data=dataset, item_keys=header["item_keys"],
+        num_people=header["num_people"], dim=2,
+        response_cardinality=header["response_cardinality"],
+        factor_init=None)
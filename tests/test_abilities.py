@@ -0,0 +1,45 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.abilities import AbilityStore, StoreMoment  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = AbilityStore(
+        10, [2, 1, 1], str(tmp_path), dtype='float64', partition_size=4)
+    rows = np.arange(10)
+    store.put('loc', rows, np.arange(20.).reshape(10, 2, 1, 1))
+    return store
+
+
+def test_store_moment_reads_rows(store):
+    mean = StoreMoment(store, 'mean')
+    assert mean.shape == (10, 2, 1, 1)
+    np.testing.assert_allclose(mean[3], [[[6.]], [[7.]]])
+    np.testing.assert_allclose(mean[[1, 8], 1, 0, 0], [3., 17.])
+    np.testing.assert_allclose(
+        tf.reduce_sum(mean).numpy(), np.sum(np.arange(20.)))
+    stddev = StoreMoment(store, 'stddev')
+    np.testing.assert_allclose(np.asarray(stddev), 0.1)
+
+
+def test_population_moments_stream_partitions(store):
+    mean, std = StoreMoment(store, 'mean').population_moments()
+    values = np.arange(20.).reshape(10, 2, 1, 1)
+    np.testing.assert_allclose(mean, np.mean(values, axis=0))
+    np.testing.assert_allclose(std, np.std(values, axis=0))
+
+
+def test_non_finite_rows_are_not_written(store):
+    grads = np.ones((2, 2, 1, 1))
+    grads[1, 0] = np.nan
+    store.apply_gradients(
+        np.array([2, 5]), {'loc': grads, 'raw_scale': np.zeros_like(grads)},
+        0.1)
+    assert store.take('loc', [2])[0, 0, 0, 0] < 4.
+    np.testing.assert_allclose(store.take('loc', [5]), [[[[10.]], [[11.]]]])
+    np.testing.assert_array_equal(store.take('step', [2, 5]), [1, 0])
@@ -0,0 +1,50 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from autoencirt.irt.advi import fit_surrogate_posterior_minibatch  # noqa: E402
+from autoencirt.irt.callbacks import Callback  # noqa: E402
+
+
+class Interrupt(Exception):
+    pass
+
+
+class StepCounter(Callback):
+
+    def __init__(self, stop_after=None):
+        self.steps = 0
+        self.stop_after = stop_after
+
+    def on_step_end(self, step, logs=None):
+        self.steps += 1
+        if self.steps == self.stop_after:
+            raise Interrupt()
+
+
+def fit(checkpoint_dir, callback):
+    x = tf.Variable(0., dtype=tf.float64)
+    dataset = tf.data.Dataset.from_tensor_slices(
+        tf.range(10, dtype=tf.float64))
+    losses = fit_surrogate_posterior_minibatch(
+        lambda batch: (x - batch)**2, [x], dataset, num_epochs=2,
+        checkpoint_dir=checkpoint_dir, checkpoint_steps=3,
+        callbacks=[callback])
+    return x, losses
+
+
+def test_resume_continues_mid_epoch(tmp_path):
+    checkpoint_dir = str(tmp_path)
+    with pytest.raises(Interrupt):
+        fit(checkpoint_dir, StepCounter(stop_after=5))
+    # the checkpoint after 3 batches holds, 7 remain in the first epoch
+    counter = StepCounter()
+    _, losses = fit(checkpoint_dir, counter)
+    assert counter.steps == 7 + 10
+    assert len(losses) == 2
+
+    uninterrupted = StepCounter()
+    _, expected = fit(str(tmp_path/"fresh"), uninterrupted)
+    assert uninterrupted.steps == 20
+    np.testing.assert_allclose(losses, expected)
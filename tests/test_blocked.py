@@ -0,0 +1,72 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from autoencirt.irt.blocked import (  # noqa: E402
+    StepSizeAdapter, mala_step, unit_sum)
+
+
+def test_unit_sum():
+    x = tf.ones([3, 4, 5], tf.float64)
+    np.testing.assert_allclose(unit_sum(x, 1).numpy(), np.full(4, 15.))
+    np.testing.assert_allclose(unit_sum(x, -1).numpy(), np.full(5, 12.))
+    np.testing.assert_allclose(unit_sum(x, None).numpy(), [60.])
+
+
+def test_mala_samples_independent_normals():
+    tf.random.set_seed(0)
+    loc = tf.constant(np.linspace(-3., 3., 40)[:, np.newaxis], tf.float64)
+
+    def log_prob_fn(state):
+        x, = state
+        return unit_sum(-0.5*(x - loc)**2, 0)
+
+    state = [tf.zeros([40, 2], tf.float64)]
+    draws = []
+    accepted = []
+    for t in range(1500):
+        state, accept = mala_step(log_prob_fn, state, [0], 1.)
+        accepted += [np.mean(accept.numpy())]
+        if t >= 200:
+            draws += [(state[0] - loc).numpy()]
+    draws = np.stack(draws)
+    assert 0.3 < np.mean(accepted) < 0.95
+    np.testing.assert_allclose(np.mean(draws), 0., atol=0.05)
+    np.testing.assert_allclose(np.var(draws), 1., atol=0.1)
+
+
+def test_mala_rejects_proposals_outside_the_support():
+    tf.random.set_seed(1)
+
+    def log_prob_fn(state):
+        x, = state
+        return unit_sum(
+            tf.where(x > 0, -0.5*x**2, tf.constant(-np.inf, x.dtype)), 0)
+
+    state = [tf.fill([20, 3], tf.constant(0.5, tf.float64))]
+    for _ in range(100):
+        state, _ = mala_step(log_prob_fn, state, [0], 0.8)
+        assert np.all(state[0].numpy() > 0)
+
+
+def test_step_size_adapter_follows_acceptance():
+    adapter = StepSizeAdapter(0.1)
+    adapter.update(1.)
+    assert adapter.step_size > 0.1
+    adapter = StepSizeAdapter(0.1)
+    adapter.update(0.)
+    assert adapter.step_size < 0.1
+
+
+def test_mala_stateless_seed_is_reproducible():
+    def log_prob_fn(state):
+        x, = state
+        return unit_sum(-0.5*x**2, 0)
+
+    state = [tf.zeros([10, 2], tf.float64)]
+    first, accept = mala_step(log_prob_fn, state, [0], 0.5, seed=[1, 2])
+    tf.random.set_seed(3)
+    second, again = mala_step(log_prob_fn, state, [0], 0.5, seed=[1, 2])
+    np.testing.assert_array_equal(first[0].numpy(), second[0].numpy())
+    np.testing.assert_array_equal(accept.numpy(), again.numpy())
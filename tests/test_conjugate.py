@@ -0,0 +1,44 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+
+def monte_carlo_scales(model, num_samples=100000):
+    """1/scale^2 + E_q[1/x^2] of every conjugate auxiliary, by sampling
+    """
+    scales = {}
+    for k, (child, scale) in model._conjugate_parents().items():
+        draws = model.surrogate_distribution.model[child].sample(
+            num_samples, seed=0).numpy()
+        scales[k] = np.asarray(scale)**-2 + np.mean(draws**-2, axis=0)
+    return scales
+
+
+def test_conjugate_update_matches_complete_conditional(small_grm):
+    small_grm.enable_conjugate_updates()
+    expected = monte_carlo_scales(small_grm)
+    for k, v in small_grm.conjugate_scales.items():
+        np.testing.assert_allclose(v.numpy(), expected[k], rtol=5e-2)
+        q = small_grm.surrogate_distribution.model[k].distribution
+        np.testing.assert_allclose(q.concentration.numpy(), 1.)
+
+
+def test_conjugate_factors_are_not_trained(small_grm):
+    small_grm.enable_conjugate_updates()
+    trainable = {
+        v.ref()
+        for v in small_grm.surrogate_distribution.trainable_variables}
+    for v in small_grm.conjugate_variables():
+        assert v.ref() not in trainable
+
+
+def test_calibration_keeps_conjugate_factors_optimal(small_grm):
+    small_grm.enable_conjugate_updates()
+    losses = small_grm.calibrate_advi(
+        num_epochs=2, data_batches=3, set_expectations=False,
+        conjugate_every=1)
+    assert np.all(np.isfinite(losses))
+    expected = monte_carlo_scales(small_grm)
+    for k, v in small_grm.conjugate_scales.items():
+        np.testing.assert_allclose(v.numpy(), expected[k], rtol=5e-2)
@@ -0,0 +1,47 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tensorflow_probability")
+synthetic = pytest.importorskip("autoencirt.data.synthetic")
+
+from autoencirt.irt import DichotomousModel, GRModel  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def binary_data(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("binary"))
+    synthetic.simulate_grm(
+        path, num_people=40, num_items=5, response_cardinality=2,
+        dimensions=1, missingness=0.1, seed=1)
+    return synthetic.load_synthetic(path)
+
+
+def build(model_class, binary_data, **kwargs):
+    dataset, header = binary_data
+    return model_class(
+        data=dataset, item_keys=header["item_keys"],
+        num_people=header["num_people"], dim=1, factor_init=None, **kwargs)
+
+
+def test_matches_two_category_grm(binary_data):
+    dataset, header = binary_data
+    grm = build(GRModel, binary_data, response_cardinality=2)
+    dichotomous = build(DichotomousModel, binary_data)
+    params = grm.surrogate_distribution.sample(3)
+    batch = next(iter(dataset.batch(header["num_people"])))
+    expected = grm.log_likelihood(
+        batch, discriminations=params['discriminations'],
+        difficulties0=params['difficulties0'],
+        ddifficulties=params['ddifficulties'],
+        abilities=params['abilities'])
+    result = dichotomous.log_likelihood(
+        batch, discriminations=params['discriminations'],
+        difficulties0=params['difficulties0'],
+        abilities=params['abilities'])
+    np.testing.assert_allclose(result.numpy(), expected.numpy(), rtol=1e-6)
+
+
+def test_rejects_other_cardinalities(binary_data):
+    with pytest.raises(ValueError, match="two categories"):
+        build(DichotomousModel, binary_data, response_cardinality=3)
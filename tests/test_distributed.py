@@ -0,0 +1,64 @@
+import functools
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+distributed = pytest.importorskip("autoencirt.irt.distributed")
+synthetic = pytest.importorskip("autoencirt.data.synthetic")
+
+from autoencirt.irt.moments import factorized_moments  # noqa: E402
+from autoencirt.irt.persistence import (  # noqa: E402
+    load_arrays, load_model, surrogate_arrays)
+
+ADVI = {'num_epochs': 150, 'sample_size': 16, 'learning_rate': 0.05}
+
+
+def records(path):
+    # module level, so that spawned workers can unpickle it
+    return synthetic.load_synthetic(path)[0]
+
+
+@pytest.fixture
+def initial_dir(small_grm, tmp_path):
+    path = str(tmp_path/"initial")
+    small_grm.save(path)
+    return path
+
+
+def test_distributed_matches_a_single_process(
+        synthetic_dir, initial_dir, tmp_path):
+    workdir = str(tmp_path/"work")
+    model = load_model(initial_dir, mmap_mode=None)
+    losses = distributed.calibrate_advi_distributed(
+        model, functools.partial(records, synthetic_dir), num_workers=2,
+        data_batches=2, threads=1, workdir=workdir,
+        set_expectations=False, **ADVI)
+    assert np.all(np.isfinite(losses))
+
+    single = load_model(initial_dir, mmap_mode=None)
+    single.calibrate_advi(
+        data=records(synthetic_dir), data_batches=4,
+        set_expectations=False, **ADVI)
+
+    # the global variables agree up to the optimization noise
+    mean, _ = factorized_moments(model.surrogate_distribution)
+    expected, _ = factorized_moments(single.surrogate_distribution)
+    for k in ['discriminations', 'difficulties0', 'ddifficulties']:
+        a, b = mean[k].numpy(), expected[k].numpy()
+        assert np.linalg.norm(a - b) < 0.1*np.linalg.norm(b), k
+
+    # every ability row comes from the worker that owns it
+    arrays = surrogate_arrays(model)
+    owners = np.full(model.num_people, -1)
+    for w in range(2):
+        path = os.path.join(workdir, f"worker{w}")
+        owned = np.load(os.path.join(path, "owned.npy"))
+        assert np.all(owners[owned] == -1)
+        owners[owned] = w
+        for name, value in load_arrays(path, prefix="surrogate/").items():
+            if name.startswith("surrogate/abilities/"):
+                assert value.shape[0] == len(owned)
+                np.testing.assert_array_equal(arrays[name][owned], value)
+    assert np.all(owners >= 0)
@@ -0,0 +1,97 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+tfp = pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.estimators import (  # noqa: E402
+    elementwise_negative_log_q, linear_control_variate, negative_log_q,
+    negative_log_q_terms)
+
+tfd = tfp.distributions
+tfb = tfp.bijectors
+
+
+def surrogate(loc, scale):
+    loc = tf.Variable(loc, dtype=tf.float64)
+    scale = tfp.util.TransformedVariable(
+        scale, tfb.Softplus(), dtype=tf.float64)
+    joint = tfd.JointDistributionNamed({
+        'x': tfd.Independent(tfd.Normal(loc, scale), 1),
+        'y': tfd.Independent(tfd.TransformedDistribution(
+            tfd.Normal(loc, scale), tfb.Softplus()), 1)
+    })
+    return joint, [loc] + list(scale.trainable_variables)
+
+
+def test_estimators_agree_in_value():
+    joint, _ = surrogate([0.5, -1.], [0.3, 2.])
+    samples = joint.sample(7, seed=1)
+    standard = negative_log_q(joint, samples, 'standard')
+    stl = negative_log_q(joint, samples, 'stl')
+    np.testing.assert_allclose(stl.numpy(), standard.numpy())
+    # the analytic estimate differs per draw but not in expectation
+    samples = joint.sample(20000, seed=2)
+    analytic = negative_log_q(joint, samples, 'analytic')
+    standard = negative_log_q(joint, samples, 'standard')
+    np.testing.assert_allclose(
+        np.mean(analytic.numpy()), np.mean(standard.numpy()), rtol=1e-2)
+
+
+def test_terms_sum_to_negative_log_q():
+    joint, _ = surrogate([0.5, -1.], [0.3, 2.])
+    samples = joint.sample(5, seed=3)
+    for estimator in ['standard', 'stl', 'analytic']:
+        terms = negative_log_q_terms(joint, samples, estimator)
+        np.testing.assert_allclose(
+            tf.add_n(list(terms.values())).numpy(),
+            negative_log_q(joint, samples, estimator).numpy())
+        for k, distribution in joint.model.items():
+            elementwise = elementwise_negative_log_q(
+                distribution, samples[k], estimator)
+            np.testing.assert_allclose(
+                tf.reduce_sum(elementwise, axis=-1).numpy(),
+                terms[k].numpy())
+
+
+def test_unknown_estimator():
+    joint, _ = surrogate([0.], [1.])
+    with pytest.raises(ValueError):
+        negative_log_q_terms(joint, joint.sample(2), 'unknown')
+
+
+def test_sticking_the_landing_has_zero_gradient_at_the_optimum():
+    # q equals the target, so every STL draw has zero ELBO gradient
+    joint, variables = surrogate([0.5, -1.], [0.3, 2.])
+    target = tfd.Independent(tfd.Normal(
+        tf.constant([0.5, -1.], tf.float64),
+        tf.constant([0.3, 2.], tf.float64)), 1)
+
+    def elbo_gradients(estimator):
+        with tf.GradientTape() as tape:
+            samples = joint.sample(3, seed=4)
+            elbo = target.log_prob(samples['x']) + (
+                negative_log_q_terms(joint, samples, estimator)['x'])
+        return tape.gradient(tf.reduce_sum(elbo), variables)
+
+    for g in elbo_gradients('stl'):
+        np.testing.assert_allclose(g.numpy(), 0., atol=1e-10)
+    assert any(
+        np.max(np.abs(g.numpy())) > 1e-3 for g in elbo_gradients('standard'))
+
+
+def test_linear_control_variate_cancels_a_linear_likelihood():
+    a = tf.constant([2., -3.], tf.float64)
+    loc = tf.constant([0.5, -1.], tf.float64)
+    joint = tfd.JointDistributionNamed({
+        'x': tfd.Independent(tfd.Normal(
+            loc, tf.constant([0.3, 2.], tf.float64)), 1)})
+
+    def log_likelihood(params):
+        return tf.reduce_sum(a*params['x'], axis=-1)
+
+    samples = joint.sample(11, seed=5)
+    corrected = log_likelihood(samples) - linear_control_variate(
+        log_likelihood, joint, samples)
+    np.testing.assert_allclose(
+        corrected.numpy(), np.full(11, np.sum(a.numpy()*loc.numpy())))
@@ -0,0 +1,94 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+tfp = pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.laplace import (  # noqa: E402
+    Flattener, block_probes, probe_diagonal, set_surrogate_from_laplace)
+
+tfd = tfp.distributions
+
+
+def block_hessian(num_people, dim, rng):
+    """Symmetric Hessian over {'abilities': (N, D), 'xi': (D,)} in which
+    different people only interact through xi
+    """
+    size = num_people*dim + dim
+    H = np.zeros([size, size])
+    for n in range(num_people):
+        rows = slice(n*dim, (n + 1)*dim)
+        block = rng.normal(size=[dim, dim])
+        H[rows, rows] = block + block.T
+    coupling = rng.normal(size=[num_people*dim, dim])
+    H[:num_people*dim, num_people*dim:] = coupling
+    H[num_people*dim:, :num_people*dim] = coupling.T
+    xi = rng.normal(size=[dim, dim])
+    H[num_people*dim:, num_people*dim:] = xi + xi.T
+    return H
+
+
+def test_flattener_round_trip():
+    structure = {
+        'a': tf.reshape(tf.range(6, dtype=tf.float64), [3, 2]),
+        'b': tf.constant([7.], tf.float64)}
+    flat = Flattener(structure)
+    vector = flat.flatten(structure)
+    np.testing.assert_allclose(vector.numpy(), np.arange(8.))
+    back = flat.unflatten(vector)
+    for k in structure:
+        np.testing.assert_allclose(back[k].numpy(), structure[k].numpy())
+
+
+def test_block_probes_cover_every_entry_once():
+    flat = Flattener({
+        'abilities': tf.zeros([5, 3, 1, 1]), 'xi': tf.zeros([1, 3, 1, 1])})
+    probes = np.array(list(block_probes(flat, {'abilities': [0]})))
+    # one probe per ability dimension, one per element of xi
+    assert probes.shape == (6, 18)
+    np.testing.assert_allclose(np.sum(probes, axis=0), 1.)
+
+
+def test_probe_diagonal_is_exact():
+    rng = np.random.default_rng(0)
+    N, D = 7, 3
+    H = block_hessian(N, D, rng)
+    flat = Flattener({
+        'abilities': tf.zeros([N, D]), 'xi': tf.zeros([D])})
+    diagonal = probe_diagonal(
+        lambda v: tf.linalg.matvec(tf.constant(H), v),
+        block_probes(flat, {'abilities': [0]}), tf.float64)
+    np.testing.assert_allclose(diagonal.numpy(), np.diag(H))
+    # ignoring the blocks mixes in off-diagonal terms
+    wrong = probe_diagonal(
+        lambda v: tf.linalg.matvec(tf.constant(H), v),
+        [np.ones(N*D + D)], tf.float64)
+    assert not np.allclose(wrong.numpy(), np.diag(H))
+
+
+def test_set_surrogate_from_laplace():
+    loc = tf.Variable([0., 0.], dtype=tf.float64)
+    scale = tfp.util.TransformedVariable(
+        [1., 1.], tfp.bijectors.Softplus(), dtype=tf.float64)
+    concentration = tf.Variable([3., 3.], dtype=tf.float64)
+    ig_scale = tf.Variable([1., 1.], dtype=tf.float64)
+    surrogate = tfd.JointDistributionNamed({
+        'x': tfd.Independent(tfd.Normal(loc, scale), 1),
+        'y': tfd.Independent(tfd.InverseGamma(concentration, ig_scale), 1),
+        'z': tfd.Independent(tfd.Normal(
+            tf.Variable([5.], dtype=tf.float64),
+            tf.constant([1.], tf.float64)), 1)})
+    set_surrogate_from_laplace(
+        surrogate,
+        {'x': [1., 2.], 'y': [2., 4.], 'z': [0.]},
+        {'x': [0.5, 0.25], 'y': [1., 1.], 'z': [3.]},
+        skip=['z'])
+    np.testing.assert_allclose(loc.numpy(), [1., 2.])
+    np.testing.assert_allclose(
+        tf.convert_to_tensor(scale).numpy(), [0.5, 0.25])
+    mean = ig_scale.numpy()/(concentration.numpy() - 1.)
+    sd = mean/np.sqrt(concentration.numpy() - 2.)
+    np.testing.assert_allclose(mean, [2., 4.])
+    np.testing.assert_allclose(sd, [1., 1.])
+    np.testing.assert_allclose(
+        surrogate.model['z'].distribution.loc.numpy(), [5.])
@@ -0,0 +1,116 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+tfp = pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.moments import (  # noqa: E402
+    expectation, factorized_moments, surrogate_moments)
+
+tfd = tfp.distributions
+tfb = tfp.bijectors
+# renamed in numpy 2
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+
+def grid_moments(log_density, fn, low, high, size=200001):
+    """Mean and variance of fn(X) by the trapezoid rule in log x
+    """
+    u = np.linspace(np.log(low), np.log(high), size)
+    x = np.exp(u)
+    w = np.exp(log_density(x) - np.max(log_density(x)))*x
+    w /= trapezoid(w, u)
+    mean = trapezoid(fn(x)*w, u)
+    return mean, trapezoid(fn(x)**2*w, u) - mean**2
+
+
+def inverse_gamma_log_density(a, b):
+    return lambda x: (
+        a*np.log(b) - math.lgamma(a) - (a + 1.)*np.log(x) - b/x)
+
+
+def softplus(x):
+    return np.logaddexp(0., x)
+
+
+def test_normal_moments_are_exact():
+    loc = tf.constant([[-1.], [2.]], tf.float64)
+    scale = tf.constant([0.5, 3.], tf.float64)
+    mean, var = surrogate_moments(
+        tfd.Independent(tfd.Normal(loc, scale), 2))
+    np.testing.assert_allclose(mean.numpy(), [[-1., -1.], [2., 2.]])
+    np.testing.assert_allclose(var.numpy(), [[0.25, 9.], [0.25, 9.]])
+
+
+def test_inverse_gamma_moments_are_exact():
+    mean, var = surrogate_moments(tfd.InverseGamma(
+        tf.constant([5., 3.], tf.float64), tf.constant([3., 1.], tf.float64)))
+    np.testing.assert_allclose(mean.numpy(), [3./4., 1./2.])
+    np.testing.assert_allclose(var.numpy(), [9./48., 1./4.])
+
+
+def test_softplus_normal_moments():
+    loc, scale = 0.3, 0.8
+    mean, var = surrogate_moments(tfd.TransformedDistribution(
+        tfd.Normal(tf.constant(loc, tf.float64),
+                   tf.constant(scale, tf.float64)),
+        tfb.Softplus()))
+    z = np.linspace(-12., 12., 200001)
+    w = np.exp(-0.5*z**2)
+    w /= trapezoid(w, z)
+    values = softplus(loc + scale*z)
+    expected = trapezoid(values*w, z)
+    np.testing.assert_allclose(mean.numpy(), expected, rtol=1e-6)
+    np.testing.assert_allclose(
+        var.numpy(), trapezoid(values**2*w, z) - expected**2, rtol=1e-4)
+
+
+@pytest.mark.parametrize("a,b", [(6., 2.), (3.5, 0.1), (4.5, 10.)])
+def test_softplus_inverse_gamma_moments(a, b):
+    mean, var = surrogate_moments(tfd.TransformedDistribution(
+        tfd.InverseGamma(
+            tf.constant(a, tf.float64), tf.constant(b, tf.float64)),
+        tfb.Softplus()))
+    expected_mean, expected_var = grid_moments(
+        inverse_gamma_log_density(a, b), softplus, 1e-6, 1e6)
+    np.testing.assert_allclose(mean.numpy(), expected_mean, rtol=1e-3)
+    np.testing.assert_allclose(var.numpy(), expected_var, rtol=1e-2)
+
+
+def test_missing_moments_fall_back_to_sampling():
+    mean, var = surrogate_moments(tfd.InverseGamma(
+        tf.constant([0.5, 5.], tf.float64),
+        tf.constant([1., 3.], tf.float64)), samples=10)
+    assert np.all(np.isfinite(mean.numpy()))
+    np.testing.assert_allclose(mean.numpy()[1], 3./4.)
+
+
+def test_expectation_by_quadrature():
+    value = expectation(
+        tfd.Normal(tf.constant(1., tf.float64), tf.constant(2., tf.float64)),
+        lambda x: x**2)
+    np.testing.assert_allclose(value.numpy(), 5.)
+
+
+def test_factorized_moments():
+    joint = tfd.JointDistributionNamed({
+        'x': tfd.Normal(tf.constant(1., tf.float64),
+                        tf.constant(2., tf.float64)),
+        'y': tfd.InverseGamma(tf.constant(4., tf.float64),
+                              tf.constant(6., tf.float64))})
+    mean, var = factorized_moments(joint)
+    np.testing.assert_allclose(mean['x'].numpy(), 1.)
+    np.testing.assert_allclose(var['x'].numpy(), 4.)
+    np.testing.assert_allclose(mean['y'].numpy(), 2.)
+    np.testing.assert_allclose(var['y'].numpy(), 2.)
+
+
+def test_factorized_moments_rejects_dependent_surrogates():
+    joint = tfd.JointDistributionNamed({
+        'x': tfd.Normal(tf.constant(0., tf.float64),
+                        tf.constant(1., tf.float64)),
+        'y': lambda x: tfd.Normal(x, tf.constant(1., tf.float64))})
+    with pytest.raises(ValueError):
+        factorized_moments(joint)
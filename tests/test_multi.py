@@ -0,0 +1,98 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.multi import MultiGRModel  # noqa: E402
+from autoencirt.irt.persistence import surrogate_arrays  # noqa: E402
+
+ITEMS = ['discriminations', 'difficulties0', 'ddifficulties']
+
+
+def instrument(dataset, header, item_keys, name):
+    return {
+        'item_keys': item_keys, 'num_people': header['num_people'],
+        'data': dataset, 'name': name,
+        'response_cardinality': header['response_cardinality']}
+
+
+@pytest.fixture
+def two_instruments(synthetic_data):
+    dataset, header = synthetic_data
+    keys = header['item_keys']
+    return MultiGRModel([
+        instrument(dataset, header, keys[:2], 'A'),
+        instrument(dataset, header, keys[2:], 'B')], dim=2,
+        factor_init=None, seed=0)
+
+
+def batch_log_likelihood(model, batch, params):
+    return model.log_likelihood(
+        batch, **{k: params[k] for k in ITEMS + ['abilities']}).numpy()
+
+
+def test_one_instrument_matches_grm(synthetic_data, small_grm):
+    dataset, header = synthetic_data
+    multi = MultiGRModel(
+        [instrument(dataset, header, header['item_keys'], 'A')], dim=2,
+        factor_init=None)
+    params = multi.surrogate_distribution.sample(3)
+    num_people = header['num_people']
+    np.testing.assert_allclose(
+        batch_log_likelihood(
+            multi, next(iter(multi.instrument_dataset(0).batch(num_people))),
+            params),
+        batch_log_likelihood(
+            small_grm, next(iter(dataset.batch(num_people))), params),
+        rtol=1e-6)
+
+
+def test_instrument_model_slices_round_trip(two_instruments, synthetic_data):
+    dataset, header = synthetic_data
+    params = two_instruments.surrogate_distribution.sample(3)
+    keys = header['item_keys']
+    for name, item_keys in [('A', keys[:2]), ('B', keys[2:])]:
+        model = two_instruments.instrument_model(name)
+        assert model.item_keys == item_keys
+        arrays = surrogate_arrays(model)
+        for k, value in surrogate_arrays(two_instruments).items():
+            np.testing.assert_array_equal(
+                arrays[k],
+                two_instruments.instrument_slice(name, k.split("/")[1], value))
+
+        sliced = {
+            k: two_instruments.instrument_slice(name, k, params[k])
+            for k in ITEMS + ['abilities']}
+        np.testing.assert_allclose(
+            batch_log_likelihood(
+                two_instruments,
+                next(iter(two_instruments.instrument_dataset(name).batch(
+                    header['num_people']))), params),
+            batch_log_likelihood(
+                model, next(iter(dataset.batch(header['num_people']))),
+                sliced),
+            rtol=1e-6)
+
+
+def test_per_instrument_waic_and_score(two_instruments, tmp_path):
+    model = two_instruments
+    model.set_calibration_expectations()
+    model.sample_posterior(num_samples=20, mode='summary')
+
+    waic = model.waic(num_splits=2, data_batches=2)
+    assert set(waic.keys()) == {'A', 'B'}
+
+    rng = np.random.default_rng(0)
+    responses = {
+        name: rng.integers(0, 3, size=(5, 2)) for name in ['A', 'B']}
+    scores = model.score(responses, samples=50)
+    assert set(scores.keys()) == {'A', 'B'}
+    for mean, *_ in scores.values():
+        assert np.all(np.isfinite(np.asarray(mean)))
+
+    path = str(tmp_path/"multi")
+    model.save(path)
+    loaded = MultiGRModel.load(path)
+    with pytest.raises(ValueError, match="has no data"):
+        loaded.waic()
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.grm import GRModel  # noqa: E402
+from autoencirt.irt.persistence import surrogate_arrays  # noqa: E402
+
+
+@pytest.fixture
+def saved(small_grm, tmp_path):
+    small_grm.set_calibration_expectations()
+    small_grm.surrogate_sample = {
+        k: v.numpy()
+        for k, v in small_grm.surrogate_distribution.sample(5).items()}
+    path = str(tmp_path/"grm")
+    small_grm.save(path, include_samples=True)
+    return small_grm, path
+
+
+def assert_same(model, loaded):
+    expected = surrogate_arrays(model)
+    arrays = surrogate_arrays(loaded)
+    assert set(arrays) == set(expected)
+    for name, value in expected.items():
+        np.testing.assert_array_equal(arrays[name], value)
+    for k, v in model.calibrated_expectations.items():
+        np.testing.assert_array_equal(
+            np.asarray(loaded.calibrated_expectations[k]), np.asarray(v))
+        np.testing.assert_array_equal(
+            np.asarray(loaded.calibrated_sd[k]),
+            np.asarray(model.calibrated_sd[k]))
+    # the stored draws, not new ones
+    for k, v in model.surrogate_sample.items():
+        np.testing.assert_array_equal(
+            np.asarray(loaded.surrogate_sample[k]), v)
+
+
+def test_round_trip_in_memory(saved):
+    model, path = saved
+    loaded = GRModel.load(path, mmap_mode=None)
+    assert isinstance(loaded, GRModel)
+    assert loaded.item_keys == model.item_keys
+    assert loaded.dimensions == model.dimensions
+    assert_same(model, loaded)
+
+
+def test_round_trip_memory_mapped(saved):
+    model, path = saved
+    loaded = GRModel.load(path, mmap_mode='r')
+    assert_same(model, loaded)
+    for k in model.calibrated_expectations:
+        assert isinstance(loaded.calibrated_expectations[k], np.memmap)
+    for k in model.surrogate_sample:
+        assert isinstance(loaded.surrogate_sample[k], np.memmap)
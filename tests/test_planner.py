@@ -0,0 +1,91 @@
+import types
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from autoencirt.irt.planner import MemoryPlanner, parse_bytes  # noqa: E402
+
+
+def fake_model(num_people, dim=2, num_items=10, cardinality=5):
+    return types.SimpleNamespace(
+        num_people=num_people, dimensions=dim, num_items=num_items,
+        response_cardinality=cardinality, dtype=types.SimpleNamespace(size=8))
+
+
+def calibration_budget(model, sample_size, batch_size):
+    """A budget for which plan_calibration picks exactly batch_size
+    """
+    planner = MemoryPlanner(1)
+    fixed = 4*sample_size*model.num_people*model.dimensions*8
+    per_person = planner.intermediate_factor*planner.gradient_factor*(
+        model.dimensions*model.num_items*model.response_cardinality*8)
+    return int(fixed + per_person*sample_size*batch_size)
+
+
+def realised_batch_size(num_people, data_batches):
+    # as BayesianModel._batch_data
+    return max(int(np.floor(num_people/data_batches)), 1)
+
+
+def test_parse_bytes():
+    assert parse_bytes(1024) == 1024
+    assert parse_bytes("4GB") == 4*2**30
+    assert parse_bytes(" 1.5 MiB ") == int(1.5*2**20)
+    with pytest.raises(ValueError):
+        parse_bytes("lots")
+
+
+def test_plan_calibration_batch_size():
+    model = fake_model(1050)
+    planner = MemoryPlanner.for_model(
+        model, calibration_budget(model, 4, 100))
+    plan = planner.plan_calibration(model, 4)
+    assert plan['batch_size'] == 100
+    assert plan['data_batches'] == 11
+    assert plan['predicted_bytes'] <= planner.budget
+
+
+@pytest.mark.parametrize("num_people", [1, 99, 100, 101, 1050, 9999])
+@pytest.mark.parametrize("batch_size", [1, 7, 100, 512])
+def test_realised_batches_within_plan(num_people, batch_size):
+    model = fake_model(num_people)
+    planner = MemoryPlanner.for_model(
+        model, calibration_budget(model, 4, batch_size))
+    plan = planner.plan_calibration(model, 4)
+    assert plan['batch_size'] <= batch_size
+    assert realised_batch_size(
+        num_people, plan['data_batches']) <= plan['batch_size']
+
+
+def test_plan_calibration_over_budget():
+    model = fake_model(10**6)
+    with pytest.raises(MemoryError):
+        MemoryPlanner(2**20).plan_calibration(model, 4)
+
+
+@pytest.mark.parametrize("num_people", [300, 1050, 100000])
+def test_plan_waic_within_budget(num_people):
+    model = fake_model(num_people)
+    planner = MemoryPlanner("64MB")
+    plan = planner.plan_waic(model, 100)
+    batch_size = realised_batch_size(num_people, plan['data_batches'])
+    split_size = int(np.ceil(100/plan['num_splits']))
+    assert planner.likelihood_bytes(
+        model, split_size, batch_size) <= planner.budget
+
+
+def test_batch_data_respects_plan():
+    tf = pytest.importorskip("tensorflow")
+    model_module = pytest.importorskip("autoencirt.irt.model")
+    model = fake_model(1050)
+    planner = MemoryPlanner.for_model(
+        model, calibration_budget(model, 4, 100))
+    plan = planner.plan_calibration(model, 4)
+    data = tf.data.Dataset.from_tensor_slices(
+        {'person': tf.range(1050, dtype=tf.int64)})
+    batched, num_batches = model_module.BayesianModel()._batch_data(
+        data, plan['data_batches'])
+    sizes = [int(batch['person'].shape[0]) for batch in batched]
+    assert num_batches == len(sizes)
+    assert max(sizes) <= plan['batch_size']
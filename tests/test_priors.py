@@ -0,0 +1,70 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+tfp = pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.priors import (  # noqa: E402
+    abs_horseshoe_log_prob, half_normal_log_prob, horseshoe_log_prob,
+    inverse_gamma_log_prob, normal_log_prob, sqrt_inverse_gamma_log_prob)
+
+tfd = tfp.distributions
+tfb = tfp.bijectors
+
+X = tf.constant([1e-3, 0.1, 0.7, 2., 30.], tf.float64)
+SCALE = tf.constant([0.01, 0.1, 1., 3., 0.5], tf.float64)
+
+
+def test_normal_and_half_normal():
+    np.testing.assert_allclose(
+        normal_log_prob(X, 0.5, SCALE).numpy(),
+        tfd.Normal(tf.constant(0.5, tf.float64), SCALE).log_prob(X).numpy())
+    np.testing.assert_allclose(
+        half_normal_log_prob(X, SCALE).numpy(),
+        tfd.HalfNormal(SCALE).log_prob(X).numpy())
+    assert half_normal_log_prob(
+        -X, SCALE).numpy().max() == -np.inf
+
+
+def test_inverse_gamma():
+    np.testing.assert_allclose(
+        inverse_gamma_log_prob(X, 0.5*SCALE, SCALE).numpy(),
+        tfd.InverseGamma(0.5*SCALE, SCALE).log_prob(X).numpy())
+
+
+def test_sqrt_inverse_gamma():
+    half = tf.constant(0.5, tf.float64)
+    expected = tfd.TransformedDistribution(
+        tfd.InverseGamma(half*tf.ones_like(SCALE), 1./SCALE),
+        tfb.Power(power=0.5)).log_prob(X)
+    np.testing.assert_allclose(
+        sqrt_inverse_gamma_log_prob(X, half, 1./SCALE).numpy(),
+        expected.numpy())
+
+
+def test_horseshoe():
+    np.testing.assert_allclose(
+        horseshoe_log_prob(X, SCALE).numpy(),
+        tfd.Horseshoe(scale=SCALE).log_prob(X).numpy())
+    expected = tfd.TransformedDistribution(
+        tfd.Horseshoe(scale=SCALE), tfb.AbsoluteValue()).log_prob(X)
+    np.testing.assert_allclose(
+        abs_horseshoe_log_prob(X, SCALE).numpy(), expected.numpy())
+
+
+def test_fused_prior_matches_the_joint_distribution(small_grm):
+    params = small_grm.surrogate_distribution.sample(3, seed=0)
+    expected = small_grm.joint_prior_distribution.log_prob(params)
+    fused = tf.add_n(list(small_grm.log_prior_terms(params).values()))
+    np.testing.assert_allclose(fused.numpy(), expected.numpy(), rtol=1e-10)
+
+
+def test_generic_prior_terms_match_the_fused_ones(small_grm):
+    model_module = pytest.importorskip("autoencirt.irt.model")
+    params = small_grm.surrogate_distribution.sample(3, seed=1)
+    fused = small_grm.log_prior_terms(params)
+    generic = model_module.BayesianModel.log_prior_terms(small_grm, params)
+    assert set(generic) == set(fused)
+    for k in fused:
+        np.testing.assert_allclose(
+            generic[k].numpy(), fused[k].numpy(), rtol=1e-10)
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tensorflow_probability")
+
+from autoencirt.irt.callbacks import Callback  # noqa: E402
+
+STAGES = [
+    {'num_epochs': 2, 'learning_rate': 0.05},
+    {'num_epochs': 2, 'learning_rate': 0.01}]
+
+
+class Interrupt(Exception):
+    pass
+
+
+class StepCounter(Callback):
+
+    def __init__(self, stop_after=None):
+        self.steps = 0
+        self.stop_after = stop_after
+
+    def on_step_end(self, step, logs=None):
+        self.steps += 1
+        if self.steps == self.stop_after:
+            raise Interrupt()
+
+
+def calibrate(model, checkpoint_dir, counter):
+    return model.calibrate_advi_staged(
+        STAGES, data_batches=2, sample_size=4, checkpoint_dir=checkpoint_dir,
+        set_expectations=False, callbacks=[counter])
+
+
+def test_resume_skips_finished_stages(small_grm, tmp_path):
+    checkpoint_dir = str(tmp_path)
+    # stage 1 takes 2 epochs of 2 batches, stop in the first step of stage 2
+    with pytest.raises(Interrupt):
+        calibrate(small_grm, checkpoint_dir, StepCounter(stop_after=5))
+    marker = os.path.join(checkpoint_dir, "stage0", "done.npz")
+    assert os.path.exists(marker)
+    assert not os.path.exists(
+        os.path.join(checkpoint_dir, "stage1", "done.npz"))
+    modified = os.path.getmtime(marker)
+    with np.load(marker) as done:
+        first_losses = done['losses']
+
+    counter = StepCounter()
+    losses = calibrate(small_grm, checkpoint_dir, counter)
+    # only stage 2 ran
+    assert 0 < counter.steps <= 4
+    assert len(losses) == 2
+    np.testing.assert_array_equal(losses[0], first_losses)
+    assert os.path.getmtime(marker) == modified
+    assert os.path.exists(
+        os.path.join(checkpoint_dir, "stage1", "done.npz"))
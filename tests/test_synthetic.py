@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+synthetic = pytest.importorskip("autoencirt.data.synthetic")
+sweep = pytest.importorskip("autoencirt.irt.sweep")
+
+
+def simulate(path, seed=0, **kwargs):
+    kwargs = {
+        'num_people': 200, 'num_items': 6, 'response_cardinality': 4,
+        'dimensions': 2, **kwargs}
+    synthetic.simulate_grm(str(path), seed=seed, chunk_size=64, **kwargs)
+    return np.load(os.path.join(str(path), "responses.npy"))
+
+
+def as_matrix(dataset, header):
+    responses = np.full(
+        (header["num_people"], len(header["item_keys"])), -1.)
+    for batch in dataset.batch(64):
+        people = batch["person"].numpy()
+        responses[people] = np.stack(
+            [batch[k].numpy() for k in header["item_keys"]], axis=-1)
+    return responses
+
+
+def test_seed_determinism(tmp_path):
+    first = simulate(tmp_path/"a", seed=3)
+    np.testing.assert_array_equal(simulate(tmp_path/"b", seed=3), first)
+    assert np.any(simulate(tmp_path/"c", seed=4) != first)
+    a = synthetic.load_params(str(tmp_path/"a"))
+    b = synthetic.load_params(str(tmp_path/"b"))
+    for k in ["discriminations", "difficulties", "abilities"]:
+        np.testing.assert_array_equal(np.asarray(a[k]), np.asarray(b[k]))
+
+
+def test_missing_completely_at_random(tmp_path):
+    responses = simulate(tmp_path, num_people=2000, missingness=0.3)
+    missing = responses < 0
+    np.testing.assert_allclose(np.mean(missing), 0.3, atol=0.02)
+    # the rate does not depend on the item
+    np.testing.assert_allclose(np.mean(missing, axis=0), 0.3, atol=0.05)
+    assert np.all(responses[~missing] < 4)
+
+
+def test_holdout_splits_the_observed_responses(tmp_path):
+    data_dir = str(tmp_path/"data")
+    responses = simulate(data_dir, num_people=1000, missingness=0.2)
+    path = sweep.make_holdout(
+        data_dir, str(tmp_path/"holdout.npy"), fraction=0.25)
+    mask = np.load(path)
+    observed = responses >= 0
+    assert not np.any(mask & ~observed)
+    np.testing.assert_allclose(
+        np.sum(mask)/np.sum(observed), 0.25, atol=0.02)
+
+    train = as_matrix(*synthetic.load_synthetic(data_dir, holdout=path))
+    test = as_matrix(*synthetic.load_synthetic(
+        data_dir, holdout=path, held_out=True))
+    np.testing.assert_array_equal(train >= 0, observed & ~mask)
+    np.testing.assert_array_equal(test >= 0, mask)
+    # together the two halves give back every observed response
+    np.testing.assert_array_equal(np.maximum(train, test), responses)